@@ -0,0 +1,75 @@
+"""Per call latency of the batch size lookup over the tuning run data.
+
+Compares filtering and sorting a pandas frame on every call, as
+use_kb_for_batch_size used to, with the NumPy TuningRunIndex, run with
+
+    python benchmarks/bench_batch_size_lookup.py [num_rows] [num_calls]
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from tuning_config_recommender.utils.tuning_config import TuningRunIndex
+
+MODELS = [f"model-{i}" for i in range(200)]
+METHODS = ["full", "lora"]
+LENGTHS = [512, 1024, 2048, 4096, 8192, 16384]
+
+
+def _run_data(num_rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "model_name": rng.choice(MODELS, num_rows),
+            "method": rng.choice(METHODS, num_rows),
+            "model_max_length": rng.choice(LENGTHS, num_rows),
+            "per_device_train_batch_size": rng.integers(1, 64, num_rows),
+            "number_gpus": rng.choice([1, 2, 4, 8], num_rows),
+        }
+    )
+
+
+def lookup_with_pandas(df, model_name, method, target_length):
+    df = df[(df["model_name"] == model_name) & (df["method"] == method)]
+    exact_match = df[df["model_max_length"] == target_length]
+    if not exact_match.empty:
+        return exact_match.iloc[0]
+    smaller_matches = df[df["model_max_length"] < target_length]
+    if not smaller_matches.empty:
+        nearest = smaller_matches.sort_values(by="model_max_length", ascending=False)
+        return nearest.iloc[0]
+    return None
+
+
+def main(num_rows: int = 1_000_000, num_calls: int = 100):
+    df = _run_data(num_rows)
+    rng = np.random.default_rng(1)
+    queries = [
+        (rng.choice(MODELS), rng.choice(METHODS), int(rng.integers(256, 20000)))
+        for _ in range(num_calls)
+    ]
+
+    start = time.perf_counter()
+    index = TuningRunIndex(df)
+    print(f"{'index build':>16}: {time.perf_counter() - start:8.3f}s")
+
+    results = {}
+    for name, lookup in (
+        ("pandas", lambda q: lookup_with_pandas(df, *q)),
+        ("numpy index", lambda q: index.find_best_row(*q)),
+    ):
+        start = time.perf_counter()
+        results[name] = [lookup(q) for q in queries]
+        per_call = (time.perf_counter() - start) / num_calls
+        print(f"{name:>16}: {per_call * 1e6:10.1f}us per call")
+    for expected, row in zip(results["pandas"], results["numpy index"], strict=True):
+        assert (expected is None) == (row is None)
+        if row is not None:
+            assert row["model_max_length"] == expected["model_max_length"]
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,63 @@
+"""Attribution of final JSON patch ops to the actions that produced them.
+
+Compares list membership over op dicts with the hashed PatchIndex for a
+large data config, run with
+
+    python benchmarks/bench_patch_attribution.py [num_ops] [num_actions]
+"""
+
+import sys
+import time
+
+from tuning_config_recommender.utils import PatchIndex
+
+
+def _ops(num_ops: int) -> list[dict]:
+    return [
+        {
+            "op": "add",
+            "path": f"/tuning_data_config/datasets/{i}",
+            "value": {"name": f"d{i}", "data_paths": [f"/data/{i}.jsonl"]},
+        }
+        for i in range(num_ops)
+    ]
+
+
+def attribute_with_lists(final_ops, action_ops):
+    commented = []
+    for ops in action_ops:
+        if all(op in final_ops for op in ops):
+            commented.extend(ops)
+    return [op for op in final_ops if op not in commented]
+
+
+def attribute_with_index(final_ops, action_ops):
+    final_index = PatchIndex(final_ops)
+    commented = PatchIndex()
+    for ops in action_ops:
+        if final_index.covers(ops):
+            commented.update(ops)
+    return [op for op in final_ops if op not in commented]
+
+
+def main(num_ops: int = 10_000, num_actions: int = 12):
+    final_ops = _ops(num_ops)
+    # every action produced a slice of the final patch, built from fresh
+    # dicts as they are when diffed separately
+    chunk = num_ops // num_actions
+    action_ops = [
+        _ops(num_ops)[i * chunk : (i + 1) * chunk] for i in range(num_actions)
+    ]
+    results = {}
+    for name, fn in (
+        ("list membership", attribute_with_lists),
+        ("hashed index", attribute_with_index),
+    ):
+        start = time.perf_counter()
+        results[name] = fn(final_ops, action_ops)
+        print(f"{name:>16}: {time.perf_counter() - start:8.3f}s")
+    assert results["list membership"] == results["hashed index"]
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
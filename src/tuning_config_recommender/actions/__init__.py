@@ -1,6 +1,17 @@
-from .actions import IR, Action, Comment, PatchLevel, PatchType
+from .actions import (
+    IR,
+    REMOVE,
+    Action,
+    Comment,
+    PatchLevel,
+    PatchType,
+    RunContext,
+    get_run_context,
+    reset_run_context,
+    set_run_context,
+)
 from .compute import ApplyComputeConfig
-from .data import ApplyChatFormat, ApplyQAFormat
+from .data import ApplyChatFormat, ApplyMaxSeqLength, ApplyQAFormat
 from .defaults import ApplyDefaults
 from .train import (
     ApplyDistributedTraining,
@@ -9,11 +20,13 @@ from .train import (
     ApplyLoRAConfig,
     ApplyMoEOptimization,
     ApplyOptimalBatchSize,
+    ApplyPackingOptimization,
     ApplyTrainingOptimization,
 )
 
 ACTIONS = [
     ApplyDefaults,
+    ApplyMaxSeqLength,
     ApplyComputeConfig,
     ApplyTrainingOptimization,
     ApplyDistributedTraining,
@@ -22,6 +35,7 @@ ACTIONS = [
     ApplyLoRAConfig,
     ApplyMoEOptimization,
     ApplyOptimalBatchSize,
+    ApplyPackingOptimization,
     ApplyChatFormat,
     ApplyQAFormat,
 ]
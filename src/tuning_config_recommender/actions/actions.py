@@ -1,3 +1,6 @@
+import hashlib
+import json
+from contextvars import ContextVar
 from dataclasses import dataclass, field
 from enum import StrEnum, auto
 from typing import Any
@@ -5,6 +8,16 @@ from typing import Any
 import jsonpatch
 from loguru import logger
 
+from tuning_config_recommender.constants import DEFAULT_PROBE_WORKERS
+from tuning_config_recommender.utils.cow import CowDict, thaw
+
+IR_SECTIONS = (
+    "tuning_config",
+    "compute_config",
+    "accelerate_config",
+    "tuning_data_config",
+)
+
 
 class PatchLevel(StrEnum):
     MANDATORY = auto()
@@ -31,6 +44,28 @@ class Comment:
         return self.comment
 
 
+class _Remove:
+    """Merge patch value removing its key from the IR, None values are set
+    like any other value"""
+
+    def __repr__(self):
+        return "<remove>"
+
+    def __reduce__(self):
+        # copies and unpickled patches refer to the same marker
+        return "REMOVE"
+
+
+REMOVE = _Remove()
+
+
+def _changes(section: dict, key: str, value) -> bool:
+    """Whether merging key: value changes the section"""
+    if value is REMOVE:
+        return key in section
+    return key not in section or section[key] != value
+
+
 @dataclass
 class IR:
     tuning_config: dict | None = field(default_factory=dict)
@@ -48,15 +83,104 @@ class IR:
             self.effect = self.type
 
     def update(self, json_merge_patch):
-        data_keys = [
-            "tuning_config",
-            "compute_config",
-            "accelerate_config",
-            "tuning_data_config",
-        ]
-        for key in data_keys:
+        # patched sections are replaced rather than modified in place
+        # so snapshots sharing them are left untouched
+        for key in IR_SECTIONS:
             if key in json_merge_patch.__dict__ and json_merge_patch.__dict__[key]:
-                self.__dict__[key].update(json_merge_patch.__dict__[key])
+                self.__dict__[key] = {
+                    k: v
+                    for k, v in {
+                        **(self.__dict__[key] or {}),
+                        **json_merge_patch.__dict__[key],
+                    }.items()
+                    if v is not REMOVE
+                }
+
+    def snapshot(self) -> "IR":
+        """IR sharing all sections with this one, which is cheap as long as
+        sections are only ever replaced through update"""
+        return IR(**self.__dict__)
+
+    def view(self) -> "IR":
+        """Copy-on-write view of this IR, it can be modified freely without
+        affecting this IR and only the parts written are ever copied"""
+        ir = self.snapshot()
+        for key in IR_SECTIONS:
+            if ir.__dict__[key] is not None:
+                ir.__dict__[key] = CowDict(ir.__dict__[key])
+        return ir
+
+    def thaw(self) -> "IR":
+        """Turn the sections of a view back into plain dicts in place"""
+        for key in IR_SECTIONS:
+            self.__dict__[key] = thaw(self.__dict__[key])
+        return self
+
+    def get_path(self, path: str):
+        """Value at an IR path, either a section or section.key"""
+        section, _, key = path.partition(".")
+        value = self.__dict__[section] or {}
+        return value.get(key) if key else value
+
+    def changed_paths(self, json_merge_patch) -> set[str]:
+        """section.key paths whose value would change by applying the patch"""
+        changed = set()
+        for section in IR_SECTIONS:
+            patch_section = json_merge_patch.__dict__.get(section)
+            if not patch_section:
+                continue
+            current = self.__dict__[section] or {}
+            for key, value in patch_section.items():
+                if _changes(current, key, value):
+                    changed.add(f"{section}.{key}")
+        return changed
+
+    def diff_paths(self, base: "IR") -> set[str]:
+        """section.key paths whose value differs from base, sections shared
+        with base are not compared"""
+        changed = set()
+        for section in IR_SECTIONS:
+            current, previous = self.__dict__[section], base.__dict__[section]
+            if current is previous:
+                continue
+            if not isinstance(current, dict) or not isinstance(previous, dict):
+                changed.add(section)
+                continue
+            for key in current.keys() | previous.keys():
+                if (
+                    key not in current
+                    or key not in previous
+                    or current[key] != previous[key]
+                ):
+                    changed.add(f"{section}.{key}")
+        return changed
+
+    def delta(self, base: "IR") -> "IR":
+        """Merge patch keeping only the keys whose value differs from base,
+        with the metadata of this patch"""
+        delta = IR(**self.__dict__)
+        for section in IR_SECTIONS:
+            patch_section = self.__dict__[section]
+            if not patch_section:
+                continue
+            current = base.__dict__[section] or {}
+            delta.__dict__[section] = {
+                key: value
+                for key, value in patch_section.items()
+                if _changes(current, key, value)
+            }
+        return delta
+
+    def fingerprint(self, paths: tuple[str, ...] = IR_SECTIONS) -> str:
+        """Digest of the values at the given IR paths, the whole IR by default"""
+        digest = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            digest.update(
+                json.dumps(
+                    [path, self.get_path(path)], sort_keys=True, default=str
+                ).encode("utf-8")
+            )
+        return digest.hexdigest()
 
     def to_dict(self):
         return self.__dict__
@@ -68,16 +192,144 @@ class IR:
             patch = []
         return patch
 
+    def get_json_patch_at(self, ir, paths) -> list:
+        """JSON patch from this IR to the given one over the given section or
+        section.key paths only, the IRs are taken to be equal elsewhere"""
+        patch = []
+        for path in paths:
+            section, _, key = path.partition(".")
+            source, target = self.__dict__[section], ir.__dict__[section]
+            if key and isinstance(source, dict) and isinstance(target, dict):
+                prefix = f"/{section}"
+                source = {key: source[key]} if key in source else {}
+                target = {key: target[key]} if key in target else {}
+            else:
+                prefix = ""
+                source, target = {section: source}, {section: target}
+            for op in jsonpatch.JsonPatch.from_diff(source, target):
+                op["path"] = prefix + op["path"]
+                if "from" in op:
+                    op["from"] = prefix + op["from"]
+                patch.append(op)
+        return patch
+
+    def order_json_patch(self, ir, ops_by_path: dict) -> list:
+        """Flatten JSON patch ops kept per changed path, see get_json_patch_at,
+        in the order a full diff of this IR against the given one gives"""
+        patch = []
+        sections = {path.partition(".")[0] for path in ops_by_path}
+        for section in IR_SECTIONS:
+            if section not in sections:
+                continue
+            if section in ops_by_path:
+                patch.extend(ops_by_path[section])
+                continue
+            source, target = self.__dict__[section], ir.__dict__[section]
+            # removed, added and then common keys, as jsonpatch diffs dicts
+            keys = [
+                *(key for key in source if key not in target),
+                *(key for key in target if key not in source),
+                *(key for key in source if key in target),
+            ]
+            for key in keys:
+                patch.extend(ops_by_path.get(f"{section}.{key}", ()))
+        return patch
+
+
+@dataclass
+class RunContext:
+    """Mutable state of one rule engine run. It is kept out of the engine
+    and the actions so that both can be shared by concurrent runs."""
+
+    actions_meta: list[str] = field(default_factory=list)
+    ir_pipeline: list[IR] = field(default_factory=list)
+    skipped: set = field(default_factory=set)
+    json_merge_patches: dict = field(default_factory=dict)
+    json_patches_and_comment_wrt_source: dict = field(default_factory=dict)
+    # JSON patch ops relative to the source IR per changed IR path
+    source_json_patches: dict = field(default_factory=dict)
+    # number of data paths actions probe concurrently
+    probe_workers: int = DEFAULT_PROBE_WORKERS
+
+
+_RUN_CONTEXT: ContextVar[RunContext | None] = ContextVar("run_context", default=None)
+
+
+def get_run_context() -> RunContext | None:
+    """Context of the rule engine run active in this thread or task"""
+    return _RUN_CONTEXT.get()
+
+
+def set_run_context(context: RunContext | None):
+    return _RUN_CONTEXT.set(context)
+
+
+def reset_run_context(token):
+    _RUN_CONTEXT.reset(token)
+
 
 class Action:
-    skip: bool = False
+    """Actions hold no state of their own. skip and the recorded patches live
+    in the context of the active rule engine run, outside of a run they are
+    kept per action instance."""
+
     depends_on_tuning_config: bool = False
     depends_on_compute_config: bool = False
     depends_on_accelerate_config: bool = False
     depends_on_tuning_data_config: bool = False
     depends_on_dataset: bool = False
-    json_merge_patches: list[IR] = []
-    json_patches_and_comment_wrt_source: list[dict] = []
+    # IR paths, either a section or section.key, the action reads and writes.
+    # None means undeclared, such an action is assumed to read and write the
+    # whole IR, so it is rerun on any change and never runs in parallel.
+    reads: tuple[str, ...] | None = None
+    writes: tuple[str, ...] | None = None
+
+    def _run_context(self) -> RunContext:
+        context = get_run_context()
+        if context is None:
+            context = self.__dict__.setdefault("_local_run_context", RunContext())
+        return context
+
+    @property
+    def skip(self) -> bool:
+        return self in self._run_context().skipped
+
+    @skip.setter
+    def skip(self, value: bool):
+        if value:
+            self._run_context().skipped.add(self)
+        else:
+            self._run_context().skipped.discard(self)
+
+    @property
+    def json_merge_patches(self) -> list[IR]:
+        return self._run_context().json_merge_patches.setdefault(self, [])
+
+    @property
+    def json_patches_and_comment_wrt_source(self) -> list[dict]:
+        return self._run_context().json_patches_and_comment_wrt_source.setdefault(
+            self, []
+        )
+
+    def read_paths(self) -> tuple[str, ...]:
+        """IR paths whose change makes the rule engine run the action again"""
+        paths = list(self.reads or [])
+        for section in IR_SECTIONS:
+            if getattr(self, f"depends_on_{section}"):
+                paths.append(section)
+        if self.depends_on_dataset:
+            paths.extend(["tuning_data_config", "tuning_config.training_data_path"])
+        if not paths and self.reads is None:
+            return IR_SECTIONS
+        return tuple(dict.fromkeys(paths))
+
+    def write_paths(self) -> tuple[str, ...]:
+        return IR_SECTIONS if self.writes is None else tuple(self.writes)
+
+    def warm(self):
+        """Load resources the action uses in every run ahead of the first one,
+        called once when an engine plan of the action is built"""
+        pass
 
     def heuristic_skip(self, ir: IR) -> bool:
         """Given the existing input, this function does some heuristic analysis
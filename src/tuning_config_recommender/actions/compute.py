@@ -4,6 +4,7 @@ from typing import Optional
 
 from loguru import logger
 
+from ..utils.profiling import profile_span
 from .actions import IR, Action, Comment, PatchLevel, PatchType
 
 try:
@@ -32,6 +33,15 @@ class ApplyComputeConfig(Action):
 
     _recommender: MinGpuRecommenderCaller | None = None
 
+    reads = (
+        "compute_config",
+        "tuning_config.model_name_or_path",
+        "tuning_config.tuning_strategy",
+        "tuning_config.max_seq_length",
+        "tuning_config.per_device_train_batch_size",
+    )
+    writes = ("compute_config.num_nodes", "compute_config.num_gpus_per_node")
+
     def __init__(self):
         if not skip_autoconf:
             if self._recommender is None:
@@ -182,7 +192,8 @@ class ApplyComputeConfig(Action):
         """
         logger.debug(f"Sending configuration to min gpu recommender: {config}")
 
-        result = self._recommender.run(config, self.RECOMMENDER_MODE)  # type: ignore
+        with profile_span("min_gpu_recommender", "estimator"):
+            result = self._recommender.run(config, self.RECOMMENDER_MODE)  # type: ignore
 
         # Early return if recommender failed
         if result["gpus_per_worker"] == self.RECOMMENDER_FAILURE_CODE:
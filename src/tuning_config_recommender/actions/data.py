@@ -1,35 +1,97 @@
+import math
+
+from loguru import logger
+
+from tuning_config_recommender.constants import (
+    MAX_SEQ_LENGTH_MULTIPLE,
+    MAX_SEQ_LENGTH_OVERSIZE_FACTOR,
+    MAX_SEQ_LENGTH_PERCENTILE,
+    MAX_TRUNCATION_RATE,
+)
 from tuning_config_recommender.utils.data_config import (
     determine_input_and_response_text,
     fetch_chat_template,
-    has_any_key_containing,
 )
 from tuning_config_recommender.utils.data_processing import (
     escape_newlines_in_strings,
-    load_training_data,
 )
+from tuning_config_recommender.utils.dataset_profile import (
+    CHAT_STYLE_KEYS,
+    ProbeResult,
+    find_inconsistent_shards,
+    get_dataset_profile,
+    probe_dataset_paths,
+)
+from tuning_config_recommender.utils.kb_table import load_kb
+from tuning_config_recommender.utils.token_stats import (
+    get_token_length_stats,
+    warm_tokenizer_backend,
+)
+from tuning_config_recommender.utils.tuning_config import get_model_config
 
 from .actions import IR, Action, Comment, PatchLevel, PatchType
 
 
+def get_data_paths(ir: IR) -> list[str]:
+    """All data paths referenced by the data config and the tuning config"""
+    paths = [
+        path
+        for dataset in ir.tuning_data_config.get("datasets", None) or []
+        for path in dataset.get("data_paths", [])
+    ]
+    if ir.tuning_config.get("training_data_path", None):
+        paths.append(ir.tuning_config["training_data_path"])
+    return paths
+
+
 class ApplyDataFormat(Action):
+    reads = (
+        "tuning_config.model_name_or_path",
+        "tuning_config.max_seq_length",
+        "tuning_config.training_data_path",
+        "tuning_data_config",
+    )
+    writes = (
+        "tuning_data_config",
+        "tuning_config.dataset_text_field",
+        "tuning_config.response_template",
+    )
+
+    def warm(self):
+        load_kb()
+
     def _is_data_in_required_format(self, dataset_path: str) -> bool:
         raise NotImplementedError(
             "Data format validation should be implemented by child data based action class."
         )
 
     def _is_data_tokenized(self, path):
-        data = load_training_data(path)
-        if not data or not isinstance(data, list):
-            return False
-        if not isinstance(data[0], dict):
-            return False
-        tokenized_fields = {"input_ids", "labels", "attention_mask"}
-        return any(field in data[0] for field in tokenized_fields)
+        return get_dataset_profile(path).is_tokenized
+
+    def _probe(self, paths: list[str]) -> dict[str, ProbeResult]:
+        return probe_dataset_paths(paths, self._run_context().probe_workers)
+
+    def _probe_data_paths(self, ir: IR) -> dict[str, ProbeResult]:
+        """Profile every data path of the IR concurrently, later format checks
+        on these paths are served from the profile cache."""
+        results = self._probe(get_data_paths(ir))
+        for path, result in results.items():
+            if result.error is not None:
+                logger.warning(f"Failed to probe data path {path}: {result.error}")
+        return results
+
+    def _is_path_in_format(self, path: str, result: ProbeResult | None = None) -> bool:
+        """Like _is_data_in_required_format, but a data path which could not be
+        probed is not in format rather than failing the whole action"""
+        if result is None:
+            result = self._probe([path])[path]
+        return result.error is None and self._is_data_in_required_format(path)
 
     def heuristic_skip(self, ir):
         if ir.tuning_config.get(
             "training_data_path", None
         ) or ir.tuning_data_config.get("datasets", None):
+            results = self._probe_data_paths(ir)
             if ir.tuning_data_config.get("datasets", None):
                 for dataset in ir.tuning_data_config["datasets"]:
                     if not len(dataset.get("data_paths", [])):
@@ -37,61 +99,172 @@ class ApplyDataFormat(Action):
                         # we should return IR with type USER_INTERVENTION
                         return True
                     for path in dataset.get("data_paths"):
-                        if self._is_data_in_required_format(
-                            path
-                        ) and not self._is_data_tokenized(path):
+                        if (
+                            self._is_path_in_format(path, results[path])
+                            and not results[path].profile.is_tokenized
+                        ):
                             # NOTE: we check for one path to be in format
                             # while all paths are checked in action.apply
                             # implementation
                             return False
             if ir.tuning_config.get("training_data_path", None):
-                return not self._is_data_in_required_format(
-                    ir.tuning_config.get("training_data_path", None)
+                training_data_path = ir.tuning_config["training_data_path"]
+                return not self._is_path_in_format(
+                    training_data_path, results[training_data_path]
                 )
         return True
 
+    def _get_inconsistent_shards(self, dataset: dict) -> list[str]:
+        return find_inconsistent_shards(
+            dataset.get("data_paths", []), self._run_context().probe_workers
+        )
+
+    def _formattable_datasets(self, ir: IR) -> tuple[list[dict], list[IR]]:
+        """Datasets of the IR in the format of this action, and a patch for
+        each dataset the user has to fix. Datasets whose first data path could
+        not be probed or whose shards disagree on format are left untouched,
+        before training crashes on them mid-epoch."""
+        datasets = []
+        interventions = []
+        for dataset in ir.tuning_data_config["datasets"]:
+            name = dataset.get("name", "")
+            first_path = dataset["data_paths"][0]
+            result = self._probe([first_path])[first_path]
+            if result.error is not None:
+                issue = (
+                    f"Data path {first_path} of dataset {name} could not be read "
+                    f"({result.error}) and has to be fixed or removed."
+                )
+            elif not self._is_data_in_required_format(first_path):
+                continue
+            elif inconsistent_shards := self._get_inconsistent_shards(dataset):
+                issue = (
+                    f"Data paths {inconsistent_shards} of dataset {name} do not "
+                    "match the format of its first data path and have to be "
+                    "fixed or removed."
+                )
+            else:
+                datasets.append(dataset)
+                continue
+            interventions.append(
+                IR(
+                    type=PatchType.COMPATIBILITY,
+                    level=PatchLevel.USER_INTERVENTION,
+                    comment=Comment(issue),
+                )
+            )
+        return datasets, interventions
+
+    def _record_patches(self, ir: IR, interventions: list[IR]):
+        """Record the patches of the datasets to be fixed by the user apart
+        from the formatting patch, whose level they leave as is. Only the
+        returned patch makes it to the output, so their notes are added to
+        its comment."""
+        for intervention in interventions:
+            ir.comment.add(str(intervention.comment))
+        self.json_merge_patches.extend(interventions)
+        self.json_merge_patches.append(ir)
+
     def _are_all_datapaths_in_format(self, data_paths):
         return not any(
             [not self._is_data_in_required_format(path) for path in data_paths]
         )
 
 
+class ApplyMaxSeqLength(Action):
+    """Recommend max_seq_length from token lengths of a data sample rather
+    than a fixed default, trading padding against truncation."""
+
+    reads = (
+        "tuning_config.model_name_or_path",
+        "tuning_config.max_seq_length",
+        "tuning_config.training_data_path",
+        "tuning_data_config.datasets",
+    )
+    writes = ("tuning_config.max_seq_length",)
+
+    def warm(self):
+        warm_tokenizer_backend()
+
+    def heuristic_skip(self, ir):
+        return not get_data_paths(ir)
+
+    def _recommend_max_seq_length(self, covered_length: int, model_max_length):
+        max_seq_length = (
+            math.ceil(covered_length / MAX_SEQ_LENGTH_MULTIPLE)
+            * MAX_SEQ_LENGTH_MULTIPLE
+        )
+        max_seq_length = max(max_seq_length, MAX_SEQ_LENGTH_MULTIPLE)
+        if model_max_length:
+            max_seq_length = min(max_seq_length, int(model_max_length))
+        return max_seq_length
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.heuristic_skip(ir) or self.skip:
+            self.skip = True
+            return
+        model_name_or_path = ir.tuning_config["model_name_or_path"]
+        stats = get_token_length_stats(get_data_paths(ir), model_name_or_path)
+        if stats is None:
+            self.skip = True
+            return
+
+        covered_length = stats.percentile(MAX_SEQ_LENGTH_PERCENTILE)
+        max_seq_length = self._recommend_max_seq_length(
+            covered_length,
+            get_model_config(model_name_or_path).get("max_position_embeddings"),
+        )
+        user_max_seq_length = ir.tuning_config.get("max_seq_length", None)
+        if user_max_seq_length:
+            user_max_seq_length = int(user_max_seq_length)
+            user_truncation_rate = stats.truncation_rate(user_max_seq_length)
+            oversized = (
+                user_max_seq_length >= max_seq_length * MAX_SEQ_LENGTH_OVERSIZE_FACTOR
+            )
+            # a user value truncating few samples is kept unless it is oversized
+            if user_truncation_rate <= MAX_TRUNCATION_RATE and not oversized:
+                self.skip = True
+                return
+
+        truncation_rate = stats.truncation_rate(max_seq_length)
+        comment = Comment(
+            f"max_seq_length is set from {stats.num_samples} sampled records with "
+            f"p50/p95/p99/max token lengths of {stats.percentile(50)}/"
+            f"{stats.percentile(95)}/{covered_length}/{stats.percentile(100)}."
+        )
+        if user_max_seq_length:
+            comment.add(
+                f"max_seq_length of {user_max_seq_length} truncates "
+                f"{user_truncation_rate:.1%} of the samples."
+            )
+            if oversized:
+                comment.add(
+                    f"It is {user_max_seq_length / max_seq_length:.1f}x the "
+                    f"recommended {max_seq_length}, batches sized and padded for it "
+                    "spend memory and compute on padding tokens."
+                )
+        level = PatchLevel.SUGGESTION
+        if truncation_rate > MAX_TRUNCATION_RATE:
+            level = PatchLevel.USER_INTERVENTION
+            comment.add(
+                f"{truncation_rate:.1%} of the samples are longer than the model "
+                "supports and will be truncated, consider filtering or splitting them."
+            )
+        return_ir = IR(
+            tuning_config={"max_seq_length": max_seq_length},
+            type=PatchType.SYSTEM_PERFORMANCE,
+            effect=[PatchType.SYSTEM_PERFORMANCE, PatchType.MODEL_QUALITY],
+            level=level,
+            comment=comment,
+        )
+        self.json_merge_patches.append(return_ir)
+        self.skip = True
+        return return_ir
+
+
 class ApplyQAFormat(ApplyDataFormat):
     def _is_data_in_required_format(self, dataset_path: str) -> bool:
-        data = load_training_data(dataset_path)
-        if isinstance(data, list) and len(data) > 0:
-            data = data[0]
-        COMMON_INPUT_KEYS = [
-            "input",
-            "instruction",
-            "prompt",
-            "question",
-            "tweet_text",
-            "query",
-            "source",
-            "tweet text",
-        ]
-        COMMON_RESPONSE_KEYS = [
-            "output",
-            "response",
-            "answer",
-            "label",
-            "text_label",
-            "target",
-            "completion",
-        ]
-
-        if has_any_key_containing(data, COMMON_INPUT_KEYS) and has_any_key_containing(
-            data, COMMON_RESPONSE_KEYS
-        ):
-            return True
-        return False
-
-    def _is_dataset_in_required_format(self, dataset: dict) -> bool:
-        # TODO: This can turn out to be an time-intensive operation
-        # we should think if we want to do this.
-        # ideally should iterate over each datapath using _is_data_in_required_format
-        return True
+        return get_dataset_profile(dataset_path).is_qa
 
     def _get_values_for_given_datapath(self, dataset_path: str):
         # TODO: Actions should made aware of the existing user changes
@@ -147,9 +320,8 @@ class ApplyQAFormat(ApplyDataFormat):
                 }
             ]
 
-        for dataset in ir.tuning_data_config["datasets"]:
-            if not self._is_data_in_required_format(dataset["data_paths"][0]):
-                continue
+        datasets, interventions = self._formattable_datasets(ir)
+        for dataset in datasets:
             values_to_set = self._get_values_for_given_dataset(dataset)
             ir.tuning_config.update(
                 {
@@ -163,36 +335,16 @@ class ApplyQAFormat(ApplyDataFormat):
         )
         ir.type = PatchType.COMPATIBILITY
         ir.level = PatchLevel.MANDATORY
-        self.json_merge_patches.append(ir)
+        self._record_patches(ir, interventions)
         self.skip = True
         return ir
 
 
 class ApplyChatFormat(ApplyDataFormat):
-    CHAT_STYLE_KEYS = ["messages", "conversations", "dialogues", "chat", "turns"]
+    CHAT_STYLE_KEYS = CHAT_STYLE_KEYS
 
     def _is_data_in_required_format(self, dataset_path: str) -> bool:
-        data = load_training_data(dataset_path)
-        columns = data[0].keys()
-        if isinstance(data, list) and len(data) > 0:
-            data = data[0]
-        if has_any_key_containing(data, self.CHAT_STYLE_KEYS):
-            for chat_key in self.CHAT_STYLE_KEYS:
-                if chat_key in columns:
-                    val = data[chat_key]
-                    if isinstance(val, list):
-                        if all(
-                            isinstance(m, dict) and "role" in m and "content" in m
-                            for m in val
-                        ):
-                            return True
-        return False
-
-    def _is_dataset_in_required_format(self, dataset: dict) -> bool:
-        # TODO: This can turn out to be an time-intensive operation
-        # we should think if we want to do this.
-        # ideally should iterate over each datapath using _is_data_in_required_format
-        return True
+        return get_dataset_profile(dataset_path).is_chat
 
     def _get_values_for_given_datapath(
         self, dataset_path: str, model_name_or_path: str, max_seq_length: int
@@ -205,12 +357,7 @@ class ApplyChatFormat(ApplyDataFormat):
         if chat_template:
             chat_template = escape_newlines_in_strings(chat_template)
             chat_template = "{% raw %}\n  " + chat_template + "\n  {% endraw %}"
-        data = load_training_data(dataset_path)
-        columns = data[0].keys()
-        for chat_key in self.CHAT_STYLE_KEYS:
-            if chat_key in columns:
-                conversation_column_name = chat_key
-                break
+        conversation_column_name = get_dataset_profile(dataset_path).chat_column
 
         return {
             "chat_template": chat_template,
@@ -256,9 +403,8 @@ class ApplyChatFormat(ApplyDataFormat):
                     "data_handlers": {},
                 }
             ]
-        for dataset in ir.tuning_data_config["datasets"]:
-            if not self._is_data_in_required_format(dataset["data_paths"][0]):
-                continue
+        datasets, interventions = self._formattable_datasets(ir)
+        for dataset in datasets:
             values_to_set = self._get_values_for_given_dataset(
                 dataset,
                 ir.tuning_config["model_name_or_path"],
@@ -274,6 +420,6 @@ class ApplyChatFormat(ApplyDataFormat):
         )
         ir.type = PatchType.COMPATIBILITY
         ir.level = PatchLevel.MANDATORY
-        self.json_merge_patches.append(ir)
+        self._record_patches(ir, interventions)
         self.skip = True
         return ir
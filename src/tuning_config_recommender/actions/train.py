@@ -4,16 +4,36 @@ from tuning_config_recommender.constants import (
     DEFAULT_NUM_GPUS_PER_NODE,
     DEFAULT_NUM_NODES,
 )
+from tuning_config_recommender.utils.dataset_profile import (
+    DatasetFormat,
+    get_dataset_profile,
+)
+from tuning_config_recommender.utils.token_stats import (
+    PaddingStrategy,
+    choose_padding_strategy,
+    estimate_padding_waste,
+    get_token_length_stats,
+    warm_tokenizer_backend,
+)
 from tuning_config_recommender.utils.tuning_config import (
     get_model_config,
     is_model_type_moe,
+    load_tuning_run_index,
     use_kb_for_batch_size,
 )
 
-from .actions import IR, Action, Comment, PatchLevel, PatchType
+from .actions import IR, REMOVE, Action, Comment, PatchLevel, PatchType
+from .data import get_data_paths
 
 
 class ApplyDistributedTraining(Action):
+    reads = (
+        "compute_config.num_nodes",
+        "compute_config.num_gpus_per_node",
+        "tuning_config.model_name_or_path",
+    )
+    writes = ("accelerate_config",)
+
     def apply(self, ir: IR, actions_meta: list[str]) -> IR:
         if self.heuristic_skip(ir) or self.skip:
             self.skip = True
@@ -75,6 +95,12 @@ class ApplyDistributedTraining(Action):
 
 
 class ApplyGradientCheckpointing(Action):
+    reads = ("tuning_config.tuning_strategy",)
+    writes = (
+        "tuning_config.gradient_checkpointing",
+        "tuning_config.gradient_checkpointing_kwargs",
+    )
+
     def apply(self, ir: IR, actions_meta: list[str]) -> IR:
         if self.heuristic_skip(ir) or self.skip:
             self.skip = True
@@ -104,6 +130,16 @@ class ApplyGradientCheckpointing(Action):
 
 
 class ApplyLoRAConfig(Action):
+    reads = ("tuning_config.tuning_strategy", "tuning_config.peft_method")
+    writes = (
+        "tuning_config.peft_method",
+        "tuning_config.lora_alpha",
+        "tuning_config.lora_dropout",
+        "tuning_config.r",
+        "tuning_config.target_modules",
+        "tuning_config.modules_to_save",
+    )
+
     def heuristic_skip(self, ir):
         if (
             ir.tuning_config.get("tuning_strategy") == "lora"
@@ -140,6 +176,13 @@ class ApplyLoRAConfig(Action):
 
 
 class ApplyMoEOptimization(Action):
+    reads = (
+        "tuning_config.model_name_or_path",
+        "compute_config.num_nodes",
+        "compute_config.num_gpus_per_node",
+    )
+    writes = ("tuning_config.fast_moe",)
+
     def _get_num_experts(self, model_name_or_path: str) -> int:
         config = get_model_config(model_name_or_path)
         num_local_experts = config.get("num_local_experts", None)
@@ -177,6 +220,20 @@ class ApplyMoEOptimization(Action):
 
 
 class ApplyOptimalBatchSize(Action):
+    reads = (
+        "tuning_config.model_name_or_path",
+        "tuning_config.tuning_strategy",
+        "tuning_config.per_device_train_batch_size",
+        "tuning_config.max_seq_length",
+    )
+    writes = (
+        "tuning_config.per_device_train_batch_size",
+        "tuning_config.max_seq_length",
+    )
+
+    def warm(self):
+        load_tuning_run_index()
+
     def apply(self, ir: IR, actions_meta: list[str]) -> IR:
         if self.heuristic_skip(ir) or self.skip:
             self.skip = True
@@ -216,6 +273,8 @@ class ApplyOptimalBatchSize(Action):
 
 
 class ApplyFastKernelsOptimization(Action):
+    reads = ("tuning_config.model_name_or_path",)
+    writes = ("tuning_config.fast_kernels",)
     supported_model_archs = [
         "GraniteForCausalLM",
         "GraniteMoeForCausalLM",
@@ -253,6 +312,14 @@ class ApplyFastKernelsOptimization(Action):
 
 
 class ApplyTrainingOptimization(Action):
+    reads = ("tuning_config.use_flash_attn",)
+    writes = ("tuning_config.padding_free", "tuning_config.use_flash_attn")
+
+    def heuristic_skip(self, ir: IR) -> bool:
+        # keep flash attention off when the user turned it off
+        use_flash_attn = ir.tuning_config.get("use_flash_attn")
+        return use_flash_attn is not None and str(use_flash_attn).lower() != "true"
+
     def apply(self, ir: IR, actions_meta: list[str]) -> IR:
         if self.heuristic_skip(ir) or self.skip:
             self.skip = True
@@ -270,3 +337,99 @@ class ApplyTrainingOptimization(Action):
         self.json_merge_patches.append(return_ir)
         self.skip = True
         return return_ir
+
+
+class ApplyPackingOptimization(Action):
+    """Choose between padding, padding free and packing from the measured
+    token length distribution at the recommended max_seq_length."""
+
+    reads = (
+        "tuning_config.model_name_or_path",
+        "tuning_config.max_seq_length",
+        "tuning_config.per_device_train_batch_size",
+        "tuning_config.use_flash_attn",
+        "tuning_config.training_data_path",
+        "tuning_data_config.datasets",
+    )
+    writes = ("tuning_config.padding_free", "tuning_config.packing")
+    # packing is a string in the KB defaults
+    strategy_patches = {
+        PaddingStrategy.PADDING_FREE: {
+            "padding_free": "huggingface",
+            "packing": "False",
+        },
+        PaddingStrategy.PACKING: {"packing": "True", "padding_free": REMOVE},
+        PaddingStrategy.PADDING: {"packing": "False", "padding_free": REMOVE},
+    }
+
+    def warm(self):
+        warm_tokenizer_backend()
+
+    def heuristic_skip(self, ir):
+        return not get_data_paths(ir)
+
+    def _candidate_strategies(self, ir: IR) -> list[PaddingStrategy]:
+        strategies = list(PaddingStrategy)
+        # padding free relies on flash attention to attend within samples
+        # of the flattened batch only
+        if str(ir.tuning_config.get("use_flash_attn", False)).lower() != "true":
+            strategies.remove(PaddingStrategy.PADDING_FREE)
+        # chat and QA formatting train on responses only and that
+        # masking does not survive samples being packed together
+        if any(
+            get_dataset_profile(path).format in (DatasetFormat.CHAT, DatasetFormat.QA)
+            for path in get_data_paths(ir)
+        ):
+            strategies.remove(PaddingStrategy.PACKING)
+        return strategies
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.heuristic_skip(ir) or self.skip:
+            self.skip = True
+            return
+        strategies = self._candidate_strategies(ir)
+        # there is nothing to choose with plain padding left only
+        if strategies == [PaddingStrategy.PADDING]:
+            self.skip = True
+            return
+        stats = get_token_length_stats(
+            get_data_paths(ir), ir.tuning_config["model_name_or_path"]
+        )
+        if stats is None:
+            self.skip = True
+            return
+        estimates = estimate_padding_waste(
+            stats.lengths,
+            max_seq_length=int(ir.tuning_config.get("max_seq_length", 4096)),
+            batch_size=int(ir.tuning_config.get("per_device_train_batch_size", 8)),
+            strategies=strategies,
+        )
+        if not estimates:
+            self.skip = True
+            return
+        best = choose_padding_strategy(estimates)
+        padding = estimates[PaddingStrategy.PADDING]
+        if best.strategy == PaddingStrategy.PADDING:
+            comment = Comment(
+                f"Padding every batch keeps an estimated "
+                f"{padding.useful_token_fraction:.1%} of computed tokens useful, "
+                "which packing does not improve on."
+            )
+        else:
+            comment = Comment(
+                f"{best.strategy} keeps an estimated {best.useful_token_fraction:.1%} "
+                f"of computed tokens useful against {padding.useful_token_fraction:.1%} "
+                "when padding every batch, an estimated throughput gain of "
+                f"{best.useful_token_fraction / padding.useful_token_fraction:.2f}x."
+            )
+        if PaddingStrategy.PADDING_FREE not in estimates:
+            comment.add("padding_free is not considered as use_flash_attn is off.")
+        return_ir = IR(
+            tuning_config=dict(self.strategy_patches[best.strategy]),
+            type=PatchType.SYSTEM_PERFORMANCE,
+            level=PatchLevel.SUGGESTION,
+            comment=comment,
+        )
+        self.json_merge_patches.append(return_ir)
+        self.skip = True
+        return return_ir
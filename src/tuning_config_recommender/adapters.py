@@ -1,17 +1,51 @@
 import json
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import ContextVar, copy_context
 from copy import deepcopy
 from pathlib import Path
 
 from loguru import logger
 
-from tuning_config_recommender.actions import IR
-from tuning_config_recommender.rule_engine import RuleEngine
+from tuning_config_recommender.actions import ACTIONS, IR
+from tuning_config_recommender.constants import (
+    DEFAULT_BATCH_WORKERS,
+    DEFAULT_PROBE_WORKERS,
+)
+from tuning_config_recommender.rule_engine import (
+    BatchResult,
+    RuleEngine,
+    get_engine_plan,
+)
 from tuning_config_recommender.utils.adapter_utils import (
     build_launch_command,
     prepare_ir_for_accelerate,
     write_yaml_preserving_templates,
 )
-from tuning_config_recommender.utils.data_processing import get_model_path
+from tuning_config_recommender.utils.data_config import fetch_chat_template
+from tuning_config_recommender.utils.data_processing import (
+    get_model_path,
+    resolve_data_path_glob,
+)
+from tuning_config_recommender.utils.dataset_profile import probe_dataset_paths
+from tuning_config_recommender.utils.kb_table import (
+    get_kb_snapshot,
+    load_kb,
+    pin_kb_snapshot,
+)
+from tuning_config_recommender.utils.profiling import profile_span
+from tuning_config_recommender.utils.recommendation_cache import (
+    RecommendationCache,
+    recommendation_key,
+)
+from tuning_config_recommender.utils.token_stats import get_token_length_stats
+from tuning_config_recommender.utils.tuning_config import get_model_config
+
+# local model paths fetched once for all items of a batch group, keyed by
+# model_name_or_path
+_BATCH_MODEL_PATHS: ContextVar[dict | None] = ContextVar(
+    "batch_model_paths", default=None
+)
 
 
 class Adapter:
@@ -20,6 +54,8 @@ class Adapter:
 
 
 class VanillaAdapter(Adapter):
+    # a run uses one KB snapshot even when the KB is reloaded meanwhile
+    @pin_kb_snapshot()
     def execute(
         self,
         tuning_config,
@@ -30,18 +66,39 @@ class VanillaAdapter(Adapter):
         skip_estimator=None,
     ):
         try:
-            re = RuleEngine()
-            re.register_all_inbuilt_actions()
+            action_classes = list(ACTIONS)
             if hasattr(self, "additional_actions") and self.additional_actions:
                 logger.info("Registering additional actions")
-                for _, action_cls in self.additional_actions.items():
-                    re.register_action(action_cls())
-            if skip_estimator:
-                re.add_to_actions_meta("skip_estimator")
-            model_name_or_path = tuning_config["model_name_or_path"]
-            local_model_name_or_path = get_model_path(
-                model_name_or_path, unique_tag=unique_tag
+                action_classes.extend(self.additional_actions.values())
+            # actions are instantiated, validated and warmed up once per
+            # action set and shared by all requests
+            re = RuleEngine.from_plan(
+                get_engine_plan(action_classes),
+                parallel=getattr(self, "parallel_actions", False),
+                probe_workers=getattr(self, "probe_workers", DEFAULT_PROBE_WORKERS),
             )
+            actions_meta = ["skip_estimator"] if skip_estimator else []
+            model_name_or_path = tuning_config["model_name_or_path"]
+            cache: RecommendationCache | None = getattr(self, "cache", None)
+            if cache is not None:
+                cache_key = self._recommendation_key(
+                    re,
+                    tuning_config,
+                    compute_config,
+                    accelerate_config,
+                    data_config,
+                    unique_tag,
+                    actions_meta,
+                )
+                with profile_span("cache_lookup", "adapter"):
+                    cached = cache.get(cache_key)
+                if cached is not None:
+                    logger.info(f"Using cached recommendation {cache_key}")
+                    return cached
+            with profile_span("model_download", "adapter"):
+                local_model_name_or_path = (_BATCH_MODEL_PATHS.get() or {}).get(
+                    model_name_or_path
+                ) or get_model_path(model_name_or_path, unique_tag=unique_tag)
             tuning_config["model_name_or_path"] = local_model_name_or_path
             tuning_config["original_model_name_or_path"] = model_name_or_path
             if "tuning_strategy" not in tuning_config:
@@ -55,17 +112,163 @@ class VanillaAdapter(Adapter):
                 accelerate_config=accelerate_config,
                 tuning_data_config=data_config,
             )
-            ir_to_apply, json_patches = re.apply(ir=deepcopy(ir))
+            with profile_span("rule_engine", "adapter"):
+                ir_to_apply, json_patches = re.apply(
+                    ir=deepcopy(ir), actions_meta=actions_meta
+                )
             ir_to_apply.tuning_config.pop("tuning_strategy")
+            if cache is not None:
+                cache.put(cache_key, (ir_to_apply, json_patches))
             return ir_to_apply, json_patches
         except Exception as e:
             logger.error(f"Error in VanillaAdapter.execute: {str(e)}")
             raise Exception(f"Failed to execute VanillaAdapter: {str(e)}") from e
 
+    def execute_many(
+        self, inputs: list[dict], max_workers: int = DEFAULT_BATCH_WORKERS
+    ) -> Iterator[BatchResult]:
+        """Run execute for every item of inputs, each a dict of execute
+        keyword arguments. Items of the same model and datasets form a group
+        whose model files, chat template, KB and dataset profiles are loaded
+        once before its items run on the worker pool. Results are yielded as
+        items complete, an item failing does not affect the others."""
+        groups: dict[tuple, list[int]] = {}
+        for index, item in enumerate(inputs):
+            try:
+                groups.setdefault(self._batch_group_key(item), []).append(index)
+            except Exception as e:
+                logger.error(f"Batch item {index} failed: {str(e)}")
+                yield BatchResult(index, error=e)
+        logger.info(f"Running {len(inputs)} items in {len(groups)} groups")
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            prefetches = {
+                executor.submit(
+                    copy_context().run, self._prefetch_batch_group, inputs[indices[0]]
+                ): indices
+                for indices in groups.values()
+            }
+            items = {}
+            while prefetches or items:
+                done, _ = wait([*prefetches, *items], return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in items:
+                        yield BatchResult.from_future(items.pop(future), future)
+                        continue
+                    model_paths = future.result()
+                    for index in prefetches.pop(future):
+                        item_future = executor.submit(
+                            copy_context().run,
+                            self._execute_batch_item,
+                            inputs[index],
+                            model_paths,
+                        )
+                        items[item_future] = index
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _batch_data_paths(self, item: dict) -> list[str]:
+        return self._input_data_paths(item["tuning_config"], item.get("data_config"))
+
+    def _batch_group_key(self, item: dict) -> tuple:
+        # the unique_tag only names the outputs of an item, items of other
+        # tags share the prefetched model files
+        return (
+            item["tuning_config"]["model_name_or_path"],
+            tuple(sorted(self._batch_data_paths(item))),
+        )
+
+    def _prefetch_batch_group(self, item: dict) -> dict:
+        """Load what the items of a group share ahead of their runs. Failures
+        are only logged, items load what is missing and report errors."""
+        model_name_or_path = item["tuning_config"].get("model_name_or_path")
+        unique_tag = item.get("unique_tag")
+        model_paths = {}
+        try:
+            with profile_span("prefetch_batch_group", "adapter"):
+                local_model_name_or_path = get_model_path(
+                    model_name_or_path, unique_tag=unique_tag
+                )
+                model_paths[model_name_or_path] = local_model_name_or_path
+                get_model_config(local_model_name_or_path)
+                fetch_chat_template(local_model_name_or_path)
+                load_kb()
+                data_paths = [
+                    p
+                    for path in self._batch_data_paths(item)
+                    for p in resolve_data_path_glob(path)
+                ]
+                probe_dataset_paths(
+                    data_paths, getattr(self, "probe_workers", DEFAULT_PROBE_WORKERS)
+                )
+                get_token_length_stats(data_paths, local_model_name_or_path)
+        except Exception as e:
+            logger.warning(f"Could not prefetch batch group {model_name_or_path}: {e}")
+        return model_paths
+
+    def _execute_batch_item(self, item: dict, model_paths: dict):
+        token = _BATCH_MODEL_PATHS.set(model_paths)
+        try:
+            # execute fills in the configs it is given
+            return self.execute(**deepcopy(item))
+        finally:
+            _BATCH_MODEL_PATHS.reset(token)
+
+    @staticmethod
+    def _input_data_paths(tuning_config, data_config) -> list[str]:
+        data_paths = [
+            path
+            for dataset in (data_config or {}).get("datasets", [])
+            for path in dataset.get("data_paths", [])
+        ]
+        if tuning_config.get("training_data_path"):
+            data_paths.append(tuning_config["training_data_path"])
+        return data_paths
+
+    def _recommendation_key(
+        self,
+        re: RuleEngine,
+        tuning_config,
+        compute_config,
+        accelerate_config,
+        data_config,
+        unique_tag,
+        actions_meta,
+    ):
+        data_paths = self._input_data_paths(tuning_config, data_config)
+        return recommendation_key(
+            {
+                "adapter": type(self).__name__,
+                "tuning_config": tuning_config,
+                "compute_config": compute_config,
+                "accelerate_config": accelerate_config,
+                "data_config": data_config,
+                # local model copies are stored per tag
+                "unique_tag": unique_tag,
+                "actions_meta": [*re.actions_meta, *actions_meta],
+            },
+            [type(action) for action in re.actions],
+            data_paths,
+            tuning_config["model_name_or_path"],
+            kb_version=get_kb_snapshot().version,
+        )
+
 
 class FMSAdapter(VanillaAdapter):
-    def __init__(self, base_dir: str | Path = "out/fms_final", additional_actions=None):
+    def __init__(
+        self,
+        base_dir: str | Path = "out/fms_final",
+        additional_actions=None,
+        parallel_actions: bool = False,
+        cache: RecommendationCache | None = None,
+        probe_workers: int = DEFAULT_PROBE_WORKERS,
+    ):
         self.base_dir = Path(base_dir)
+        self.parallel_actions = parallel_actions
+        # number of data paths probed concurrently
+        self.probe_workers = probe_workers
+        # reuse recommendations for identical inputs, off unless given
+        self.cache = cache
         if not additional_actions:
             additional_actions = []
         self.additional_actions = additional_actions
@@ -87,13 +290,33 @@ class FMSAdapter(VanillaAdapter):
             ],
         }
 
-    def _resolve_data_paths_in_data_config(self, data_config):
-        import glob
+    @staticmethod
+    def _data_paths_from_paths(paths) -> list[str]:
+        # "paths" = {
+        #     "chat_data": "",
+        #     "qa_data": "",
+        # }
+        data_paths = []
+        for _, path in (paths or {}).items():
+            if "_data" in path:
+                data_paths.append(path)
+        return data_paths
+
+    def _batch_data_paths(self, item: dict) -> list[str]:
+        tuning_config = item["tuning_config"]
+        if not item.get("data_config") and not tuning_config.get(
+            "training_data_path", None
+        ):
+            return self._data_paths_from_paths(item.get("paths"))
+        return super()._batch_data_paths(item)
 
+    def _resolve_data_paths_in_data_config(self, data_config):
         try:
             for dataset in data_config.get("datasets", []):
                 dataset["data_paths"] = [
-                    p for path in dataset.get("data_paths", []) for p in glob.glob(path)
+                    p
+                    for path in dataset.get("data_paths", [])
+                    for p in resolve_data_path_glob(path)
                 ]
             return data_config
         except FileNotFoundError as e:
@@ -103,6 +326,7 @@ class FMSAdapter(VanillaAdapter):
             logger.error(f"Error resolving data paths in data config: {str(e)}")
             raise Exception(f"Failed to resolve data paths: {str(e)}") from e
 
+    @pin_kb_snapshot()
     def execute(
         self,
         tuning_config,
@@ -116,16 +340,11 @@ class FMSAdapter(VanillaAdapter):
     ):
         try:
             if not data_config and not tuning_config.get("training_data_path", None):
-                # "paths" = {
-                #     "chat_data": "",
-                #     "qa_data": "",
-                # }
-                data_paths = []
-                for _, path in paths.items():
-                    if "_data" in path:
-                        data_paths.append(path)
-                data_config = self._populate_data_config(data_paths)
-            data_config = self._resolve_data_paths_in_data_config(data_config)
+                data_config = self._populate_data_config(
+                    self._data_paths_from_paths(paths)
+                )
+            with profile_span("resolve_data_paths", "adapter"):
+                data_config = self._resolve_data_paths_in_data_config(data_config)
             ir, patches = super().execute(
                 tuning_config,
                 compute_config,
@@ -135,37 +354,38 @@ class FMSAdapter(VanillaAdapter):
                 skip_estimator,
             )
 
-            ir = ir.to_dict()
-            target_dir = (self.base_dir / unique_tag).resolve()
-            target_dir.mkdir(parents=True, exist_ok=True)
+            with profile_span("write_outputs", "adapter"):
+                ir = ir.to_dict()
+                target_dir = (self.base_dir / unique_tag).resolve()
+                target_dir.mkdir(parents=True, exist_ok=True)
 
-            orig = ir["tuning_config"].pop("original_model_name_or_path", None)
-            if orig:
-                ir["tuning_config"]["model_name_or_path"] = orig
+                orig = ir["tuning_config"].pop("original_model_name_or_path", None)
+                if orig:
+                    ir["tuning_config"]["model_name_or_path"] = orig
 
-            ir_clean, dynamic_args = prepare_ir_for_accelerate(ir)
-            data_path = target_dir / "tuning_data_config.yaml"
-            write_yaml_preserving_templates(
-                ir_clean.get("tuning_data_config", {}), data_path
-            )
+                ir_clean, dynamic_args = prepare_ir_for_accelerate(ir)
+                data_path = target_dir / "tuning_data_config.yaml"
+                write_yaml_preserving_templates(
+                    ir_clean.get("tuning_data_config", {}), data_path
+                )
 
-            accel_path = target_dir / "accelerate_config.yaml"
-            write_yaml_preserving_templates(
-                ir_clean.get("accelerate_config", {}), accel_path
-            )
+                accel_path = target_dir / "accelerate_config.yaml"
+                write_yaml_preserving_templates(
+                    ir_clean.get("accelerate_config", {}), accel_path
+                )
 
-            tuning_config_path = target_dir / "tuning_config.yaml"
-            compute_config_path = target_dir / "compute_config.yaml"
-            write_yaml_preserving_templates(
-                ir_clean.get("tuning_config", {}), tuning_config_path
-            )
-            write_yaml_preserving_templates(
-                ir_clean.get("compute_config", {}), compute_config_path
-            )
-            launch_cmd = build_launch_command(
-                ir_clean, data_path, accel_path, dynamic_args,
-                fsdp_args_format=fsdp_args_format,
-            )
+                tuning_config_path = target_dir / "tuning_config.yaml"
+                compute_config_path = target_dir / "compute_config.yaml"
+                write_yaml_preserving_templates(
+                    ir_clean.get("tuning_config", {}), tuning_config_path
+                )
+                write_yaml_preserving_templates(
+                    ir_clean.get("compute_config", {}), compute_config_path
+                )
+                launch_cmd = build_launch_command(
+                    ir_clean, data_path, accel_path, dynamic_args,
+                    fsdp_args_format=fsdp_args_format,
+                )
             serializable_patches = []
             for patch in patches:
                 serializable_patches.append(
@@ -198,6 +418,7 @@ class FMSAdapter(VanillaAdapter):
                         },
                         "patches": patches,
                         "serializable_patches": serializable_patches,
+                        "kb_version": get_kb_snapshot().version,
                     },
                     default=str,
                 )
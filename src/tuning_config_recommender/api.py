@@ -1,6 +1,7 @@
 import asyncio
 import os
 import uuid
+from contextlib import asynccontextmanager, nullcontext
 from datetime import UTC, datetime, timezone
 from pathlib import Path
 from typing import Optional
@@ -14,8 +15,24 @@ from loguru import logger
 from pydantic import BaseModel
 
 from tuning_config_recommender.adapters import FMSAdapter
+from tuning_config_recommender.rule_engine import get_engine_plan
+from tuning_config_recommender.utils.kb_table import KBWatcher, reload_kb
+from tuning_config_recommender.utils.profiling import Profiler
 
-app = FastAPI(title="Recommender API")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # build and warm up the plan of the inbuilt actions before the first
+    # request, every request then reuses it
+    get_engine_plan()
+    # swap in KB updates without restarting workers, requests in flight keep
+    # the snapshot they started with
+    watcher = KBWatcher().start()
+    yield
+    watcher.stop()
+
+
+app = FastAPI(title="Recommender API", lifespan=lifespan)
 
 
 app.add_middleware(
@@ -43,6 +60,8 @@ class RecommendationsRequest(BaseModel):
     compute_config: dict | None = None
     accelerate_config: dict | None = None
     skip_estimator: bool | None = False
+    # adds per phase and per action timings and a Chrome trace to the response
+    profile: bool | None = False
 
 
 def generate_unique_stamps():
@@ -51,6 +70,20 @@ def generate_unique_stamps():
     return f"{timestamp}_{random_id}"
 
 
+@app.post("/admin/reload-kb")
+def reload_knowledge_base():
+    """Reload the KB files now instead of waiting for the watcher"""
+    try:
+        snapshot = reload_kb(force=True)
+        return {"kb_version": snapshot.version}
+    except Exception as e:
+        logger.error(f"Failed to reload KB: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content=jsonable_encoder({"message": f"Failed to reload KB: {str(e)}"}),
+        )
+
+
 @app.post("/recommend")
 async def recommend(
     background_tasks: BackgroundTasks,
@@ -92,16 +125,24 @@ async def recommend(
 
         fms_adapter = FMSAdapter(base_dir=output_dir, additional_actions=[])
 
-        response = fms_adapter.execute(
-            tuning_config=req.tuning_config,
-            compute_config=req.compute_config,
-            accelerate_config=req.accelerate_config,
-            data_config=req.tuning_data_config,
-            unique_tag="",
-            paths={},
-            skip_estimator=req.skip_estimator,
-        )
+        # tracing memory would slow down every request served meanwhile
+        profiler = Profiler(trace_memory=False) if req.profile else nullcontext()
+        with profiler:
+            response = fms_adapter.execute(
+                tuning_config=req.tuning_config,
+                compute_config=req.compute_config,
+                accelerate_config=req.accelerate_config,
+                data_config=req.tuning_data_config,
+                unique_tag="",
+                paths={},
+                skip_estimator=req.skip_estimator,
+            )
         response.pop("patches")
+        if req.profile:
+            response["profile"] = {
+                "summary": profiler.summary_rows(),
+                "trace": profiler.chrome_trace(),
+            }
         for _, path in response["paths"].items():
             paths_to_delete.append(path)
 
@@ -1,8 +1,10 @@
 import argparse
 import importlib
 import json
+import os
 import pkgutil
 import sys
+from contextlib import nullcontext
 from pathlib import Path
 
 import yaml
@@ -10,6 +12,15 @@ from loguru import logger
 
 from tuning_config_recommender.actions import Action
 from tuning_config_recommender.adapters import FMSAdapter
+from tuning_config_recommender.constants import (
+    COMPILED_KB_ENV_VAR,
+    DEFAULT_PROBE_WORKERS,
+    RUN_HISTORY_DIR_ENV_VAR,
+)
+from tuning_config_recommender.utils.kb_table import compile_kb
+from tuning_config_recommender.utils.profiling import Profiler
+from tuning_config_recommender.utils.recommendation_cache import RecommendationCache
+from tuning_config_recommender.utils.run_history import ingest_runs, run_history_dir
 
 
 def load_actions_from_folder(folder_path):
@@ -35,6 +46,40 @@ def load_actions_from_folder(folder_path):
     return classes
 
 
+def run_batch(fms_adapter: FMSAdapter, batch_file: str, skip_estimator: bool):
+    """Recommend for every item of a YAML or JSON list of inline configs and
+    print one JSON line per item as it completes"""
+    with open(batch_file) as f:
+        items = yaml.safe_load(f)
+    inputs = [
+        {
+            "tuning_config": item.get("tuning_config"),
+            "compute_config": item.get("compute_config", {}),
+            "accelerate_config": item.get("accelerate_config", {}),
+            "data_config": item.get("tuning_data_config", {}),
+            # outputs of each item go to their own folder
+            "unique_tag": str(item.get("unique_tag", index)),
+            "paths": {},
+            "skip_estimator": skip_estimator,
+        }
+        for index, item in enumerate(items)
+    ]
+    failed = 0
+    for batch_result in fms_adapter.execute_many(inputs):
+        line = {
+            "index": batch_result.index,
+            "unique_tag": inputs[batch_result.index]["unique_tag"],
+        }
+        if batch_result.ok:
+            line["paths"] = batch_result.result["paths"]
+            line["patches"] = batch_result.result["serializable_patches"]
+        else:
+            failed += 1
+            line["error"] = str(batch_result.error)
+        print(json.dumps(line, default=str), flush=True)
+    return failed
+
+
 def main():
     parser = argparse.ArgumentParser(description="Recommender CLI interface")
     parser.add_argument(
@@ -76,21 +121,121 @@ def main():
         default=False,
         help="Path to compute config",
     )
+    parser.add_argument(
+        "--parallel-actions",
+        action="store_true",
+        help="Evaluate independent actions concurrently",
+    )
+    parser.add_argument(
+        "--probe-workers",
+        required=False,
+        type=int,
+        default=DEFAULT_PROBE_WORKERS,
+        help="Number of data paths probed concurrently",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        required=False,
+        type=str,
+        default=None,
+        help="Folder to cache recommendations in and reuse them from",
+    )
+    parser.add_argument(
+        "--profile-output",
+        required=False,
+        type=str,
+        default=None,
+        help="Path to write a Chrome trace of the run to, also prints a summary",
+    )
+    parser.add_argument(
+        "--batch-file",
+        required=False,
+        type=str,
+        default=None,
+        help="Path to a YAML or JSON list of inline configs to recommend for",
+    )
+    parser.add_argument(
+        "--compile-kb",
+        action="store_true",
+        help="Compile the knowledge base files for faster loading and exit",
+    )
+    parser.add_argument(
+        "--compiled-kb",
+        required=False,
+        type=str,
+        default=None,
+        help=(
+            "Path of the compiled knowledge base, written by --compile-kb and "
+            f"loaded at startup, defaults to ${COMPILED_KB_ENV_VAR} or the "
+            "knowledge base folder of the package"
+        ),
+    )
+    parser.add_argument(
+        "--ingest-runs",
+        required=False,
+        nargs="+",
+        default=None,
+        help="Output folders of finished tuning runs to add to the run history and exit",
+    )
+    parser.add_argument(
+        "--run-history-dir",
+        required=False,
+        type=str,
+        default=None,
+        help=(
+            "Folder of the run history store, ingested into and looked up, "
+            f"defaults to ${RUN_HISTORY_DIR_ENV_VAR} or the user cache dir"
+        ),
+    )
+    parser.add_argument(
+        "--gpu-hour-cost",
+        required=False,
+        type=float,
+        default=None,
+        help="Cost of one GPU hour to derive dollars per million tokens of runs",
+    )
     args = parser.parse_args()
+    if args.run_history_dir:
+        os.environ[RUN_HISTORY_DIR_ENV_VAR] = args.run_history_dir
+    if args.compiled_kb:
+        os.environ[COMPILED_KB_ENV_VAR] = args.compiled_kb
+    if args.ingest_runs:
+        ingested = ingest_runs(args.ingest_runs, gpu_hour_cost=args.gpu_hour_cost)
+        print(f"Added {ingested} runs to the run history at {run_history_dir()}")
+        return
+    if args.compile_kb:
+        print(f"Compiled knowledge base available at {compile_kb()}")
+        return
     additional_actions = load_actions_from_folder(args.rules_dir)
     fms_adapter = FMSAdapter(
-        base_dir=args.output_dir, additional_actions=additional_actions
+        base_dir=args.output_dir,
+        additional_actions=additional_actions,
+        parallel_actions=args.parallel_actions,
+        probe_workers=args.probe_workers,
+        cache=RecommendationCache(args.cache_dir) if args.cache_dir else None,
     )
 
-    result = fms_adapter.execute(
-        tuning_config=yaml.safe_load(open(args.tuning_config)),
-        compute_config=yaml.safe_load(open(args.compute_config)),
-        accelerate_config=yaml.safe_load(open(args.accelerate_config)),
-        data_config=yaml.safe_load(open(args.tuning_data_config)),
-        unique_tag="",
-        paths={},
-        skip_estimator=args.skip_estimator,
-    )
+    profiler = Profiler() if args.profile_output else nullcontext()
+    if args.batch_file:
+        with profiler:
+            failed = run_batch(fms_adapter, args.batch_file, args.skip_estimator)
+        if args.profile_output:
+            profiler.write_chrome_trace(args.profile_output)
+            print(profiler.summary())
+        sys.exit(1 if failed else 0)
+    with profiler:
+        result = fms_adapter.execute(
+            tuning_config=yaml.safe_load(open(args.tuning_config)),
+            compute_config=yaml.safe_load(open(args.compute_config)),
+            accelerate_config=yaml.safe_load(open(args.accelerate_config)),
+            data_config=yaml.safe_load(open(args.tuning_data_config)),
+            unique_tag="",
+            paths={},
+            skip_estimator=args.skip_estimator,
+        )
+    if args.profile_output:
+        profiler.write_chrome_trace(args.profile_output)
+        print(profiler.summary())
     print(result["patches"])
     json.dump(
         result["serializable_patches"],
@@ -1,2 +1,56 @@
 DEFAULT_NUM_NODES = 1
 DEFAULT_NUM_GPUS_PER_NODE = 1
+# number of records read when probing a dataset for its format
+DEFAULT_PROBE_NUM_SAMPLES = 16
+# number of dataset profiles kept in memory across rule engine runs
+DATASET_PROFILE_CACHE_SIZE = 256
+# upper bounds on a single dataset probe so it never pulls a full dataset
+DEFAULT_PROBE_MAX_SECONDS = 60
+DEFAULT_PROBE_MAX_BYTES = 64 * 1024 * 1024
+# parquet row groups a random probe sample is drawn from
+DEFAULT_PROBE_MAX_ROW_GROUPS = 4
+# number of data paths probed concurrently
+DEFAULT_PROBE_WORKERS = 8
+# number of per-shard format consistency verdicts kept in memory
+SHARD_CONSISTENCY_CACHE_SIZE = 4096
+# number of records tokenized per data path for token length statistics
+DEFAULT_TOKEN_STATS_NUM_SAMPLES = 1024
+# number of texts sent to the tokenizer in one call
+TOKENIZER_BATCH_SIZE = 256
+# number of per (dataset, tokenizer) token length statistics kept in memory
+TOKEN_STATS_CACHE_SIZE = 256
+# sample percentile max_seq_length is chosen to cover, rounded up to a multiple
+MAX_SEQ_LENGTH_PERCENTILE = 99
+MAX_SEQ_LENGTH_MULTIPLE = 256
+# a user max_seq_length at least this many times the recommended one is
+# flagged as mostly padding even when it truncates few samples
+MAX_SEQ_LENGTH_OVERSIZE_FACTOR = 2
+# fraction of truncated samples above which max_seq_length is flagged
+MAX_TRUNCATION_RATE = 0.01
+# useful token fractions closer than this are treated as a tie between
+# padding strategies, the one keeping more tokens untruncated wins then
+PADDING_STRATEGY_TIE_TOLERANCE = 0.01
+# number of independent actions evaluated concurrently in parallel mode
+DEFAULT_ACTION_WORKERS = 8
+# number of engine plans, one per distinct action set, kept in memory
+ENGINE_PLAN_CACHE_SIZE = 16
+# number of (model, section) KB lookups memoized
+KB_QUERY_CACHE_SIZE = 4096
+# seconds between checks of the KB files for changes by the KB watcher
+KB_WATCH_INTERVAL = 5.0
+# number of parsed model files (config.json, tokenizer_config.json) kept in memory
+MODEL_FILE_CACHE_SIZE = 64
+# number of items of a batch run concurrently
+DEFAULT_BATCH_WORKERS = 8
+# number of recommendations kept in memory by a RecommendationCache
+RECOMMENDATION_CACHE_SIZE = 128
+# size the on disk recommendation cache is trimmed to, oldest entries first
+RECOMMENDATION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# env var overriding the folder the persisted caches are kept under
+CACHE_DIR_ENV_VAR = "TUNING_CONFIG_RECOMMENDER_CACHE_DIR"
+# env var overriding the folder of the run history store, which is also where
+# the batch size lookup reads the aggregates of the ingested runs from
+RUN_HISTORY_DIR_ENV_VAR = "TUNING_CONFIG_RECOMMENDER_RUN_HISTORY_DIR"
+# env var overriding the path of the compiled KB, which is in the package
+# folder otherwise
+COMPILED_KB_ENV_VAR = "TUNING_CONFIG_RECOMMENDER_COMPILED_KB"
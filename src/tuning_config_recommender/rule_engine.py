@@ -1,33 +1,182 @@
+import contextvars
 import os
+from collections.abc import Iterator
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from copy import deepcopy
+from dataclasses import dataclass
+from enum import StrEnum, auto
+from typing import Any
 
 from loguru import logger
 from tqdm import tqdm
 
-from tuning_config_recommender.actions import ACTIONS, IR, Action
-from tuning_config_recommender.utils import set_difference, set_issubset
+from tuning_config_recommender.actions import (
+    ACTIONS,
+    IR,
+    Action,
+    RunContext,
+    get_run_context,
+    reset_run_context,
+    set_run_context,
+)
+from tuning_config_recommender.constants import (
+    DEFAULT_ACTION_WORKERS,
+    DEFAULT_BATCH_WORKERS,
+    DEFAULT_PROBE_WORKERS,
+    ENGINE_PLAN_CACHE_SIZE,
+)
+from tuning_config_recommender.utils import LRUCache, PatchIndex
+from tuning_config_recommender.utils.profiling import profile_span
+
+VALIDATED_PATHS = (
+    "tuning_config.model_name_or_path",
+    "tuning_config.tuning_strategy",
+    "tuning_config.training_data_path",
+    "tuning_data_config.datasets",
+)
+
+
+class PatchMode(StrEnum):
+    """How JSON patches relative to the source IR are derived"""
+
+    # from the keys each merge patch changes
+    INCREMENTAL = auto()
+    # from a diff of the whole source IR against the patched IR
+    DIFF = auto()
+    # both, failing whenever they disagree
+    VERIFY = auto()
+
+
+@dataclass
+class BatchResult:
+    """Outcome of one item of a batch, identified by its index in the inputs"""
+
+    index: int
+    result: Any = None
+    error: Exception | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @classmethod
+    def from_future(cls, index: int, future: Future) -> "BatchResult":
+        """Result of a completed future, an exception it raised is kept as
+        the error of the item instead of being raised"""
+        try:
+            return cls(index, result=future.result())
+        except Exception as e:
+            logger.error(f"Batch item {index} failed: {str(e)}")
+            return cls(index, error=e)
+
+
+def paths_overlap(path: str, other: str) -> bool:
+    """Whether one IR path is equal to or nested in the other"""
+    return path == other or path.startswith(other + ".") or other.startswith(path + ".")
+
+
+def validate_action(action: Action):
+    expected_arg_count = 3
+    if action.apply.__code__.co_argcount != expected_arg_count:
+        raise ValueError(
+            f"action {action.__class__.__name__} should have {expected_arg_count}, but got {action.apply.__code__.co_argcount}"
+        )
+    logger.debug(f"action {action.__class__.__name__} is valid!")
+
+
+class EnginePlan:
+    """Actions of an action set instantiated, validated and warmed up once,
+    with their read and write paths and the dependencies between them worked
+    out ahead of any run. Plans hold no run state, engines built from one
+    with RuleEngine.from_plan can serve any number of requests."""
+
+    def __init__(self, action_classes: list[type[Action]]):
+        self.action_classes = tuple(action_classes)
+        self.actions: list[Action] = []
+        for action_cls in self.action_classes:
+            action = action_cls()
+            validate_action(action)
+            try:
+                action.warm()
+            except Exception as e:
+                # the action loads what it needs on first use instead
+                logger.warning(f"Could not warm up {action_cls.__name__}: {e}")
+            self.actions.append(action)
+        self.read_paths = {action: action.read_paths() for action in self.actions}
+        self.write_paths = {action: action.write_paths() for action in self.actions}
+        # actions which may read what each action writes
+        self.affects = {
+            action: frozenset(
+                other
+                for other in self.actions
+                if any(
+                    paths_overlap(write, read)
+                    for write in self.write_paths[action]
+                    for read in self.read_paths[other]
+                )
+            )
+            for action in self.actions
+        }
+        logger.debug(f"engine plan of {len(self.actions)} actions built")
+
+
+_PLAN_CACHE = LRUCache(maxsize=ENGINE_PLAN_CACHE_SIZE)
+
+
+def get_engine_plan(action_classes: list[type[Action]] | None = None) -> EnginePlan:
+    """Plan of the given action classes, the inbuilt actions by default,
+    built on first use and shared afterwards"""
+    key = tuple(ACTIONS if action_classes is None else action_classes)
+    plan = _PLAN_CACHE.get(key)
+    if plan is None:
+        plan = EnginePlan(list(key))
+        _PLAN_CACHE.put(key, plan)
+    return plan
+
+
+def clear_engine_plan_cache():
+    _PLAN_CACHE.clear()
 
 
 class RuleEngine:
-    actions: list[Action] = []
-    ir_pipeline: list[IR] = []
-    # NOTE: In future we may make this meta specific to each action
-    # for now meta is common across actions
-    actions_meta: list[str] = []
+    """Registered actions are shared by all runs of the engine while the state
+    of each run lives in its own RunContext, so one engine can serve
+    concurrent applies from several threads."""
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        parallel: bool = False,
+        max_workers: int = DEFAULT_ACTION_WORKERS,
+        patch_mode: PatchMode = PatchMode.INCREMENTAL,
+        probe_workers: int = DEFAULT_PROBE_WORKERS,
+    ):
+        # evaluate independent actions of a pass concurrently
+        self.parallel = parallel
+        self.patch_mode = patch_mode
+        self.max_workers = max_workers
+        # data paths probed concurrently by the actions of a run
+        self.probe_workers = probe_workers
+        self.actions: list[Action] = []
+        self.plan: EnginePlan | None = None
+        # NOTE: In future we may make this meta specific to each action
+        # for now meta is common across actions and runs
+        self.actions_meta: list[str] = []
 
     def add_to_actions_meta(self, meta: str):
         self.actions_meta.append(meta)
 
+    @classmethod
+    def from_plan(cls, plan: "EnginePlan", **kwargs) -> "RuleEngine":
+        """Engine running the prepared actions of a plan, which is much cheaper
+        than registering the actions anew"""
+        engine = cls(**kwargs)
+        engine.plan = plan
+        engine.actions = list(plan.actions)
+        return engine
+
     def _validate_action(self, action: Action):
-        expected_arg_count = 3
-        if action.apply.__code__.co_argcount != expected_arg_count:
-            raise ValueError(
-                f"action {action.__class__.__name__} should have {expected_arg_count}, but got {action.apply.__code__.co_argcount}"
-            )
-        logger.debug(f"action {action.__class__.__name__} is valid!")
+        validate_action(action)
 
     def register_action(self, action: Action):
         self._validate_action(action=action)
@@ -39,40 +188,213 @@ class RuleEngine:
             self.register_action(action_cls())
         logger.debug("All actions registered!")
 
-    def _get_json_patch_from_merge_patch(
-        self, json_merge_patch: IR, source_ir: IR, ir_to_patch: IR
+    def _track_changes(self, context: RunContext, ir: IR, changed: set[str]):
+        """Update the source relative JSON patch ops of the changed paths"""
+        if self.patch_mode == PatchMode.DIFF:
+            return
+        source = context.ir_pipeline[0]
+        for path in changed:
+            section = path.partition(".")[0]
+            if not isinstance(source.__dict__[section], dict):
+                path = section
+            context.source_json_patches[path] = source.get_json_patch_at(ir, [path])
+
+    def _get_json_patch_wrt_source(self, context: RunContext, ir: IR) -> list:
+        """JSON patch from the source IR of the run to the given IR, all its
+        changes must have been tracked in incremental mode"""
+        source = context.ir_pipeline[0]
+        if self.patch_mode != PatchMode.DIFF:
+            patch = source.order_json_patch(ir, context.source_json_patches)
+            if self.patch_mode == PatchMode.INCREMENTAL:
+                return patch
+        diff = source.get_json_patch(ir)
+        if self.patch_mode == PatchMode.VERIFY and patch != diff:
+            raise RuntimeError(
+                f"incremental JSON patch {patch} does not match diff {diff}"
+            )
+        return diff
+
+    def _dependents(self, changed: set[str]) -> list[Action]:
+        """Actions reading any of the changed IR paths"""
+        return [
+            action
+            for action in self.actions
+            if not action.skip
+            and any(
+                paths_overlap(read, path)
+                for read in self._read_paths(action)
+                for path in changed
+            )
+        ]
+
+    def _read_paths(self, action: Action) -> tuple[str, ...]:
+        if self.plan is not None and action in self.plan.read_paths:
+            return self.plan.read_paths[action]
+        return action.read_paths()
+
+    def _write_paths(self, action: Action) -> tuple[str, ...]:
+        if self.plan is not None and action in self.plan.write_paths:
+            return self.plan.write_paths[action]
+        return action.write_paths()
+
+    def _conflicts(self, earlier: Action, later: Action) -> bool:
+        """Whether the later action may read what the earlier one writes"""
+        if self.plan is not None and earlier in self.plan.affects:
+            return later in self.plan.affects[earlier]
+        return any(
+            paths_overlap(write, read)
+            for write in self._write_paths(earlier)
+            for read in self._read_paths(later)
+        )
+
+    def _next_wave(self, candidates: list[Action]) -> list[Action]:
+        """Longest prefix of the pending actions in which no action reads what
+        an earlier one writes, these can all run on the same input IR"""
+        wave = candidates[:1]
+        if not self.parallel:
+            return wave
+        for action in candidates[1:]:
+            if any(self._conflicts(member, action) for member in wave):
+                break
+            wave.append(action)
+        return wave
+
+    def _apply_action(self, action: Action, ir: IR, actions_meta: list[str]):
+        with profile_span(action.__class__.__name__, "action"):
+            return action.apply(ir, actions_meta)
+
+    def _evaluate_wave(self, wave: list[Action], ir: IR, context, executor):
+        if executor is None or len(wave) == 1:
+            return [
+                self._apply_action(action, ir.view(), context.actions_meta)
+                for action in wave
+            ]
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                self._apply_action,
+                action,
+                ir.view(),
+                context.actions_meta,
+            )
+            for action in wave
+        ]
+        return [future.result() for future in futures]
+
+    def _merge(self, action: Action, json_merge_patch: IR, input_ir: IR, running_ir):
+        """Record the patch of an action against the running IR and apply it,
+        returns the changed paths"""
+        context = get_run_context()
+        json_merge_patch.thaw()
+        # only keys the action changed in its own input are merged, so a
+        # patch computed on an older IR does not revert later changes
+        delta = json_merge_patch.delta(input_ir)
+        changed = running_ir.changed_paths(delta)
+        undeclared = [
+            path
+            for path in changed
+            if not any(paths_overlap(w, path) for w in self._write_paths(action))
+        ]
+        if undeclared:
+            logger.warning(
+                f"action {action.__class__.__name__} wrote {undeclared} "
+                "which are not declared in its writes"
+            )
+        stage_source_ir = running_ir.snapshot()
+        running_ir.update(delta)
+        self._track_changes(context, running_ir, changed)
+        json_patch = self._get_json_patch_wrt_source(context, running_ir)
+        logger.debug(
+            f"action {action.__class__.__name__} applied, returned json merge patch {json_merge_patch} and json patch {json_patch}"
+        )
+        action.json_patches_and_comment_wrt_source.append(
+            {
+                "comment": json_merge_patch.comment,
+                "json_patch": json_patch,
+                "json_merge_patch": json_merge_patch,
+                "stage_source_ir": stage_source_ir,
+            }
+        )
+        return changed
+
+    def run_all_actions(
+        self,
+        ir: IR,
+        pending: set[Action] | None = None,
+        executor: Executor | None = None,
     ):
-        ir_to_patch.update(json_merge_patch=json_merge_patch)
-        return source_ir.get_json_patch(ir_to_patch)
+        """Run the pending actions, all actions by default, in registration
+        order. A patch marks every action reading a changed path as pending,
+        later actions then run in this pass and earlier ones in the next.
 
-    def run_all_actions(self, ir: IR):
+        In parallel mode consecutive actions which do not read each other's
+        writes run concurrently on the executor. Their patches are still
+        merged one by one in registration order and a result is dropped, and
+        the action run again, whenever the sequential order would have given
+        it a different input. Must be called within a run, see apply."""
         try:
+            context = get_run_context()
+            if context is None:
+                raise RuntimeError("actions can only run within RuleEngine.apply")
+            if pending is None:
+                pending = set(self.actions)
+            position = {action: i for i, action in enumerate(self.actions)}
             running_ir = ir
-            for action in tqdm(
-                self.actions, total=(len(self.actions)), desc="Iterating over actions"
-            ):
-                json_merge_patch: IR = action.apply(
-                    deepcopy(running_ir), self.actions_meta
-                )
-                if not json_merge_patch:
-                    continue
-                json_patch = self._get_json_patch_from_merge_patch(
-                    json_merge_patch,
-                    deepcopy(self.ir_pipeline[0]),
-                    deepcopy(running_ir),
-                )
-                logger.debug(
-                    f"action {action.__class__.__name__} applied, returned json merge patch {json_merge_patch} and json patch {json_patch}"
-                )
-                action.json_patches_and_comment_wrt_source.append(
-                    {
-                        "comment": json_merge_patch.comment,
-                        "json_patch": json_patch,
-                        "json_merge_patch": json_merge_patch,
-                        "stage_source_ir": deepcopy(running_ir),
-                    }
-                )
-                running_ir.update(json_merge_patch)
+            progress = tqdm(total=len(self.actions), desc="Iterating over actions")
+            next_position = 0
+            while candidates := [
+                action for action in self.actions[next_position:] if action in pending
+            ]:
+                wave = self._next_wave(candidates)
+                pending.difference_update(wave)
+                saved = [
+                    (action.skip, len(action.json_merge_patches)) for action in wave
+                ]
+                input_ir = running_ir.snapshot()
+                results = self._evaluate_wave(wave, input_ir, context, executor)
+
+                # paths changed by the members merged so far, and the earliest
+                # position of an action they woke up that sequential order
+                # would have run before the remaining members
+                changed_in_wave = set()
+                woken_at = len(self.actions)
+                merged = 0
+                for action, json_merge_patch in zip(wave, results, strict=True):
+                    if woken_at < position[action] or any(
+                        paths_overlap(path, read)
+                        for path in changed_in_wave
+                        for read in self._read_paths(action)
+                    ):
+                        break
+                    merged += 1
+                    if not json_merge_patch:
+                        continue
+                    changed = self._merge(
+                        action, json_merge_patch, input_ir, running_ir
+                    )
+                    changed_in_wave |= changed
+                    # an action is not woken up again by its own writes
+                    for dependent in self._dependents(changed):
+                        if dependent is action:
+                            continue
+                        pending.add(dependent)
+                        if position[dependent] > position[action]:
+                            woken_at = min(woken_at, position[dependent])
+
+                for action, (skip, num_patches) in zip(
+                    wave[merged:], saved[merged:], strict=True
+                ):
+                    logger.debug(
+                        f"action {action.__class__.__name__} ran on a stale IR "
+                        "and is run again"
+                    )
+                    action.skip = skip
+                    del action.json_merge_patches[num_patches:]
+                    pending.add(action)
+                last = wave[merged - 1]
+                progress.update(position[last] + 1 - next_position)
+                next_position = position[last] + 1
+            progress.close()
             return running_ir
         except Exception as e:
             logger.error(f"Error running all actions: {str(e)}")
@@ -99,7 +421,11 @@ class RuleEngine:
                 ir.tuning_config.get("training_data_path", None)
                 and len(ir.tuning_data_config.get("datasets", [])) > 0
             ):
-                ir.tuning_config.pop("training_data_path")
+                ir.tuning_config = {
+                    k: v
+                    for k, v in ir.tuning_config.items()
+                    if k != "training_data_path"
+                }
             logger.debug(f"IR {ir} is valid!")
             return ir
         except FileNotFoundError as e:
@@ -109,41 +435,101 @@ class RuleEngine:
             logger.error(f"Error validating IR: {str(e)}")
             raise Exception(f"Failed to validate IR: {str(e)}") from e
 
-    def apply(self, ir: IR):
+    def apply(
+        self,
+        ir: IR,
+        actions_meta: list[str] | None = None,
+        context: RunContext | None = None,
+    ):
+        """Run all actions over the IR until it reaches a fixed point. Meta
+        passed here only applies to this run, a context may be passed in to
+        inspect the run state afterwards."""
+        if context is None:
+            context = RunContext()
+        context.actions_meta = [*self.actions_meta, *(actions_meta or [])]
+        context.probe_workers = self.probe_workers
+        token = set_run_context(context)
+        try:
+            with (
+                ThreadPoolExecutor(max_workers=self.max_workers)
+                if self.parallel
+                else nullcontext()
+            ) as executor:
+                return self._apply(ir, context, executor)
+        finally:
+            reset_run_context(token)
+
+    def apply_many(
+        self,
+        irs: list[IR],
+        actions_meta: list[str] | None = None,
+        max_workers: int = DEFAULT_BATCH_WORKERS,
+    ) -> Iterator[BatchResult]:
+        """Apply the engine to every IR on a pool of workers. Results are
+        yielded in completion order as (final IR, patches) of their BatchResult,
+        one IR failing does not affect the others."""
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {
+                executor.submit(
+                    contextvars.copy_context().run, self.apply, ir, actions_meta
+                ): index
+                for index, ir in enumerate(irs)
+            }
+            for future in as_completed(futures):
+                yield BatchResult.from_future(futures[future], future)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    def _apply(self, ir: IR, context: RunContext, executor: Executor | None = None):
         try:
             max_iterations = 20
+            # the only full copy, every later stage shares unchanged sections
             ir_to_apply: IR = deepcopy(ir)
-            self.ir_pipeline.append(deepcopy(ir))
-            while any([not action.skip for action in self.actions]) and max_iterations:
-                ir_to_apply = self.validate_and_maybe_fix_ir(ir_to_apply)
-                ir_to_apply = self.run_all_actions(ir_to_apply)
-                self.ir_pipeline.append(deepcopy(ir_to_apply))
+            context.ir_pipeline.append(ir_to_apply.snapshot())
+            pending = {action for action in self.actions if not action.skip}
+            validated_fingerprint = None
+            while pending and max_iterations:
+                # only paths validation looks at can turn a valid IR invalid
+                if ir_to_apply.fingerprint(VALIDATED_PATHS) != validated_fingerprint:
+                    unvalidated = ir_to_apply.snapshot()
+                    with profile_span("validate_and_maybe_fix_ir", "engine"):
+                        ir_to_apply = self.validate_and_maybe_fix_ir(ir_to_apply)
+                    self._track_changes(
+                        context, ir_to_apply, ir_to_apply.diff_paths(unvalidated)
+                    )
+                    validated_fingerprint = ir_to_apply.fingerprint(VALIDATED_PATHS)
+                fingerprint = ir_to_apply.fingerprint()
+                with profile_span(
+                    f"iteration {len(context.ir_pipeline)}",
+                    "iteration",
+                    pending=len(pending),
+                ):
+                    ir_to_apply = self.run_all_actions(ir_to_apply, pending, executor)
+                context.ir_pipeline.append(ir_to_apply.snapshot())
                 max_iterations -= 1
+                if ir_to_apply.fingerprint() == fingerprint:
+                    break
             # extracting comments for json patches
-            json_patches = self.ir_pipeline[0].get_json_patch(ir_to_apply)
+            json_patches = self._get_json_patch_wrt_source(context, ir_to_apply)
             final_json_patches_with_comment: list[dict] = []
-            _json_patches_that_have_comments = []
+            final_index = PatchIndex(json_patches)
+            commented = PatchIndex()
             for action in self.actions:
                 if len(action.json_patches_and_comment_wrt_source):
-                    if set_issubset(
-                        json_patches,
-                        action.json_patches_and_comment_wrt_source[-1]["json_patch"],
-                    ):
-                        final_json_patches_with_comment.append(
-                            action.json_patches_and_comment_wrt_source[-1]
-                        )
-                        _json_patches_that_have_comments.extend(
-                            action.json_patches_and_comment_wrt_source[-1]["json_patch"]
-                        )
+                    last = action.json_patches_and_comment_wrt_source[-1]
+                    if final_index.covers(last["json_patch"]):
+                        final_json_patches_with_comment.append(last)
+                        commented.update(last["json_patch"])
             final_json_patches_with_comment.append(
                 {
                     "comment": "",
-                    "json_patch": set_difference(
-                        json_patches, _json_patches_that_have_comments
-                    ),
+                    "json_patch": [op for op in json_patches if op not in commented],
                 }
             )
-            return ir_to_apply, final_json_patches_with_comment
+            # sections of the result are shared with the pipeline, hand out
+            # top level copies so callers can modify them
+            return ir_to_apply.view().thaw(), final_json_patches_with_comment
         except Exception as e:
             logger.error(f"Error in RuleEngine.apply: {str(e)}")
             raise Exception(f"Failed to apply rules: {str(e)}") from e
@@ -0,0 +1,188 @@
+from copy import deepcopy
+
+
+class CowDict(dict):
+    """Copy-on-write view of a dict that is never modified through the view.
+
+    The view starts as a shallow copy and nested dicts and lists are wrapped
+    in views of their own when first accessed, so writes at any depth stay
+    local to the view while everything untouched is shared with the base.
+    Values assigned through the view belong to it and are not wrapped."""
+
+    __slots__ = ("_owned",)
+
+    def __init__(self, base=()):
+        super().__init__(base)
+        # ids of plain containers written through this view
+        self._owned = set()
+
+    def _own(self, key):
+        value = dict.__getitem__(self, key)
+        wrapped = _wrap(self, value)
+        if wrapped is not value:
+            dict.__setitem__(self, key, wrapped)
+        return wrapped
+
+    def __getitem__(self, key):
+        return self._own(key)
+
+    def __setitem__(self, key, value):
+        _mark_owned(self, value)
+        dict.__setitem__(self, key, value)
+
+    def __iter__(self):
+        # overridden so dict(view) and {**view} go through __getitem__
+        return dict.__iter__(self)
+
+    def get(self, key, default=None):
+        return self._own(key) if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self._own(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self._own(key)
+        dict.__delitem__(self, key)
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def values(self):
+        return [self._own(key) for key in self]
+
+    def items(self):
+        return [(key, self._own(key)) for key in self]
+
+    def copy(self):
+        return CowDict(thaw(self))
+
+    def __deepcopy__(self, memo):
+        return deepcopy(thaw(self), memo)
+
+    def __reduce_ex__(self, protocol):
+        return (dict, (thaw(self),))
+
+
+class CowList(list):
+    """Copy-on-write view of a list, see CowDict"""
+
+    __slots__ = ("_owned",)
+
+    def __init__(self, base=()):
+        super().__init__(base)
+        self._owned = set()
+
+    def _own(self, index):
+        value = list.__getitem__(self, index)
+        wrapped = _wrap(self, value)
+        if wrapped is not value:
+            list.__setitem__(self, index, wrapped)
+        return wrapped
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._own(i) for i in range(*index.indices(len(self)))]
+        return self._own(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            for v in value:
+                _mark_owned(self, v)
+        else:
+            _mark_owned(self, value)
+        list.__setitem__(self, index, value)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._own(i)
+
+    def __reversed__(self):
+        for i in reversed(range(len(self))):
+            yield self._own(i)
+
+    def append(self, value):
+        _mark_owned(self, value)
+        list.append(self, value)
+
+    def insert(self, index, value):
+        _mark_owned(self, value)
+        list.insert(self, index, value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def pop(self, index=-1):
+        value = self._own(index)
+        list.pop(self, index)
+        return value
+
+    def copy(self):
+        return CowList(thaw(self))
+
+    def __deepcopy__(self, memo):
+        return deepcopy(thaw(self), memo)
+
+    def __reduce_ex__(self, protocol):
+        return (list, (thaw(self),))
+
+
+def _mark_owned(view, value):
+    if type(value) in (dict, list):
+        view._owned.add(id(value))
+
+
+def _wrap(view, value):
+    if id(value) in view._owned:
+        return value
+    if type(value) is dict:
+        return CowDict(value)
+    if type(value) is list:
+        return CowList(value)
+    return value
+
+
+def _thaw_owned(value):
+    """Plain copy of containers written by an action, which may hold views"""
+    if isinstance(value, CowDict | CowList):
+        return thaw(value)
+    if isinstance(value, dict):
+        return {k: _thaw_owned(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_thaw_owned(v) for v in value]
+    return value
+
+
+def thaw(value):
+    """Turn views back into plain dicts and lists. Only the parts that were
+    accessed or written are rebuilt, untouched values are shared as they are."""
+    if isinstance(value, CowDict):
+        return {
+            k: _thaw_owned(v)
+            if isinstance(v, CowDict | CowList) or id(v) in value._owned
+            else v
+            for k, v in dict.items(value)
+        }
+    if isinstance(value, CowList):
+        return [
+            _thaw_owned(v)
+            if isinstance(v, CowDict | CowList) or id(v) in value._owned
+            else v
+            for v in list.__iter__(value)
+        ]
+    return _thaw_owned(value)
@@ -6,18 +6,21 @@ import yaml
 
 from tuning_config_recommender.utils.data_processing import (
     load_model_file_from_hf,
-    load_training_data,
+)
+from tuning_config_recommender.utils.dataset_profile import (
+    get_dataset_profile,
+    has_any_key_containing,
 )
 from tuning_config_recommender.utils.tuning_config import (
     fetch_from_knowledge_base,
+    load_model_json,
 )
 
 
 def fetch_chat_template(model_name_or_path: str):
     """Given a model HF ID or Path, fetch the chat template (instruct model)"""
     if os.path.isdir(model_name_or_path):
-        with open(f"{model_name_or_path}/tokenizer_config.json", encoding="utf-8") as f:
-            config = json.load(f)
+        config = load_model_json(model_name_or_path, "tokenizer_config.json")
 
     elif (
         result := fetch_from_knowledge_base(
@@ -48,50 +51,5 @@ def fetch_chat_template(model_name_or_path: str):
 
 def determine_input_and_response_text(training_data_path: str) -> dict:
     """Determine the input and response field for the data formating template (Q/A format dataset)"""
-    data = load_training_data(training_data_path)
-    data_item = data[0]
-    columns = list(data_item.keys())
-    columns = [k.lower() for k in columns]
-
-    COMMON_INPUT_KEYS = [
-        "tweet_text",
-        "tweet text",
-        "instruction",
-        "prompt",
-        "question",
-        "input",
-        "query",
-        "source",
-        "content",
-    ]
-
-    COMMON_RESPONSE_KEYS = [
-        "text_label",
-        "label",
-        "response",
-        "answer",
-        "output",
-        "target",
-        "completion",
-    ]
-
-    input_col = "input"
-    output_col = "output"
-
-    for col in columns:
-        if any(key in col.lower() for key in COMMON_INPUT_KEYS):
-            input_col = col
-            break
-
-    for col in columns:
-        if any(key in col.lower() for key in COMMON_RESPONSE_KEYS):
-            output_col = col
-            break
-
-    return input_col, output_col
-
-
-def has_any_key_containing(example, key_substrings):
-    return any(
-        any(sub in key.lower() for sub in key_substrings) for key in example.keys()
-    )
+    profile = get_dataset_profile(training_data_path)
+    return profile.input_column, profile.response_column
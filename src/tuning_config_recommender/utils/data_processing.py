@@ -1,45 +1,386 @@
+import bz2
 import csv
+import glob
+import gzip
+import itertools
 import json
+import lzma
 import os
+import random
 import re
 import shutil
+import time
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from enum import StrEnum, auto
 from pathlib import Path
 
-import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from datasets import load_dataset
 from huggingface_hub import hf_hub_download
 from loguru import logger
 
+from tuning_config_recommender.constants import (
+    DEFAULT_PROBE_MAX_BYTES,
+    DEFAULT_PROBE_MAX_ROW_GROUPS,
+    DEFAULT_PROBE_MAX_SECONDS,
+    DEFAULT_PROBE_NUM_SAMPLES,
+)
+from tuning_config_recommender.utils.jsonl_index import (
+    count_jsonl_records,
+    sample_jsonl_records,
+)
+from tuning_config_recommender.utils.profiling import profile_span
 
-def extract_data_from_general_file(file_path) -> dict:
-    """Data extraction function from json/jsonl/parquet/arrow files"""
-    try:
-        ext = os.path.splitext(file_path)[-1].lower()
-
-        if ext == ".json":
-            with open(file_path, encoding="utf-8") as f:
-                data = json.load(f)
-        elif ext == ".jsonl":
-            with open(file_path, encoding="utf-8") as f:
-                data = [json.loads(line) for line in f]
-        elif ext == ".csv":
-            with open(file_path, encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                data = list(reader)
-        elif ext == ".parquet":
-            df = pd.read_parquet(file_path)
-            data = df.to_dict(orient="records")
-        elif ext == ".arrow":
+try:
+    import zstandard
+
+    skip_zstd = False
+except ImportError:
+    skip_zstd = True
+
+
+class SamplingStrategy(StrEnum):
+    HEAD = auto()
+    RANDOM = auto()
+
+
+def _open_zstd(file_path: str):
+    if skip_zstd:
+        raise ValueError(
+            f"zstandard is not installed, cannot decompress {file_path}. "
+            "Install tuning_config_recommender[zstd]"
+        )
+    return zstandard.open(file_path, "rt", encoding="utf-8")
+
+
+_DECOMPRESSING_OPENERS = {
+    ".gz": lambda path: gzip.open(path, "rt", encoding="utf-8"),
+    ".bz2": lambda path: bz2.open(path, "rt", encoding="utf-8"),
+    ".xz": lambda path: lzma.open(path, "rt", encoding="utf-8"),
+    ".zst": _open_zstd,
+}
+
+
+def get_data_file_format(file_path: str) -> tuple[str, str | None]:
+    """Return the data format extension and compression extension (if any)
+    of a data file, e.g. data.jsonl.gz -> (".jsonl", ".gz")"""
+    root, ext = os.path.splitext(file_path)
+    ext = ext.lower()
+    if ext in _DECOMPRESSING_OPENERS:
+        return os.path.splitext(root)[-1].lower(), ext
+    return ext, None
+
+
+def open_text_data_file(file_path: str):
+    """Open a text data file, decompressing it on the fly as it is read"""
+    _, compression = get_data_file_format(file_path)
+    if compression is None:
+        return open(file_path, encoding="utf-8")
+    return _DECOMPRESSING_OPENERS[compression](file_path)
+
+
+def _iter_json_records(file_path: str) -> Iterator[dict]:
+    """Incrementally decode records of a top level JSON array without reading
+    the whole file. Non array documents are loaded as a whole."""
+    decoder = json.JSONDecoder()
+    chunk_size = 1 << 16
+    with open_text_data_file(file_path) as f:
+        buffer = f.read(chunk_size)
+        stripped = buffer.lstrip()
+        if not stripped.startswith("["):
+            data = json.loads(buffer + f.read())
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+            return
+        buffer = stripped[1:]
+        eof = False
+        while True:
+            buffer = buffer.lstrip().lstrip(",").lstrip()
+            if buffer.startswith("]"):
+                return
             try:
-                data = load_dataset("arrow", data_files=file_path)
-            except Exception as e:
-                logger.error(f"Failed to load Arrow file: {e}")
-                raise FileNotFoundError(f"Failed to load Arrow file: {str(e)}") from e
+                record, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # record spans beyond the buffer, grow reads to keep this linear
+                more = f.read(chunk_size)
+                chunk_size *= 2
+                eof = not more
+                buffer += more
+                continue
+            yield record
+            buffer = buffer[end:]
+            if len(buffer) < chunk_size and not eof:
+                more = f.read(chunk_size)
+                eof = not more
+                buffer += more
+
+
+def _iter_jsonl_records(file_path: str) -> Iterator[dict]:
+    with open_text_data_file(file_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _iter_csv_records(file_path: str) -> Iterator[dict]:
+    with open_text_data_file(file_path) as f:
+        yield from csv.DictReader(f)
+
+
+def _iter_record_batches(batches) -> Iterator[dict]:
+    for batch in batches:
+        yield from batch.to_pylist()
+
+
+def _open_arrow_reader(file_path: str):
+    """Arrow files can be in IPC file format or IPC stream format (HF datasets
+    cache files), try both over a memory map."""
+    source = pa.memory_map(file_path, "r")
+    try:
+        return pa.ipc.open_file(source)
+    except pa.ArrowInvalid:
+        source.seek(0)
+        return pa.ipc.open_stream(source)
+
+
+def _iter_arrow_records(file_path: str) -> Iterator[dict]:
+    reader = _open_arrow_reader(file_path)
+    if isinstance(reader, pa.ipc.RecordBatchFileReader):
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    else:
+        batches = reader
+    yield from _iter_record_batches(batches)
+
+
+def _iter_parquet_records(file_path: str) -> Iterator[dict]:
+    parquet_file = pq.ParquetFile(file_path, memory_map=True)
+    yield from _iter_record_batches(parquet_file.iter_batches(batch_size=1024))
+
+
+@dataclass(frozen=True)
+class ProbeBudget:
+    """Upper bounds on the time spent and record bytes pulled by one probe"""
+
+    max_seconds: float = DEFAULT_PROBE_MAX_SECONDS
+    max_bytes: int = DEFAULT_PROBE_MAX_BYTES
+    # row groups a random sample of a parquet file is drawn from
+    max_row_groups: int = DEFAULT_PROBE_MAX_ROW_GROUPS
+
+
+def _select_columns(names: list[str], columns: list[str] | None) -> list[str] | None:
+    """Names of the file matching the requested columns, compared case
+    insensitively as profiles hold lower cased column names"""
+    if columns is None:
+        return None
+    wanted = {column.lower() for column in columns}
+    return [name for name in names if name.lower() in wanted]
+
+
+def _project(records: Iterable[dict], columns: list[str] | None) -> Iterable[dict]:
+    """Limit records read in full to the given columns"""
+    if columns is None:
+        return records
+    wanted = {column.lower() for column in columns}
+    return (
+        {k: v for k, v in record.items() if k.lower() in wanted}
+        if isinstance(record, dict)
+        else record
+        for record in records
+    )
+
+
+def _sample_parquet_records(
+    file_path: str,
+    num_samples: int,
+    strategy: SamplingStrategy,
+    seed: int,
+    budget: ProbeBudget | None = None,
+    columns: list[str] | None = None,
+) -> list[dict]:
+    """Sample rows of a parquet file decoding only the given columns of the
+    row groups holding them. Random samples are drawn from at most
+    budget.max_row_groups row groups picked at random, row groups are read
+    until the budget is exhausted."""
+    budget = budget or ProbeBudget()
+    parquet_file = pq.ParquetFile(file_path, memory_map=True)
+    columns = _select_columns(parquet_file.schema_arrow.names, columns)
+    if strategy == SamplingStrategy.HEAD:
+        batches = parquet_file.iter_batches(batch_size=num_samples, columns=columns)
+        return take_samples(_iter_record_batches(batches), num_samples, budget=budget)
+
+    metadata = parquet_file.metadata
+    rng = random.Random(seed)
+    row_groups = sorted(
+        rng.sample(
+            range(metadata.num_row_groups),
+            min(budget.max_row_groups, metadata.num_row_groups),
+        )
+    )
+    sizes = [metadata.row_group(row_group).num_rows for row_group in row_groups]
+    rows = sorted(rng.sample(range(sum(sizes)), min(num_samples, sum(sizes))))
+    deadline = time.monotonic() + budget.max_seconds
+    consumed = 0
+    records = []
+    row_group_start = 0
+    for row_group, size in zip(row_groups, sizes, strict=True):
+        row_group_end = row_group_start + size
+        offsets = [
+            r - row_group_start for r in rows if row_group_start <= r < row_group_end
+        ]
+        row_group_start = row_group_end
+        if not offsets:
+            continue
+        table = parquet_file.read_row_group(row_group, columns=columns)
+        records.extend(table.take(offsets).to_pylist())
+        consumed += table.nbytes
+        if consumed >= budget.max_bytes or time.monotonic() >= deadline:
+            logger.warning(
+                f"Probe budget {budget} exhausted after {consumed} bytes, "
+                "sampling from the row groups read so far"
+            )
+            break
+    return records
+
+
+COLUMNAR_FILE_FORMATS = (".parquet", ".arrow")
+
+
+def read_columnar_schema(file_path: str) -> tuple[pa.Schema, int | None]:
+    """Read only the schema of a parquet (footer) or arrow (IPC header) file
+    over a memory map, along with the row count when the format stores it."""
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext == ".parquet":
+        metadata = pq.read_metadata(file_path, memory_map=True)
+        return metadata.schema.to_arrow_schema(), metadata.num_rows
+    if ext == ".arrow":
+        return _open_arrow_reader(file_path).schema, None
+    raise ValueError(f"{file_path} is not a columnar file")
+
+
+def read_first_row_group(file_path: str, columns: list[str]) -> list[dict]:
+    """Decode given columns of only the first parquet row group or arrow record batch"""
+    ext = os.path.splitext(file_path)[-1].lower()
+    if ext == ".parquet":
+        parquet_file = pq.ParquetFile(file_path, memory_map=True)
+        if not parquet_file.metadata.num_row_groups:
+            return []
+        return parquet_file.read_row_group(0, columns=columns).to_pylist()
+    if ext == ".arrow":
+        reader = _open_arrow_reader(file_path)
+        if isinstance(reader, pa.ipc.RecordBatchFileReader):
+            if not reader.num_record_batches:
+                return []
+            batch = reader.get_batch(0)
         else:
-            logger.error("Unsupported file format")
-            raise ValueError("Unsupported file format")
+            batch = next(iter(reader), None)
+            if batch is None:
+                return []
+        return batch.select(columns).to_pylist()
+    raise ValueError(f"{file_path} is not a columnar file")
+
+
+_RECORD_ITERATORS = {
+    ".json": _iter_json_records,
+    ".jsonl": _iter_jsonl_records,
+    ".csv": _iter_csv_records,
+    ".parquet": _iter_parquet_records,
+    ".arrow": _iter_arrow_records,
+}
+
+
+def iter_records_from_general_file(file_path: str) -> Iterator[dict]:
+    """Lazily iterate over records of json/jsonl/csv/parquet/arrow files.
+    json/jsonl/csv files may be gzip/bz2/xz/zstd compressed."""
+    ext, compression = get_data_file_format(file_path)
+    if ext not in _RECORD_ITERATORS:
+        logger.error("Unsupported file format")
+        raise ValueError("Unsupported file format")
+    if compression and ext in COLUMNAR_FILE_FORMATS:
+        logger.error(f"Compressed {ext} files are not supported")
+        raise ValueError(
+            f"Compressed {ext} files are not supported, use the format's own compression"
+        )
+    return _RECORD_ITERATORS[ext](file_path)
+
+
+def _within_budget(records: Iterable[dict], budget: ProbeBudget) -> Iterator[dict]:
+    """Stop iterating once the budget is exhausted. Limits are checked between
+    records, so at least one record is always yielded."""
+    deadline = time.monotonic() + budget.max_seconds
+    consumed = 0
+    for record in records:
+        consumed += len(json.dumps(record, default=str))
+        yield record
+        if consumed >= budget.max_bytes or time.monotonic() >= deadline:
+            logger.warning(
+                f"Probe budget {budget} exhausted after {consumed} bytes, "
+                "sampling from the records read so far"
+            )
+            return
+
+
+def take_samples(
+    records: Iterable[dict],
+    num_samples: int,
+    strategy: SamplingStrategy = SamplingStrategy.HEAD,
+    seed: int = 0,
+    budget: ProbeBudget | None = None,
+) -> list[dict]:
+    """Take first N records or a uniform reservoir sample of N records,
+    optionally bounded by a probe budget"""
+    if budget is not None:
+        records = _within_budget(records, budget)
+    if strategy == SamplingStrategy.HEAD:
+        return list(itertools.islice(records, num_samples))
+    rng = random.Random(seed)
+    reservoir = []
+    for idx, record in enumerate(records):
+        if idx < num_samples:
+            reservoir.append(record)
+            continue
+        slot = rng.randint(0, idx)
+        if slot < num_samples:
+            reservoir[slot] = record
+    return reservoir
+
 
-        return data
+def extract_data_from_general_file(
+    file_path,
+    num_samples: int | None = None,
+    strategy: SamplingStrategy = SamplingStrategy.HEAD,
+    seed: int = 0,
+    budget: ProbeBudget | None = None,
+    columns: list[str] | None = None,
+) -> list[dict]:
+    """Data extraction function from json/jsonl/csv/parquet/arrow files.
+    All records are returned when num_samples is None, otherwise a bounded sample
+    is read using format specific streaming readers. Records are limited to
+    the given columns, parquet files only decode those."""
+    try:
+        ext, compression = get_data_file_format(file_path)
+        if num_samples is not None and ext == ".parquet" and not compression:
+            return _sample_parquet_records(
+                file_path, num_samples, strategy, seed, budget, columns
+            )
+        if (
+            num_samples is not None
+            and ext == ".jsonl"
+            and not compression
+            and strategy == SamplingStrategy.RANDOM
+        ):
+            return list(
+                _project(sample_jsonl_records(file_path, num_samples, seed), columns)
+            )
+        records = _project(iter_records_from_general_file(file_path), columns)
+        if num_samples is None:
+            return list(records)
+        return take_samples(records, num_samples, strategy, seed, budget)
     except FileNotFoundError as e:
         logger.error(f"File not found: {str(e)}")
         raise FileNotFoundError(f"File not found: {str(e)}") from e
@@ -53,6 +394,32 @@ def extract_data_from_general_file(file_path) -> dict:
         ) from e
 
 
+def count_records_in_general_file(file_path: str) -> int:
+    """Count records of a data file, using the newline index for JSONL and the
+    footer for parquet files instead of parsing records"""
+    ext, compression = get_data_file_format(file_path)
+    if ext == ".jsonl" and not compression:
+        return count_jsonl_records(file_path)
+    if ext == ".parquet" and not compression:
+        return pq.read_metadata(file_path, memory_map=True).num_rows
+    return sum(1 for _ in iter_records_from_general_file(file_path))
+
+
+def resolve_data_path_glob(pattern: str) -> list[str]:
+    """Expand a data path glob. When a pattern for a plain data format such as
+    *.jsonl matches nothing, its compressed variants (*.jsonl.gz etc.) are
+    used instead."""
+    matches = glob.glob(pattern)
+    ext, compression = get_data_file_format(pattern)
+    if matches or compression or ext not in _RECORD_ITERATORS:
+        return matches
+    return [
+        path
+        for compression_ext in _DECOMPRESSING_OPENERS
+        for path in glob.glob(pattern + compression_ext)
+    ]
+
+
 def maybe_is_a_hf_dataset_id(training_data_path: str) -> bool:
     return len(training_data_path.split("/")) == 2
 
@@ -73,8 +440,6 @@ def pick_train_split(dataset) -> str:
 def load_training_data(training_data_path: str) -> dict:
     """Load and validate training data based on training_data_path."""
     try:
-        _dataset_cache = {}
-
         # Check if path is a file
         if os.path.isfile(training_data_path):
             data = extract_data_from_general_file(training_data_path)
@@ -112,6 +477,61 @@ def load_training_data(training_data_path: str) -> dict:
         ) from e
 
 
+def sample_training_data(
+    training_data_path: str,
+    num_samples: int = DEFAULT_PROBE_NUM_SAMPLES,
+    strategy: SamplingStrategy = SamplingStrategy.HEAD,
+    seed: int = 0,
+    budget: ProbeBudget | None = None,
+    cache_dir: str | None = None,
+    columns: list[str] | None = None,
+) -> list[dict]:
+    """Probe a bounded sample of records from training_data_path instead of
+    loading the whole dataset. Dataset folders and HF dataset IDs are streamed
+    (using cache_dir as the datasets cache when given) and never fully
+    downloaded or converted. Records are limited to the given columns."""
+    with profile_span("sample_training_data", "data", path=training_data_path):
+        if budget is None:
+            budget = ProbeBudget()
+        try:
+            if os.path.isfile(training_data_path):
+                return extract_data_from_general_file(
+                    training_data_path, num_samples, strategy, seed, budget, columns
+                )
+
+            # anything that is not a file is a dataset folder or a HF dataset ID
+            try:
+                dataset = load_dataset(
+                    training_data_path, streaming=True, cache_dir=cache_dir
+                )
+                split = pick_train_split(dataset)
+                return take_samples(
+                    _project(iter(dataset[split]), columns),
+                    num_samples,
+                    strategy,
+                    seed,
+                    budget,
+                )
+            except Exception as e:
+                logger.error(f"Error loading dataset from folder or hf id: {str(e)}")
+                raise FileNotFoundError(
+                    f"Error loading dataset from folder or hf id: {str(e)}"
+                ) from e
+        except FileNotFoundError as e:
+            logger.error(f"File not found: {str(e)}")
+            raise FileNotFoundError(f"File not found: {str(e)}") from e
+        except OSError as e:
+            logger.error(f"OS Error: {str(e)}")
+            raise OSError(f"OS Error: {str(e)}") from e
+        except Exception as e:
+            logger.error(
+                f"Error sampling training data from {training_data_path}: {str(e)}"
+            )
+            raise Exception(
+                f"Failed to sample training data from {training_data_path}: {str(e)}"
+            ) from e
+
+
 def load_model_file_from_hf(model_name_or_path: str, file_name: str) -> dict:
     """Load contens of a specific file of a model. Supports both the local file system and HF hub."""
     try:
@@ -154,6 +574,11 @@ def get_model_path(model_name_or_path: str, unique_tag: str) -> str:
             "config.json",
             "tokenizer_config.json",
         ]
+        # needed for token length statistics, not every model ships them
+        optional_files_to_download = [
+            "tokenizer.json",
+            "special_tokens_map.json",
+        ]
 
         if os.path.isdir(model_name_or_path):
             return str(model_name_or_path)
@@ -168,6 +593,13 @@ def get_model_path(model_name_or_path: str, unique_tag: str) -> str:
                 src = hf_hub_download(str(model_name_or_path), filename=filename)
                 dst = os.path.join(cached_model_path, filename)
                 shutil.copy(src, dst)
+            for filename in optional_files_to_download:
+                try:
+                    src = hf_hub_download(str(model_name_or_path), filename=filename)
+                except Exception as e:
+                    logger.debug(f"Skipping {filename} of {model_name_or_path}: {e}")
+                    continue
+                shutil.copy(src, os.path.join(cached_model_path, filename))
             model_name_or_path = cached_model_path
 
         return str(model_name_or_path)
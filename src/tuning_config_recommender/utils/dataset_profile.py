@@ -0,0 +1,336 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import StrEnum, auto
+
+import pyarrow as pa
+from loguru import logger
+
+from tuning_config_recommender.constants import (
+    DATASET_PROFILE_CACHE_SIZE,
+    DEFAULT_PROBE_WORKERS,
+    SHARD_CONSISTENCY_CACHE_SIZE,
+)
+from tuning_config_recommender.utils.data_processing import (
+    COLUMNAR_FILE_FORMATS,
+    get_data_file_format,
+    read_columnar_schema,
+    read_first_row_group,
+    sample_training_data,
+)
+from tuning_config_recommender.utils.helper import LRUCache
+
+CHAT_STYLE_KEYS = ["messages", "conversations", "dialogues", "chat", "turns"]
+
+QA_INPUT_KEYS = [
+    "input",
+    "instruction",
+    "prompt",
+    "question",
+    "tweet_text",
+    "query",
+    "source",
+    "tweet text",
+]
+
+QA_RESPONSE_KEYS = [
+    "output",
+    "response",
+    "answer",
+    "label",
+    "text_label",
+    "target",
+    "completion",
+]
+
+TOKENIZED_FIELDS = {"input_ids", "labels", "attention_mask"}
+
+# Ordered by preference when picking the input and response columns
+# of the data formatting template
+TEMPLATE_INPUT_KEYS = [
+    "tweet_text",
+    "tweet text",
+    "instruction",
+    "prompt",
+    "question",
+    "input",
+    "query",
+    "source",
+    "content",
+]
+
+TEMPLATE_RESPONSE_KEYS = [
+    "text_label",
+    "label",
+    "response",
+    "answer",
+    "output",
+    "target",
+    "completion",
+]
+
+
+class DatasetFormat(StrEnum):
+    TOKENIZED = auto()
+    CHAT = auto()
+    QA = auto()
+    UNKNOWN = auto()
+
+
+def has_any_key_containing(example, key_substrings):
+    return any(
+        any(sub in key.lower() for sub in key_substrings) for key in example.keys()
+    )
+
+
+def _is_chat_record(record: dict) -> bool:
+    if not has_any_key_containing(record, CHAT_STYLE_KEYS):
+        return False
+    for chat_key in CHAT_STYLE_KEYS:
+        if chat_key in record:
+            val = record[chat_key]
+            if isinstance(val, list):
+                if all(
+                    isinstance(m, dict) and "role" in m and "content" in m for m in val
+                ):
+                    return True
+    return False
+
+
+def _determine_template_columns(columns: list[str]) -> tuple[str, str]:
+    columns = [k.lower() for k in columns]
+    input_col = "input"
+    output_col = "output"
+
+    for col in columns:
+        if any(key in col for key in TEMPLATE_INPUT_KEYS):
+            input_col = col
+            break
+
+    for col in columns:
+        if any(key in col for key in TEMPLATE_RESPONSE_KEYS):
+            output_col = col
+            break
+
+    return input_col, output_col
+
+
+@dataclass
+class DatasetProfile:
+    """Format related facts about a dataset path derived from a bounded sample.
+    For parquet and arrow files they are derived from the schema and
+    sample_rows is left empty."""
+
+    path: str
+    columns: list[str] = field(default_factory=list)
+    sample_rows: list[dict] = field(default_factory=list)
+    is_tokenized: bool = False
+    is_chat: bool = False
+    is_qa: bool = False
+    chat_column: str | None = None
+    input_column: str = "input"
+    response_column: str = "output"
+    num_rows: int | None = None
+
+    @property
+    def format(self) -> DatasetFormat:
+        if self.is_tokenized:
+            return DatasetFormat.TOKENIZED
+        if self.is_chat:
+            return DatasetFormat.CHAT
+        if self.is_qa:
+            return DatasetFormat.QA
+        return DatasetFormat.UNKNOWN
+
+
+def _is_chat_message_type(data_type: pa.DataType) -> bool | None:
+    """Decide from the arrow type alone whether a column holds role/content
+    messages. None means the type is not conclusive and values must be read."""
+    if not (pa.types.is_list(data_type) or pa.types.is_large_list(data_type)):
+        return None
+    value_type = data_type.value_type
+    if not pa.types.is_struct(value_type):
+        return None
+    names = {value_type.field(i).name for i in range(value_type.num_fields)}
+    return "role" in names and "content" in names
+
+
+def _build_profile_from_schema(path: str) -> DatasetProfile:
+    """Classify parquet/arrow files from column names and types, decoding
+    the first row group only when a value level check is needed."""
+    schema, num_rows = read_columnar_schema(path)
+    columns = list(schema.names)
+    keys = dict.fromkeys(columns)
+    chat_keys = [k for k in CHAT_STYLE_KEYS if k in keys]
+
+    is_chat = False
+    if has_any_key_containing(keys, CHAT_STYLE_KEYS):
+        undecided = []
+        for chat_key in chat_keys:
+            is_chat_type = _is_chat_message_type(schema.field(chat_key).type)
+            if is_chat_type:
+                is_chat = True
+                break
+            if is_chat_type is None:
+                undecided.append(chat_key)
+        if not is_chat and undecided:
+            rows = read_first_row_group(path, undecided)[:1]
+            is_chat = bool(rows) and _is_chat_record(rows[0])
+
+    input_column, response_column = _determine_template_columns(columns)
+    return DatasetProfile(
+        path=path,
+        columns=columns,
+        is_tokenized=any(f in keys for f in TOKENIZED_FIELDS),
+        is_chat=is_chat,
+        is_qa=has_any_key_containing(keys, QA_INPUT_KEYS)
+        and has_any_key_containing(keys, QA_RESPONSE_KEYS),
+        chat_column=next(iter(chat_keys), None),
+        input_column=input_column,
+        response_column=response_column,
+        num_rows=num_rows,
+    )
+
+
+def build_dataset_profile(path: str) -> DatasetProfile:
+    """Probe a sample of the dataset and classify its format"""
+    ext, compression = get_data_file_format(path)
+    if os.path.isfile(path) and ext in COLUMNAR_FILE_FORMATS and not compression:
+        return _build_profile_from_schema(path)
+    rows = sample_training_data(path)
+    if not rows or not isinstance(rows[0], dict):
+        return DatasetProfile(path=path, sample_rows=rows or [])
+    first_row = rows[0]
+    columns = list(first_row.keys())
+    input_column, response_column = _determine_template_columns(columns)
+    return DatasetProfile(
+        path=path,
+        columns=columns,
+        sample_rows=rows,
+        is_tokenized=any(f in first_row for f in TOKENIZED_FIELDS),
+        is_chat=_is_chat_record(first_row),
+        is_qa=has_any_key_containing(first_row, QA_INPUT_KEYS)
+        and has_any_key_containing(first_row, QA_RESPONSE_KEYS),
+        chat_column=next((k for k in CHAT_STYLE_KEYS if k in columns), None),
+        input_column=input_column,
+        response_column=response_column,
+    )
+
+
+_PROFILE_CACHE = LRUCache(maxsize=DATASET_PROFILE_CACHE_SIZE)
+
+
+def dataset_profile_key(path: str) -> tuple:
+    """Cache key which changes whenever the underlying file changes.
+    HF dataset IDs have no local stat and are keyed by ID only."""
+    try:
+        stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        return (path, None, None)
+
+
+def get_dataset_profile(path: str) -> DatasetProfile:
+    """Fetch the profile of a dataset path, computing it only when the path
+    was not profiled before or has changed since."""
+    key = dataset_profile_key(path)
+    profile = _PROFILE_CACHE.get(key)
+    if profile is None:
+        logger.debug(f"Profiling dataset {path}")
+        profile = build_dataset_profile(path)
+        _PROFILE_CACHE.put(key, profile)
+    return profile
+
+
+def clear_dataset_profile_cache():
+    _PROFILE_CACHE.clear()
+
+
+@dataclass
+class ProbeResult:
+    """Outcome of probing one data path, either a profile or the error raised"""
+
+    path: str
+    profile: DatasetProfile | None = None
+    error: Exception | None = None
+
+    def unwrap(self) -> DatasetProfile:
+        if self.error is not None:
+            raise self.error
+        return self.profile
+
+
+def _probe(path: str) -> ProbeResult:
+    try:
+        return ProbeResult(path=path, profile=build_dataset_profile(path))
+    except Exception as e:
+        return ProbeResult(path=path, error=e)
+
+
+def probe_dataset_paths(
+    paths: list[str], max_workers: int = DEFAULT_PROBE_WORKERS
+) -> dict[str, ProbeResult]:
+    """Profile all given data paths concurrently on a thread pool. Profiles
+    are stored in the shared profile cache and paths already profiled are
+    not probed again."""
+    results = {}
+    keys = {}
+    pending = []
+    for path in dict.fromkeys(paths):
+        keys[path] = dataset_profile_key(path)
+        profile = _PROFILE_CACHE.get(keys[path])
+        if profile is not None:
+            results[path] = ProbeResult(path=path, profile=profile)
+        else:
+            pending.append(path)
+
+    if pending:
+        logger.debug(f"Probing {len(pending)} data paths")
+    with ThreadPoolExecutor(max_workers=max_workers) as threads:
+        probe_results = list(threads.map(_probe, pending))
+
+    for result in probe_results:
+        if result.profile is not None:
+            _PROFILE_CACHE.put(keys[result.path], result.profile)
+        results[result.path] = result
+    return {path: results[path] for path in dict.fromkeys(paths)}
+
+
+def shard_signature(profile: DatasetProfile) -> tuple:
+    """What shards of one dataset must agree on to be processed the same way"""
+    return (str(profile.format), tuple(sorted(profile.columns)))
+
+
+# (shard profile key, reference signature) -> whether the shard matches
+_CONSISTENCY_CACHE = LRUCache(maxsize=SHARD_CONSISTENCY_CACHE_SIZE)
+
+
+def find_inconsistent_shards(
+    data_paths: list[str], max_workers: int = DEFAULT_PROBE_WORKERS
+) -> list[str]:
+    """Return the data paths whose sampled schema does not match the first
+    data path. Verdicts are cached per shard version, so unchanged shards are
+    neither probed nor compared again."""
+    if len(data_paths) < 2:
+        return []
+    reference = probe_dataset_paths(data_paths[:1], max_workers)[data_paths[0]]
+    signature = shard_signature(reference.unwrap())
+
+    verdicts = {}
+    unchecked = []
+    for path in dict.fromkeys(data_paths[1:]):
+        verdict = _CONSISTENCY_CACHE.get((dataset_profile_key(path), signature))
+        if verdict is None:
+            unchecked.append(path)
+        else:
+            verdicts[path] = verdict
+
+    for path, result in probe_dataset_paths(unchecked, max_workers).items():
+        if result.error is not None:
+            logger.warning(f"Failed to probe shard {path}: {result.error}")
+            verdicts[path] = False
+            continue
+        verdicts[path] = shard_signature(result.profile) == signature
+        _CONSISTENCY_CACHE.put((dataset_profile_key(path), signature), verdicts[path])
+
+    return [path for path in dict.fromkeys(data_paths[1:]) if not verdicts[path]]
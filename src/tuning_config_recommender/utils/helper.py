@@ -1,16 +1,107 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from tuning_config_recommender.constants import CACHE_DIR_ENV_VAR
+
+
+def user_cache_dir(name: str) -> Path:
+    """Folder of the named cache under the user cache dir, which is
+    $TUNING_CONFIG_RECOMMENDER_CACHE_DIR when set and else
+    $XDG_CACHE_HOME/tuning_config_recommender or ~/.cache/tuning_config_recommender"""
+    root = os.environ.get(CACHE_DIR_ENV_VAR)
+    if not root:
+        xdg_cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+            "~/.cache"
+        )
+        root = os.path.join(xdg_cache_home, "tuning_config_recommender")
+    return Path(root) / name
+
+
+def patch_op_key(op: dict) -> tuple:
+    """Hashable canonical form of a JSON patch op. Values are compared by
+    their canonical JSON, so equal ops built from different dicts match."""
+    value = (
+        json.dumps(op["value"], sort_keys=True, separators=(",", ":"), default=str)
+        if "value" in op
+        else None
+    )
+    return op.get("op"), op.get("path"), op.get("from"), value
+
+
+class PatchIndex:
+    """Set of JSON patch ops indexed by path for constant time membership"""
+
+    def __init__(self, ops=()):
+        self._by_path: dict[str, set[tuple]] = {}
+        self.update(ops)
+
+    def add(self, op: dict):
+        self._by_path.setdefault(op.get("path"), set()).add(patch_op_key(op))
+
+    def update(self, ops):
+        for op in ops:
+            self.add(op)
+
+    def __contains__(self, op: dict) -> bool:
+        keys = self._by_path.get(op.get("path"))
+        return keys is not None and patch_op_key(op) in keys
+
+    def covers(self, ops) -> bool:
+        return all(op in self for op in ops)
+
+    def paths(self) -> list[str]:
+        return list(self._by_path)
+
+
 def set_difference(l1, l2):
-    # l1 - l2
-    diff = []
-    for d1 in l1:
-        if d1 not in l2:
-            diff.append(d1)
-    return diff
+    # l1 - l2 over JSON patch ops, keeps the order of l1
+    index = PatchIndex(l2)
+    return [d1 for d1 in l1 if d1 not in index]
 
 
 def set_issubset(l1, l2):
     # if l2 is subset of l1
-    issubset = True
-    for item in l2:
-        if item not in l1:
-            return False
-    return issubset
+    return PatchIndex(l1).covers(l2)
+
+
+class LRUCache:
+    """Thread safe mapping bounded to maxsize entries, evicting the least
+    recently used entry first."""
+
+    def __init__(self, maxsize: int = 128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
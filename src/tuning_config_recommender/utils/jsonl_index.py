@@ -0,0 +1,170 @@
+import hashlib
+import json
+import mmap
+import os
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+from tuning_config_recommender.utils.helper import user_cache_dir
+
+INDEX_DIR = user_cache_dir("jsonl_index")
+
+# bytes scanned per step while building the index
+_SCAN_CHUNK_SIZE = 64 * 1024 * 1024
+# bytes hashed at the head and the tail of a file to check a persisted index
+# against, catching rewrites keeping the size and mtime
+_CHECK_BLOCK_SIZE = 64 * 1024
+# bytes a line made of only these is blank, as for bytes.strip()
+_WHITESPACE = np.frombuffer(b" \t\n\r\x0b\x0c", dtype=np.uint8)
+
+
+@dataclass(frozen=True)
+class JsonlIndex:
+    """Start and end byte offsets of every non blank line of a JSONL file"""
+
+    path: str
+    size: int
+    mtime_ns: int
+    # hash of the head and tail blocks of the file, see head_tail_digest
+    digest: str
+    starts: np.ndarray
+    ends: np.ndarray
+
+    @property
+    def num_records(self) -> int:
+        return len(self.starts)
+
+
+def _index_file_for(path: str) -> Path:
+    return INDEX_DIR / (hashlib.sha256(path.encode("utf-8")).hexdigest() + ".npz")
+
+
+def head_tail_digest(path: str, size: int) -> str:
+    """Hash of the first and last blocks of a file, cheap at any file size"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        digest.update(f.read(_CHECK_BLOCK_SIZE))
+        if size > _CHECK_BLOCK_SIZE:
+            f.seek(max(size - _CHECK_BLOCK_SIZE, _CHECK_BLOCK_SIZE))
+            digest.update(f.read(_CHECK_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def _non_blank_lines(data: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    """Mask of the lines holding anything but whitespace. Only the rare lines
+    starting with whitespace are checked byte by byte."""
+    non_empty = ends > starts
+    leading_whitespace = np.zeros_like(non_empty)
+    leading_whitespace[non_empty] = np.isin(data[starts[non_empty]], _WHITESPACE)
+    keep = non_empty & ~leading_whitespace
+    for line in np.flatnonzero(leading_whitespace):
+        keep[line] = bool(data[starts[line] : ends[line]].tobytes().strip())
+    return keep
+
+
+def build_jsonl_index(path: str) -> JsonlIndex:
+    """Scan a memory mapped JSONL file for newlines with numpy"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    digest = head_tail_digest(path, stat.st_size)
+    starts = ends = np.empty(0, dtype=np.int64)
+    keep = np.empty(0, dtype=bool)
+    if stat.st_size:
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm,
+        ):
+            data = np.frombuffer(mm, dtype=np.uint8)
+            newlines = [
+                np.flatnonzero(data[offset : offset + _SCAN_CHUNK_SIZE] == ord("\n"))
+                + offset
+                for offset in range(0, stat.st_size, _SCAN_CHUNK_SIZE)
+            ]
+            newlines = np.concatenate(newlines)
+            starts = np.concatenate(([0], newlines + 1)).astype(np.int64)
+            ends = np.concatenate((newlines, [stat.st_size])).astype(np.int64)
+            # drop blank lines, mainly the one after the trailing newline
+            keep = _non_blank_lines(data, starts, ends)
+            del data
+    return JsonlIndex(
+        path=path,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        digest=digest,
+        starts=starts[keep],
+        ends=ends[keep],
+    )
+
+
+def _load_persisted_index(path: str, stat: os.stat_result) -> JsonlIndex | None:
+    index_file = _index_file_for(path)
+    if not index_file.exists():
+        return None
+    try:
+        with np.load(index_file) as stored:
+            meta = json.loads(str(stored["meta"]))
+            if (
+                meta["size"] != stat.st_size
+                or meta["mtime_ns"] != stat.st_mtime_ns
+                or meta.get("digest") != head_tail_digest(path, stat.st_size)
+            ):
+                return None
+            return JsonlIndex(
+                path=path,
+                size=meta["size"],
+                mtime_ns=meta["mtime_ns"],
+                digest=meta["digest"],
+                starts=stored["starts"],
+                ends=stored["ends"],
+            )
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable JSONL index {index_file}: {e}")
+        return None
+
+
+def _persist_index(index: JsonlIndex):
+    index_file = _index_file_for(index.path)
+    meta = {"size": index.size, "mtime_ns": index.mtime_ns, "digest": index.digest}
+    try:
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        tmp_file = index_file.with_suffix(f".{os.getpid()}.tmp.npz")
+        np.savez(tmp_file, starts=index.starts, ends=index.ends, meta=json.dumps(meta))
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        logger.warning(f"Could not persist JSONL index for {index.path}: {e}")
+
+
+def get_jsonl_index(path: str) -> JsonlIndex:
+    """Fetch the persisted index of a JSONL file, rebuilding it when the file
+    changed since it was indexed, by its size, mtime or head and tail blocks"""
+    path = os.path.abspath(path)
+    index = _load_persisted_index(path, os.stat(path))
+    if index is None:
+        logger.debug(f"Building JSONL index for {path}")
+        index = build_jsonl_index(path)
+        _persist_index(index)
+    return index
+
+
+def count_jsonl_records(path: str) -> int:
+    """Exact number of records of a JSONL file, without parsing any JSON"""
+    return get_jsonl_index(path).num_records
+
+
+def sample_jsonl_records(path: str, num_samples: int, seed: int = 0) -> list[dict]:
+    """Uniform random sample of records using one seek per sampled record"""
+    index = get_jsonl_index(path)
+    rows = random.Random(seed).sample(
+        range(index.num_records), min(num_samples, index.num_records)
+    )
+    records = []
+    with open(path, "rb") as f:
+        for row in rows:
+            f.seek(int(index.starts[row]))
+            line = f.read(int(index.ends[row] - index.starts[row]))
+            records.append(json.loads(line))
+    return records
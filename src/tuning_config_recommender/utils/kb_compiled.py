@@ -0,0 +1,180 @@
+import json
+import os
+from collections.abc import Callable
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+# bumped whenever the layout of the artifact changes
+COMPILED_KB_FORMAT = 2
+
+_FORMAT_KEY = b"kb_format"
+# hashes of the source files by name
+_SOURCES_KEY = b"kb_sources"
+# (size, mtime) of the source files by name, None for missing ones
+_SOURCE_STATS_KEY = b"kb_source_stats"
+_VERSION_KEY = b"kb_version"
+# top level keys of the KB in file order, and those not in the flat table
+_KB_KEYS_KEY = b"kb_keys"
+_KB_REST_KEY = b"kb_rest"
+
+# columns of the flat KB table, the payload as JSON, kb_key is the top level
+# key of the KB the row was flattened from
+KB_TABLE_SCHEMA = pa.schema(
+    [
+        ("model_pattern", pa.string()),
+        ("section", pa.string()),
+        ("payload", pa.string()),
+        ("priority", pa.int64()),
+        ("kb_key", pa.string()),
+    ]
+)
+# top level keys of the KB flattened into the table
+_TABLE_KB_KEYS = ("general_defaults", "models")
+# record batches of the artifact, both have all columns and leave those of
+# the other one null
+_KB_BATCH = 0
+_RUN_DATA_BATCH = 1
+
+
+def _kb_key(kb: dict, row: dict) -> str:
+    defaults = kb.get("general_defaults", {})
+    if (
+        row["model_pattern"] == "*"
+        and row["section"] in defaults
+        and defaults[row["section"]] is row["payload"]
+    ):
+        return "general_defaults"
+    return "models"
+
+
+def _batch(schema: pa.Schema, columns: dict[str, pa.Array], num_rows: int):
+    return pa.RecordBatch.from_arrays(
+        [
+            columns[field.name]
+            if field.name in columns
+            else pa.nulls(num_rows, field.type)
+            for field in schema
+        ],
+        schema=schema,
+    )
+
+
+def write_compiled_kb(
+    path: str | Path,
+    kb: dict,
+    table: list[dict],
+    run_data: pd.DataFrame,
+    source_digests: dict[str, str | None],
+    source_stats: dict[str, tuple | None],
+    version: str,
+):
+    """Write the KB as one Arrow IPC file: a record batch of the flat KB
+    table, one of the tuning run data, and in the schema metadata the rest of
+    the KB and the hashes and stats of the source files it was built from"""
+    run_table = pa.Table.from_pandas(run_data, preserve_index=False)
+    overlap = set(run_table.column_names) & set(KB_TABLE_SCHEMA.names)
+    if overlap:
+        raise ValueError(f"Tuning run data columns {sorted(overlap)} are reserved")
+    kb_columns = {
+        "model_pattern": pa.array([row["model_pattern"] for row in table], pa.string()),
+        "section": pa.array([row["section"] for row in table], pa.string()),
+        "payload": pa.array([json.dumps(row["payload"]) for row in table], pa.string()),
+        "priority": pa.array([row["priority"] for row in table], pa.int64()),
+        "kb_key": pa.array([_kb_key(kb, row) for row in table], pa.string()),
+    }
+    run_columns = {
+        name: run_table.column(name).combine_chunks() for name in run_table.column_names
+    }
+    schema = pa.schema([*KB_TABLE_SCHEMA, *run_table.schema]).with_metadata(
+        {
+            _FORMAT_KEY: str(COMPILED_KB_FORMAT).encode(),
+            _SOURCES_KEY: json.dumps(source_digests, sort_keys=True).encode(),
+            _SOURCE_STATS_KEY: json.dumps(source_stats, sort_keys=True).encode(),
+            _VERSION_KEY: version.encode(),
+            _KB_KEYS_KEY: json.dumps(list(kb)).encode(),
+            _KB_REST_KEY: json.dumps(
+                {k: v for k, v in kb.items() if k not in _TABLE_KB_KEYS}
+            ).encode(),
+        }
+    )
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_batch(_batch(schema, kb_columns, len(table)))
+            writer.write_batch(_batch(schema, run_columns, run_table.num_rows))
+    os.replace(tmp_path, path)
+    logger.info(f"Compiled KB version {version} to {path}")
+
+
+def _read_kb(batch: pa.RecordBatch, metadata: dict) -> tuple[dict, list[dict]]:
+    """Flat KB table and the KB it was flattened from. Models without any
+    section have no rows and are left out of the KB."""
+    columns = {name: batch.column(name).to_pylist() for name in KB_TABLE_SCHEMA.names}
+    table = []
+    flattened = {key: {} for key in _TABLE_KB_KEYS}
+    for pattern, section, payload, priority, kb_key in zip(
+        *columns.values(), strict=True
+    ):
+        payload = json.loads(payload)
+        table.append(
+            {
+                "model_pattern": pattern,
+                "section": section,
+                "payload": payload,
+                "priority": priority,
+            }
+        )
+        if kb_key == "general_defaults":
+            flattened[kb_key][section] = payload
+        else:
+            flattened[kb_key].setdefault(pattern, {})[section] = payload
+    rest = json.loads(metadata[_KB_REST_KEY])
+    kb = {
+        key: rest[key] if key in rest else flattened[key]
+        for key in json.loads(metadata[_KB_KEYS_KEY])
+    }
+    return kb, table
+
+
+def _stats(stats: dict[str, tuple | None]) -> dict[str, list | None]:
+    # as they come back from JSON
+    return json.loads(json.dumps(stats))
+
+
+def read_compiled_kb(
+    path: str | Path,
+    source_stats: dict[str, tuple | None],
+    source_digests: Callable[[], dict[str, str | None]],
+) -> tuple[str, dict, list[dict], pa.RecordBatch] | None:
+    """Memory map the compiled KB and return (version, kb, table, run data),
+    None when there is none or it was not built from the current sources.
+    The sources are only hashed when their stats differ from those they had
+    when compiled. The run data columns are served from the memory map."""
+    if not os.path.isfile(path):
+        return None
+    try:
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            metadata = reader.schema.metadata or {}
+            if metadata.get(_FORMAT_KEY) != str(COMPILED_KB_FORMAT).encode():
+                logger.warning(f"Ignoring compiled KB {path} of another format")
+                return None
+            if (
+                json.loads(metadata[_SOURCE_STATS_KEY]) != _stats(source_stats)
+                and json.loads(metadata[_SOURCES_KEY]) != source_digests()
+            ):
+                logger.info(f"Compiled KB {path} is stale, reading the KB sources")
+                return None
+            kb, table = _read_kb(reader.get_batch(_KB_BATCH), metadata)
+            run_data = reader.get_batch(_RUN_DATA_BATCH)
+            run_data = run_data.drop_columns(KB_TABLE_SCHEMA.names)
+    except Exception as e:
+        logger.warning(f"Could not read compiled KB {path}: {e}")
+        return None
+    logger.debug(f"Loaded compiled KB {path}")
+    return metadata[_VERSION_KEY].decode(), kb, table, run_data
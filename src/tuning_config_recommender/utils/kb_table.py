@@ -1,33 +1,49 @@
 import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import math
+import os
+import re
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import yaml
+from loguru import logger
 
-_KB = None
-_KB_TABLE = None
+from tuning_config_recommender.constants import (
+    COMPILED_KB_ENV_VAR,
+    KB_QUERY_CACHE_SIZE,
+    KB_WATCH_INTERVAL,
+)
+from tuning_config_recommender.utils.helper import LRUCache
+from tuning_config_recommender.utils.kb_compiled import (
+    read_compiled_kb,
+    write_compiled_kb,
+)
+from tuning_config_recommender.utils.run_history import run_aggregates_path
 
+KB_DIR = Path(__file__).resolve().parents[1] / "knowledge_base"
+KB_PATH = KB_DIR / "knowledge_base.yaml"
+TUNING_RUN_DATA_PATH = KB_DIR / "tuning_run_data.csv"
+# the files above compiled by compile_kb, used while they are unchanged,
+# $TUNING_CONFIG_RECOMMENDER_COMPILED_KB points elsewhere
+COMPILED_KB_PATH = KB_DIR / "knowledge_base.arrow"
 
-def _load_kb_yaml():
-    """
-    Load the knowledge base YAML once.
-    """
-    global _KB
-    if _KB is not None:
-        return _KB
-
-    recommender_root = Path(__file__).resolve().parents[1]
-    kb_path = recommender_root / "knowledge_base" / "knowledge_base.yaml"
-
-    if not kb_path.exists():
-        raise FileNotFoundError(f"KB not found: {kb_path}")
-
-    with open(kb_path, encoding="utf-8") as f:
-        _KB = yaml.safe_load(f) or {}
+# characters that make a model pattern a glob rather than an exact name
+_GLOB_CHARS = re.compile(r"[*?[]")
+_NOT_CACHED = object()
 
-    return _KB
 
-
-def _build_kb_table():
+def _flatten_kb(kb: dict) -> list[dict]:
     """
     Convert KB YAML into a flat table:
     [
@@ -39,11 +55,6 @@ def _build_kb_table():
         }
     ]
     """
-    global _KB_TABLE
-    if _KB_TABLE is not None:
-        return _KB_TABLE
-
-    kb = _load_kb_yaml()
     table = []
 
     for section, payload in kb.get("general_defaults", {}).items():
@@ -69,22 +80,387 @@ def _build_kb_table():
             )
 
     table.sort(key=lambda r: r["priority"])
-    _KB_TABLE = table
     return table
 
 
+class KBIndex:
+    """
+    Lookup structure over the flat KB table. Per section, exact model names
+    are kept in a hash map and glob patterns as compiled regexes in priority
+    order, results are memoized per (model, section). A query returns the
+    same row as the first match of a scan over the table in priority order.
+    """
+
+    def __init__(self, table: list[dict]):
+        # rows are ranked by their position in the table, which is sorted by
+        # priority and keeps the KB order of rows with equal priority
+        # section -> {model name: (rank, row)} of the first row of each name
+        self.exact: dict[str, dict[str, tuple[int, dict]]] = {}
+        # section -> [(rank, compiled pattern, row)] in rank order
+        self.globs: dict[str, list[tuple[int, re.Pattern, dict]]] = {}
+        for rank, row in enumerate(table):
+            pattern = os.path.normcase(row["model_pattern"])
+            if _GLOB_CHARS.search(pattern):
+                self.globs.setdefault(row["section"], []).append(
+                    (rank, re.compile(fnmatch.translate(pattern)), row)
+                )
+            else:
+                self.exact.setdefault(row["section"], {}).setdefault(
+                    pattern, (rank, row)
+                )
+        self._memo = LRUCache(maxsize=KB_QUERY_CACHE_SIZE)
+
+    def _find(self, model_name: str, section: str) -> dict | None:
+        model_name = os.path.normcase(model_name)
+        exact_rank, exact_row = self.exact.get(section, {}).get(
+            model_name, (math.inf, None)
+        )
+        for rank, regex, row in self.globs.get(section, []):
+            if rank > exact_rank:
+                break
+            if regex.match(model_name):
+                return row
+        return exact_row
+
+    def query(self, model_name: str, section: str):
+        key = (model_name, section)
+        row = self._memo.get(key, _NOT_CACHED)
+        if row is _NOT_CACHED:
+            row = self._find(model_name, section)
+            self._memo.put(key, row)
+        if row is None:
+            return {}, False
+        return row["payload"], row["model_pattern"] != "*"
+
+
+class TuningRunIndex:
+    """Tuning run data grouped by (model_name, method) into NumPy arrays
+    sorted by model_max_length, rows of equal length keep their file order"""
+
+    KEYS = ("model_name", "method")
+    # columns the batch size lookup reads
+    COLUMNS = ("per_device_train_batch_size", "model_max_length", "number_gpus")
+
+    def __init__(self, df: pd.DataFrame):
+        # (model_name, method) -> (sorted model_max_length, {column: values})
+        self.groups: dict[tuple, tuple[np.ndarray, dict[str, np.ndarray]]] = {}
+        if df.empty or not {*self.KEYS, "model_max_length"} <= set(df.columns):
+            return
+        self._group(
+            [pd.factorize(df[key]) for key in self.KEYS],
+            df["model_max_length"].to_numpy(dtype=np.float64),
+            {c: df[c].to_numpy() for c in self.COLUMNS if c in df.columns},
+        )
+
+    @classmethod
+    def from_arrow(cls, batch: pa.RecordBatch) -> "TuningRunIndex":
+        """Index over Arrow columns, e.g. those of the compiled KB, without
+        converting them to a DataFrame"""
+        index = cls(pd.DataFrame())
+        names = batch.schema.names
+        if batch.num_rows == 0 or not {*cls.KEYS, "model_max_length"} <= set(names):
+            return index
+        factorized = []
+        for key in cls.KEYS:
+            encoded = batch.column(key).dictionary_encode()
+            factorized.append(
+                (
+                    pc.fill_null(encoded.indices, -1).to_numpy(zero_copy_only=False),
+                    encoded.dictionary.to_pylist(),
+                )
+            )
+        index._group(
+            factorized,
+            pc.cast(batch.column("model_max_length"), pa.float64()).to_numpy(
+                zero_copy_only=False
+            ),
+            {
+                c: batch.column(c).to_numpy(zero_copy_only=False)
+                for c in cls.COLUMNS
+                if c in names
+            },
+        )
+        return index
+
+    def _group(
+        self,
+        factorized: list[tuple[np.ndarray, list]],
+        lengths: np.ndarray,
+        columns: dict[str, np.ndarray],
+    ):
+        """Group rows by the codes of the key columns, missing keys coded as
+        -1 are left out"""
+        (model_codes, model_names), (method_codes, methods) = factorized
+        rows = np.flatnonzero((model_codes >= 0) & (method_codes >= 0))
+        if not len(rows):
+            return
+        codes = model_codes[rows] * len(methods) + method_codes[rows]
+        # lexsort is stable, rows of equal length keep their file order
+        order = np.lexsort((lengths[rows], codes))
+        rows, codes = rows[order], codes[order]
+        bounds = [0, *(np.flatnonzero(np.diff(codes)) + 1), len(rows)]
+        for start, end in itertools.pairwise(bounds):
+            model, method = divmod(int(codes[start]), len(methods))
+            group = rows[start:end]
+            self.groups[(model_names[model], methods[method])] = (
+                lengths[group],
+                {c: values[group] for c, values in columns.items()},
+            )
+
+    def __contains__(self, key: tuple) -> bool:
+        return key in self.groups
+
+    def find_best_row(
+        self, model_name: str, method: str, target_length: int
+    ) -> dict | None:
+        """Values of the first row with model_max_length equal to the target,
+        else of the first row with the nearest smaller length"""
+        if (model_name, method) not in self.groups:
+            return None
+        lengths, columns = self.groups[(model_name, method)]
+        i = np.searchsorted(lengths, target_length, side="left")
+        if not (i < len(lengths) and lengths[i] == target_length):
+            if i == 0:
+                return None
+            i = np.searchsorted(lengths, lengths[i - 1], side="left")
+        return {c: values[i] for c, values in columns.items()}
+
+
+@dataclass(frozen=True)
+class KBSnapshot:
+    """Immutable state of the knowledge base files at one version. Reloads
+    build a new snapshot and swap it in, a snapshot is never modified."""
+
+    # hash over the content of the KB files
+    version: str
+    kb: dict
+    table: list[dict]
+    index: KBIndex
+    run_index: TuningRunIndex
+    # stat of the KB files the snapshot was read from
+    source_key: tuple
+
+
+def _kb_sources() -> tuple[Path, ...]:
+    # aggregates of ingested runs, looked up ahead of the tuning run data
+    return KB_PATH, TUNING_RUN_DATA_PATH, run_aggregates_path()
+
+
+def compiled_kb_path() -> Path:
+    """Path of the compiled KB, $TUNING_CONFIG_RECOMMENDER_COMPILED_KB when
+    set, e.g. when the package folder is read only"""
+    return Path(os.environ.get(COMPILED_KB_ENV_VAR) or COMPILED_KB_PATH)
+
+
+def _kb_source_key() -> tuple:
+    key = []
+    for path in _kb_sources():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            key.append(None)
+            continue
+        key.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def _source_stats(source_key: tuple) -> dict[str, tuple | None]:
+    return {
+        path.name: stat for path, stat in zip(_kb_sources(), source_key, strict=True)
+    }
+
+
+def _read_sources() -> tuple[dict[Path, bytes | None], dict[str, str | None], str]:
+    """Content of the KB files, their hashes by file name and the KB version"""
+    if not KB_PATH.exists():
+        raise FileNotFoundError(f"KB not found: {KB_PATH}")
+    contents = {
+        path: path.read_bytes() if path.is_file() else None for path in _kb_sources()
+    }
+    digests = {
+        path.name: hashlib.blake2b(content).hexdigest() if content is not None else None
+        for path, content in contents.items()
+    }
+    # same version as the file based knowledge_base_version of the cache
+    version = hashlib.blake2b(digest_size=16)
+    for name, digest in digests.items():
+        version.update(f"{name}:{digest}".encode())
+    return contents, digests, version.hexdigest()
+
+
+def _parse_sources(contents: dict[Path, bytes | None]):
+    kb_content, run_data_content, aggregates_content = contents.values()
+    kb = yaml.safe_load(kb_content) or {}
+    if run_data_content is None:
+        logger.warning(f"Tuning run data not found: {TUNING_RUN_DATA_PATH}")
+        run_data = pd.DataFrame()
+    else:
+        run_data = pd.read_csv(io.BytesIO(run_data_content))
+    if aggregates_content is not None:
+        # measured runs win ties with the static data as rows come first
+        aggregates = pd.read_parquet(io.BytesIO(aggregates_content))
+        if not aggregates.empty:
+            run_data = pd.concat([aggregates, run_data], ignore_index=True)
+    return kb, _flatten_kb(kb), run_data
+
+
+def build_kb_snapshot() -> KBSnapshot:
+    """Read, flatten and index the KB files into a new snapshot. The compiled
+    KB is loaded instead of parsing the files when it was built from them."""
+    source_key = _kb_source_key()
+    # the sources are only read when the compiled KB may be stale
+    read_sources = functools.cache(_read_sources)
+    compiled = read_compiled_kb(
+        compiled_kb_path(),
+        _source_stats(source_key),
+        lambda: read_sources()[1],
+    )
+    if compiled is not None:
+        version, kb, table, run_data = compiled
+        run_index = TuningRunIndex.from_arrow(run_data)
+    else:
+        contents, _, version = read_sources()
+        kb, table, run_data = _parse_sources(contents)
+        run_index = TuningRunIndex(run_data)
+    return KBSnapshot(
+        version=version,
+        kb=kb,
+        table=table,
+        index=KBIndex(table),
+        run_index=run_index,
+        source_key=source_key,
+    )
+
+
+def compile_kb(path: str | Path | None = None) -> Path:
+    """Build step compiling the KB files into the artifact build_kb_snapshot
+    loads while the files are unchanged"""
+    path = Path(path or compiled_kb_path())
+    source_stats = _source_stats(_kb_source_key())
+    contents, digests, version = _read_sources()
+    write_compiled_kb(path, *_parse_sources(contents), digests, source_stats, version)
+    return path
+
+
+_ACTIVE_SNAPSHOT: KBSnapshot | None = None
+_SNAPSHOT_LOCK = threading.Lock()
+# snapshot a run keeps using while newer ones are swapped in
+_PINNED_SNAPSHOT: ContextVar[KBSnapshot | None] = ContextVar(
+    "pinned_kb_snapshot", default=None
+)
+
+
+def get_kb_snapshot() -> KBSnapshot:
+    """Snapshot pinned by the current run, else the active one, which is
+    built on first use"""
+    snapshot = _PINNED_SNAPSHOT.get() or _ACTIVE_SNAPSHOT
+    if snapshot is None:
+        with _SNAPSHOT_LOCK:
+            if _ACTIVE_SNAPSHOT is None:
+                _swap_snapshot(build_kb_snapshot())
+            snapshot = _ACTIVE_SNAPSHOT
+    return snapshot
+
+
+def _swap_snapshot(snapshot: KBSnapshot):
+    global _ACTIVE_SNAPSHOT
+    _ACTIVE_SNAPSHOT = snapshot
+    logger.info(f"Using KB version {snapshot.version}")
+
+
+def reload_kb(force: bool = False) -> KBSnapshot:
+    """Build a snapshot of the KB files and make it the active one when its
+    content differs. Without force, files unchanged since the active snapshot
+    was read are not read again. Runs that pinned the previous snapshot keep
+    using it until they finish."""
+    with _SNAPSHOT_LOCK:
+        active = _ACTIVE_SNAPSHOT
+        if active is not None and not force:
+            if _kb_source_key() == active.source_key:
+                return active
+        snapshot = build_kb_snapshot()
+        if active is not None and snapshot.version == active.version:
+            # only the stat changed, keep the warm memo of the active index
+            return active
+        _swap_snapshot(snapshot)
+        return snapshot
+
+
+def clear_kb_snapshot():
+    global _ACTIVE_SNAPSHOT
+    with _SNAPSHOT_LOCK:
+        _ACTIVE_SNAPSHOT = None
+
+
+@contextmanager
+def pin_kb_snapshot():
+    """Use one KB snapshot for everything run within the block, including
+    work submitted to pools with a copy of the current context"""
+    snapshot = get_kb_snapshot()
+    token = _PINNED_SNAPSHOT.set(snapshot)
+    try:
+        yield snapshot
+    finally:
+        _PINNED_SNAPSHOT.reset(token)
+
+
+class KBWatcher:
+    """Daemon thread polling the stat of the KB files and reloading the KB
+    once they changed"""
+
+    def __init__(self, interval: float = KB_WATCH_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                reload_kb()
+            except Exception as e:
+                # keep serving the active snapshot, e.g. while a file is
+                # half written
+                logger.warning(f"Could not reload the KB: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="kb-watcher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+
+def _load_kb_yaml():
+    """
+    Load the knowledge base YAML of the current snapshot.
+    """
+    return get_kb_snapshot().kb
+
+
+def _build_kb_table():
+    """
+    Flat KB table of the current snapshot, see _flatten_kb.
+    """
+    return get_kb_snapshot().table
+
+
+def load_kb():
+    """Load, flatten and index the KB ahead of the first query"""
+    get_kb_snapshot()
+
+
 def query_kb(model_name: str, section: str):
     """
     Query KB table.
     Returns:
         (payload, found)
     """
-    table = _build_kb_table()
-
-    for row in table:
-        if row["section"] != section:
-            continue
-        if fnmatch.fnmatch(model_name, row["model_pattern"]):
-            return row["payload"], row["model_pattern"] != "*"
-
-    return {}, False
+    return get_kb_snapshot().index.query(model_name, section)
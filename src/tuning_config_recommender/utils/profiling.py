@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from loguru import logger
+
+
+@dataclass
+class Span:
+    """One timed region, exported as a Chrome trace complete event"""
+
+    name: str
+    category: str
+    start_ns: int
+    thread_id: int
+    args: dict = field(default_factory=dict)
+    wall_ns: int = 0
+    cpu_ns: int = 0
+    # peak traced allocation above the allocation at span start, None when
+    # memory was not traced or other spans were traced at the same time
+    peak_bytes: int | None = None
+    # process wide, so concurrent spans are counted in each other
+    io_read_bytes: int | None = None
+    io_write_bytes: int | None = None
+
+
+@dataclass
+class _Frame:
+    span: Span
+    base_bytes: int
+    # highest traced allocation seen, kept across nested spans which reset
+    # the tracemalloc peak for their own measurement
+    peak: int = 0
+
+
+# tracemalloc is process wide: it is started by the first profiler tracing
+# memory and stopped by the last one, and its peak is only reset by a span
+# while no other profiler or thread has traced spans open
+_TRACEMALLOC_LOCK = threading.Lock()
+_memory_profilers = 0
+_started_tracemalloc = False
+# thread id -> number of traced spans open on it
+_open_spans: dict[int, int] = {}
+
+
+def _acquire_tracemalloc():
+    global _memory_profilers, _started_tracemalloc
+    with _TRACEMALLOC_LOCK:
+        _memory_profilers += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracemalloc = True
+
+
+def _release_tracemalloc():
+    global _memory_profilers, _started_tracemalloc
+    with _TRACEMALLOC_LOCK:
+        _memory_profilers -= 1
+        if not _memory_profilers and _started_tracemalloc:
+            tracemalloc.stop()
+            _started_tracemalloc = False
+
+
+def _open_traced_span(thread_id: int) -> bool:
+    """Register a traced span of the thread, returns whether it has
+    tracemalloc to itself and so may reset and measure the peak"""
+    with _TRACEMALLOC_LOCK:
+        exclusive = (
+            _memory_profilers == 1
+            and tracemalloc.is_tracing()
+            and _open_spans.keys() <= {thread_id}
+        )
+        _open_spans[thread_id] = _open_spans.get(thread_id, 0) + 1
+        return exclusive
+
+
+def _close_traced_span(thread_id: int):
+    with _TRACEMALLOC_LOCK:
+        _open_spans[thread_id] -= 1
+        if not _open_spans[thread_id]:
+            del _open_spans[thread_id]
+
+
+def _io_counters() -> tuple[int, int] | None:
+    """Bytes read and written by the process so far, None where the
+    platform does not expose them"""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class Profiler:
+    """Collects spans of the code run while it is active. Profiling is off
+    unless a profiler is entered, spans opened outside of one cost a single
+    context variable lookup. Peak memory is traced with the process wide
+    tracemalloc, so it is only measured for spans that run while no other
+    profiler or thread has spans open, and tracing slows down all threads.
+
+        with Profiler() as profiler:
+            adapter.execute(...)
+        profiler.write_chrome_trace("trace.json")
+        print(profiler.summary())
+    """
+
+    def __init__(self, trace_memory: bool = True):
+        self.trace_memory = trace_memory
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+        self._origin_ns = time.perf_counter_ns()
+        self._token = None
+
+    def __enter__(self):
+        if self.trace_memory:
+            _acquire_tracemalloc()
+        self._token = _PROFILER.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        _PROFILER.reset(self._token)
+        if self.trace_memory:
+            _release_tracemalloc()
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        stack = _SPAN_STACK.get()
+        thread_id = threading.get_ident()
+        tracing = self.trace_memory and _open_traced_span(thread_id)
+        base_bytes = 0
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            base_bytes = current
+        span = Span(
+            name=name,
+            category=category,
+            start_ns=time.perf_counter_ns() - self._origin_ns,
+            thread_id=thread_id,
+            args=args,
+        )
+        frame = _Frame(span=span, base_bytes=base_bytes)
+        token = _SPAN_STACK.set((*stack, frame))
+        io_start = _io_counters()
+        cpu_start = time.thread_time_ns()
+        try:
+            yield span
+        finally:
+            span.cpu_ns = time.thread_time_ns() - cpu_start
+            span.wall_ns = time.perf_counter_ns() - self._origin_ns - span.start_ns
+            io_end = _io_counters()
+            if io_start and io_end:
+                span.io_read_bytes = io_end[0] - io_start[0]
+                span.io_write_bytes = io_end[1] - io_start[1]
+            if tracing:
+                frame.peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+                span.peak_bytes = max(frame.peak - frame.base_bytes, 0)
+                if stack:
+                    stack[-1].peak = max(stack[-1].peak, frame.peak)
+            if self.trace_memory:
+                _close_traced_span(thread_id)
+            _SPAN_STACK.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def chrome_trace(self) -> dict:
+        """Spans in the Chrome trace event format, loadable in Perfetto or
+        chrome://tracing"""
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": span.start_ns / 1000,
+                    "dur": span.wall_ns / 1000,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": {
+                        **{k: str(v) for k, v in span.args.items()},
+                        "cpu_ms": span.cpu_ns / 1e6,
+                        "peak_bytes": span.peak_bytes,
+                        "io_read_bytes": span.io_read_bytes,
+                        "io_write_bytes": span.io_write_bytes,
+                    },
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: str | Path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+        logger.info(f"Profile trace written to {path}")
+
+    def summary_rows(self) -> list[dict]:
+        """Spans aggregated per category and name, slowest first"""
+        rows = {}
+        for span in self.spans:
+            row = rows.setdefault(
+                (span.category, span.name),
+                {
+                    "category": span.category,
+                    "name": span.name,
+                    "calls": 0,
+                    "wall_ms": 0.0,
+                    "cpu_ms": 0.0,
+                    "peak_mib": 0.0,
+                    "io_read_mib": 0.0,
+                    "io_write_mib": 0.0,
+                },
+            )
+            row["calls"] += 1
+            row["wall_ms"] += span.wall_ns / 1e6
+            row["cpu_ms"] += span.cpu_ns / 1e6
+            row["peak_mib"] = max(row["peak_mib"], (span.peak_bytes or 0) / 2**20)
+            row["io_read_mib"] += (span.io_read_bytes or 0) / 2**20
+            row["io_write_mib"] += (span.io_write_bytes or 0) / 2**20
+        return sorted(rows.values(), key=lambda row: -row["wall_ms"])
+
+    def summary(self) -> str:
+        """Plain text table of summary_rows"""
+        rows = self.summary_rows()
+        header = (
+            f"{'category':<10} {'name':<40} {'calls':>5} {'wall ms':>10} "
+            f"{'cpu ms':>10} {'peak MiB':>9} {'read MiB':>9} {'write MiB':>9}"
+        )
+        lines = [header, "-" * len(header)]
+        for row in rows:
+            lines.append(
+                f"{row['category']:<10} {row['name'][:40]:<40} {row['calls']:>5} "
+                f"{row['wall_ms']:>10.1f} {row['cpu_ms']:>10.1f} "
+                f"{row['peak_mib']:>9.2f} {row['io_read_mib']:>9.2f} "
+                f"{row['io_write_mib']:>9.2f}"
+            )
+        return "\n".join(lines)
+
+
+_PROFILER: ContextVar[Profiler | None] = ContextVar("profiler", default=None)
+_SPAN_STACK: ContextVar[tuple] = ContextVar("profiler_span_stack", default=())
+
+
+def get_profiler() -> Profiler | None:
+    """Profiler active in this thread or task, if any"""
+    return _PROFILER.get()
+
+
+@contextmanager
+def profile_span(name: str, category: str, **args):
+    """Record the enclosed code as a span of the active profiler, does
+    nothing when profiling is off"""
+    profiler = _PROFILER.get()
+    if profiler is None:
+        yield None
+        return
+    with profiler.span(name, category, **args) as span:
+        yield span
@@ -0,0 +1,299 @@
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from loguru import logger
+
+from tuning_config_recommender.actions import (
+    IR,
+    REMOVE,
+    Comment,
+    PatchLevel,
+    PatchType,
+)
+from tuning_config_recommender.constants import (
+    RECOMMENDATION_CACHE_MAX_BYTES,
+    RECOMMENDATION_CACHE_SIZE,
+)
+from tuning_config_recommender.utils.dataset_profile import dataset_profile_key
+from tuning_config_recommender.utils.helper import LRUCache, user_cache_dir
+from tuning_config_recommender.utils.run_history import run_aggregates_path
+
+KB_DIR = Path(__file__).parent.parent / "knowledge_base"
+# files of the knowledge base the inbuilt actions look up, next to the
+# aggregates of the run history
+KB_FILES = [
+    KB_DIR / "knowledge_base.yaml",
+    KB_DIR / "tuning_run_data.csv",
+]
+CACHE_DIR = user_cache_dir("recommendations")
+# files of a local model folder the actions read
+MODEL_FILES = [
+    "config.json",
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+]
+# tags of the objects of a recommendation JSON has no type for
+_IR_TAG = "__ir__"
+_COMMENT_TAG = "__comment__"
+_ENUM_TAG = "__enum__"
+_TUPLE_TAG = "__tuple__"
+_REMOVE_TAG = "__remove__"
+_ENUMS = {cls.__name__: cls for cls in (PatchLevel, PatchType)}
+
+_FILE_DIGESTS = LRUCache(maxsize=256)
+
+
+def file_digest(path: str | Path) -> str | None:
+    """Content hash of a file, recomputed only when its size or mtime change"""
+    key = dataset_profile_key(str(path))
+    if key[1] is None:
+        return None
+    digest = _FILE_DIGESTS.get(key)
+    if digest is None:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "blake2b").hexdigest()
+        _FILE_DIGESTS.put(key, digest)
+    return digest
+
+
+def knowledge_base_version() -> str:
+    """Hash over the content of all knowledge base files"""
+    digest = hashlib.blake2b(digest_size=16)
+    for path in [*KB_FILES, run_aggregates_path()]:
+        digest.update(f"{path.name}:{file_digest(path)}".encode())
+    return digest.hexdigest()
+
+
+def action_set_fingerprint(action_classes: list[type]) -> list[str]:
+    """Name and source file hash of each action class in registration order,
+    so any change to an action module, custom ones included, is picked up"""
+    fingerprint = []
+    for action_cls in action_classes:
+        try:
+            source = file_digest(inspect.getsourcefile(action_cls))
+        except (OSError, TypeError):
+            source = None
+        fingerprint.append(
+            f"{action_cls.__module__}.{action_cls.__qualname__}:{source}"
+        )
+    return fingerprint
+
+
+def recommendation_key(
+    inputs: dict,
+    action_classes: list[type],
+    data_paths: list[str],
+    model_name_or_path: str,
+    kb_version: str | None = None,
+) -> str:
+    """Content address of a recommendation: canonical JSON of the adapter
+    inputs, the knowledge base version, the action set and fingerprints of
+    the datasets and of local model files. The version of the KB files is
+    used unless the version of the KB snapshot in use is given."""
+    model_files = []
+    if os.path.isdir(model_name_or_path):
+        model_files = [
+            file_digest(os.path.join(model_name_or_path, name)) for name in MODEL_FILES
+        ]
+    payload = {
+        "inputs": inputs,
+        "kb_version": kb_version or knowledge_base_version(),
+        "actions": action_set_fingerprint(action_classes),
+        "datasets": [
+            list(dataset_profile_key(path)) for path in dict.fromkeys(data_paths)
+        ],
+        "model_files": model_files,
+    }
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True, default=str).encode("utf-8"),
+        digest_size=20,
+    ).hexdigest()
+
+
+def _to_json(value):
+    """Tag the IRs, comments, patch enums, tuples and remove markers of a
+    recommendation so they survive a JSON round trip"""
+    if value is REMOVE:
+        return {_REMOVE_TAG: True}
+    if isinstance(value, IR):
+        return {_IR_TAG: {k: _to_json(v) for k, v in value.__dict__.items()}}
+    if isinstance(value, Comment):
+        return {_COMMENT_TAG: value.comment}
+    if isinstance(value, tuple(_ENUMS.values())):
+        return {_ENUM_TAG: [type(value).__name__, str(value)]}
+    if isinstance(value, tuple):
+        return {_TUPLE_TAG: [_to_json(v) for v in value]}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    return value
+
+
+def _from_json(obj: dict):
+    if _IR_TAG in obj:
+        # fields are restored as stored, bypassing the defaults of __post_init__
+        ir = IR()
+        ir.__dict__.update(obj[_IR_TAG])
+        return ir
+    if _COMMENT_TAG in obj:
+        return Comment(obj[_COMMENT_TAG])
+    if _ENUM_TAG in obj:
+        name, value = obj[_ENUM_TAG]
+        return _ENUMS[name](value)
+    if _TUPLE_TAG in obj:
+        return tuple(obj[_TUPLE_TAG])
+    if _REMOVE_TAG in obj:
+        return REMOVE
+    return obj
+
+
+def dump_recommendation(value) -> bytes:
+    return json.dumps(_to_json(value), separators=(",", ":")).encode("utf-8")
+
+
+def load_recommendation(data: bytes):
+    return json.loads(data, object_hook=_from_json)
+
+
+class RecommendationCache:
+    """Two tier cache of JSON encoded recommendations. The memory tier is a per
+    process LRU, the disk tier is shared by all processes using the same
+    cache_dir and trimmed to max_disk_bytes by evicting the least recently
+    used entries. Disk entries are stored per knowledge base version, so
+    processes on different versions do not drop each other's entries, those
+    of versions no longer in use are the least recently used and evicted
+    first. The memory tier is emptied once the knowledge base changes."""
+
+    def __init__(
+        self,
+        cache_dir: str | Path | None = CACHE_DIR,
+        memory_size: int = RECOMMENDATION_CACHE_SIZE,
+        max_disk_bytes: int = RECOMMENDATION_CACHE_MAX_BYTES,
+    ):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = LRUCache(maxsize=memory_size)
+        self._kb_version = None
+        # size of the disk tier, scanned once and then tracked across the
+        # writes of this process, writes of other processes are only seen
+        # when it is scanned again to evict entries
+        self._disk_bytes = None
+        self._disk_lock = threading.Lock()
+
+    def _entry(self, key: str) -> Path:
+        return self.cache_dir / self._kb_version / f"{key}.json"
+
+    def _entries(self):
+        return self.cache_dir.glob("*/*.json")
+
+    def _sync_kb_version(self):
+        """Switch to the entries of the current knowledge base version when it
+        changed since the last lookup"""
+        kb_version = knowledge_base_version()
+        if kb_version == self._kb_version:
+            return
+        if self._kb_version is not None:
+            logger.info("Knowledge base changed, invalidating recommendations")
+            self._memory.clear()
+        self._kb_version = kb_version
+
+    def get(self, key: str):
+        self._sync_kb_version()
+        data = self._memory.get(key)
+        if data is None and self.cache_dir is not None:
+            entry = self._entry(key)
+            try:
+                data = entry.read_bytes()
+                # mtime orders entries for eviction
+                os.utime(entry)
+            except FileNotFoundError:
+                return None
+            except OSError as e:
+                logger.warning(f"Ignoring unreadable cached recommendation: {e}")
+                return None
+            self._memory.put(key, data)
+        if data is None:
+            return None
+        try:
+            return load_recommendation(data)
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cached recommendation: {e}")
+            self._memory.pop(key)
+            return None
+
+    def put(self, key: str, value):
+        self._sync_kb_version()
+        try:
+            data = dump_recommendation(value)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Not caching recommendation {key}: {e}")
+            return
+        self._memory.put(key, data)
+        if self.cache_dir is None:
+            return
+        entry = self._entry(key)
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                replaced = entry.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            # unique per writer, threads of one process may store the same key
+            tmp_file = entry.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_file.write_bytes(data)
+            os.replace(tmp_file, entry)
+            with self._disk_lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = self._disk_usage()
+                else:
+                    self._disk_bytes += len(data) - replaced
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict()
+        except OSError as e:
+            logger.warning(f"Could not persist recommendation {key}: {e}")
+
+    def _stat_entries(self) -> list[tuple[int, int, Path]]:
+        entries = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+        return entries
+
+    def _disk_usage(self) -> int:
+        return sum(size for _, size, _ in self._stat_entries())
+
+    def _evict(self):
+        entries = self._stat_entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+            if entry.parent.name != self._kb_version:
+                # drop the folders of versions no longer in use once empty
+                with contextlib.suppress(OSError):
+                    entry.parent.rmdir()
+        self._disk_bytes = total
+
+    def invalidate(self):
+        """Drop every cached recommendation of all knowledge base versions
+        from both tiers"""
+        self._memory.clear()
+        if self.cache_dir is None or not self.cache_dir.exists():
+            return
+        for entry in self._entries():
+            entry.unlink(missing_ok=True)
+        with self._disk_lock:
+            self._disk_bytes = None
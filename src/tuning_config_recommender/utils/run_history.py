@@ -0,0 +1,331 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from loguru import logger
+
+from tuning_config_recommender.constants import RUN_HISTORY_DIR_ENV_VAR
+from tuning_config_recommender.utils.helper import user_cache_dir
+
+# compact per (model, method, length) summary the batch size lookup reads
+AGGREGATES_FILE = "aggregates.parquet"
+PARTITION_COLUMNS = ["model_name", "method"]
+# columns of a run, the first ones are those of tuning_run_data.csv
+RUN_COLUMNS = [
+    "model_name",
+    "method",
+    "number_nodes",
+    "model_max_length",
+    "batch_size",
+    "per_device_train_batch_size",
+    "gpu_model",
+    "number_gpus",
+    "dollars_per_million_tokens",
+    "gpu_hours_per_million_tokens",
+    "dataset_tokens_per_second",
+    "gpu_memory_utilization_max",
+    "train_samples_per_second",
+    "experiment_id",
+    "train_runtime",
+    "train_loss",
+    "ingested_at",
+]
+# columns of the aggregates, the batch size lookup reads the first ones
+AGGREGATE_COLUMNS = [
+    "model_name",
+    "method",
+    "model_max_length",
+    "per_device_train_batch_size",
+    "number_gpus",
+    "number_nodes",
+    "dataset_tokens_per_second",
+    "train_samples_per_second",
+    "num_runs",
+]
+# config files of a run, as written by the recommender or dumped by the job
+CONFIG_FILES = ["tuning_config.yaml", "training_args.json"]
+# HF Trainer metric files written next to trainer_state.json
+METRICS_FILES = ["train_results.json", "all_results.json"]
+# optional file of a run overriding any of the parsed run columns
+RUN_METADATA_FILE = "run_metadata.json"
+
+
+def run_history_dir() -> Path:
+    """Folder of the run history store, $TUNING_CONFIG_RECOMMENDER_RUN_HISTORY_DIR
+    when set and else run_history under the user cache dir"""
+    return Path(
+        os.environ.get(RUN_HISTORY_DIR_ENV_VAR) or user_cache_dir("run_history")
+    )
+
+
+def run_aggregates_path() -> Path:
+    """Aggregates of the run history store the batch size lookup reads"""
+    return run_history_dir() / AGGREGATES_FILE
+
+
+def _read_structured(path: Path) -> dict:
+    if not path.is_file():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        content = yaml.safe_load(f) if path.suffix == ".yaml" else json.load(f)
+    return content if isinstance(content, dict) else {}
+
+
+def _checkpoint_step(path: Path) -> int:
+    step = path.name.removeprefix("checkpoint-")
+    return int(step) if step.isdigit() else -1
+
+
+def find_run_dirs(paths: list[str | Path]) -> list[Path]:
+    """Output folders of training runs under the given paths. A run is a
+    folder holding a trainer_state.json directly or in its checkpoints."""
+    runs = {}
+    for path in paths:
+        for state in sorted(Path(path).rglob("trainer_state.json")):
+            run_dir = state.parent
+            if run_dir.name.startswith("checkpoint-"):
+                run_dir = run_dir.parent
+            runs.setdefault(run_dir.resolve(), None)
+    return list(runs)
+
+
+def _trainer_state(run_dir: Path) -> dict:
+    """Final trainer state of a run, else the one of its latest checkpoint"""
+    if (run_dir / "trainer_state.json").is_file():
+        return _read_structured(run_dir / "trainer_state.json")
+    checkpoints = sorted(run_dir.glob("checkpoint-*"), key=_checkpoint_step)
+    for checkpoint in reversed(checkpoints):
+        if (checkpoint / "trainer_state.json").is_file():
+            return _read_structured(checkpoint / "trainer_state.json")
+    return {}
+
+
+def _experiment_id(run_dir: Path, config: dict, compute_config: dict) -> str:
+    """Folder name of a run followed by a hash of its output dir and configs.
+    Runs in folders of the same name but other configs do not collide, while
+    the id stays the same as the run progresses or its folder is moved."""
+    output_dir = Path(str(config.get("output_dir") or run_dir.name)).name
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(
+        json.dumps(
+            [output_dir, config, compute_config], sort_keys=True, default=str
+        ).encode()
+    )
+    return f"{run_dir.name}-{digest.hexdigest()}"
+
+
+def _train_loss_from_logs(run_dir: Path) -> float | None:
+    """Last training loss logged by fms-hf-tuning to training_logs.jsonl"""
+    path = run_dir / "training_logs.jsonl"
+    if not path.is_file():
+        return None
+    loss = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get("name") == "training_loss":
+                loss = entry.get("data", {}).get("value", loss)
+    return loss
+
+
+def parse_run_dir(run_dir: str | Path, gpu_hour_cost: float | None = None) -> dict:
+    """Parse the outputs of an fms-hf-tuning or HF Trainer run into a record
+    of RUN_COLUMNS. Metrics come from trainer_state.json, the metric files
+    and training_logs.jsonl, the configuration from the config files."""
+    run_dir = Path(run_dir)
+    config = {}
+    for name in CONFIG_FILES:
+        config = {**_read_structured(run_dir / name), **config}
+    compute_config = _read_structured(run_dir / "compute_config.yaml")
+    state = _trainer_state(run_dir)
+    metrics = {}
+    for entry in state.get("log_history", []):
+        if "train_runtime" in entry:
+            metrics.update(entry)
+    for name in METRICS_FILES:
+        metrics.update(_read_structured(run_dir / name))
+
+    model_name_or_path = str(
+        config.get("original_model_name_or_path")
+        or config.get("model_name_or_path")
+        or ""
+    )
+    number_nodes = compute_config.get("num_nodes", 1)
+    number_gpus = compute_config.get("num_gpus_per_node")
+    if number_gpus is not None:
+        number_gpus *= number_nodes
+    per_device_train_batch_size = config.get(
+        "per_device_train_batch_size", state.get("train_batch_size")
+    )
+    batch_size = None
+    if per_device_train_batch_size and number_gpus:
+        batch_size = (
+            per_device_train_batch_size
+            * number_gpus
+            * config.get("gradient_accumulation_steps", 1)
+        )
+    tokens_per_second = metrics.get("train_tokens_per_second")
+    gpu_hours_per_million_tokens = None
+    if tokens_per_second and number_gpus:
+        gpu_hours_per_million_tokens = number_gpus * 1e6 / tokens_per_second / 3600
+    record = {
+        "model_name": model_name_or_path.rstrip("/").split("/")[-1],
+        "method": config.get("tuning_strategy")
+        or ("lora" if config.get("peft_method") == "lora" else "full"),
+        "number_nodes": number_nodes,
+        "model_max_length": config.get("max_seq_length"),
+        "batch_size": batch_size,
+        "per_device_train_batch_size": per_device_train_batch_size,
+        "gpu_model": None,
+        "number_gpus": number_gpus,
+        "dollars_per_million_tokens": (
+            gpu_hours_per_million_tokens * gpu_hour_cost
+            if gpu_hours_per_million_tokens and gpu_hour_cost
+            else None
+        ),
+        "gpu_hours_per_million_tokens": gpu_hours_per_million_tokens,
+        "dataset_tokens_per_second": tokens_per_second,
+        "gpu_memory_utilization_max": None,
+        "train_samples_per_second": metrics.get("train_samples_per_second"),
+        "experiment_id": _experiment_id(run_dir, config, compute_config),
+        "train_runtime": metrics.get("train_runtime"),
+        "train_loss": metrics.get("train_loss", _train_loss_from_logs(run_dir)),
+    }
+    record.update(
+        (k, v)
+        for k, v in _read_structured(run_dir / RUN_METADATA_FILE).items()
+        if k in RUN_COLUMNS
+    )
+    record["experiment_id"] = str(record["experiment_id"])
+    return record
+
+
+def _to_frame(records: list[dict]) -> pd.DataFrame:
+    df = pd.DataFrame.from_records(records, columns=RUN_COLUMNS)
+    for column in RUN_COLUMNS:
+        if column in ("model_name", "method", "gpu_model", "experiment_id"):
+            df[column] = df[column].astype("string")
+        elif column != "ingested_at":
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
+    df["ingested_at"] = df["ingested_at"].astype("int64")
+    return df
+
+
+def aggregate_runs(runs: pd.DataFrame) -> pd.DataFrame:
+    """Best run per (model_name, method, model_max_length), picked by the
+    highest token throughput and then sample throughput, with the number of
+    runs seen. Runs missing what the batch size lookup needs are left out."""
+    runs = runs.dropna(subset=AGGREGATE_COLUMNS[:5])
+    if runs.empty:
+        return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+    keys = ["model_name", "method", "model_max_length"]
+    ranked = runs.sort_values(
+        ["dataset_tokens_per_second", "train_samples_per_second", "ingested_at"],
+        ascending=False,
+        na_position="last",
+        kind="stable",
+    )
+    best = ranked.drop_duplicates(keys)
+    counts = runs.groupby(keys).size().rename("num_runs").reset_index()
+    aggregates = best.merge(counts, on=keys)
+    return aggregates[AGGREGATE_COLUMNS].sort_values(
+        keys, kind="stable", ignore_index=True
+    )
+
+
+class RunHistoryStore:
+    """Append only store of runs as parquet files partitioned by model and
+    method. Runs are deduplicated by experiment_id on write, ingesting a run
+    again is a no op, and the aggregates are rewritten after every append."""
+
+    def __init__(self, root: str | Path | None = None):
+        self.root = Path(root) if root else run_history_dir()
+        self.runs_dir = self.root / "runs"
+        self.aggregates_path = self.root / AGGREGATES_FILE
+
+    @contextmanager
+    def _lock(self):
+        """Serialize writers across processes"""
+        # POSIX only, imported here to keep reading the store portable
+        import fcntl
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_runs(self, columns: list[str] | None = None) -> pd.DataFrame:
+        if not self.runs_dir.exists() or not any(self.runs_dir.rglob("*.parquet")):
+            return _to_frame([])[columns or RUN_COLUMNS]
+        df = pd.read_parquet(self.runs_dir, columns=columns)
+        for column in PARTITION_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].astype("string")
+        return df
+
+    def append(self, records: list[dict]) -> int:
+        """Write the runs not stored yet, returns how many were written"""
+        with self._lock():
+            stored = set(self.read_runs(["experiment_id"])["experiment_id"])
+            new = {}
+            for record in records:
+                if record["experiment_id"] not in stored:
+                    new[record["experiment_id"]] = record
+            if new:
+                ingested_at = time.time_ns()
+                df = _to_frame(
+                    [{**record, "ingested_at": ingested_at} for record in new.values()]
+                )
+                pq.write_to_dataset(
+                    pa.Table.from_pandas(df, preserve_index=False),
+                    root_path=str(self.runs_dir),
+                    partition_cols=PARTITION_COLUMNS,
+                    basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+                )
+            self.update_aggregates()
+        logger.info(f"Stored {len(new)} new runs of {len(records)} in {self.root}")
+        return len(new)
+
+    def read_aggregates(self) -> pd.DataFrame:
+        if not self.aggregates_path.exists():
+            return pd.DataFrame(columns=AGGREGATE_COLUMNS)
+        return pd.read_parquet(self.aggregates_path)
+
+    def update_aggregates(self):
+        aggregates = aggregate_runs(self.read_runs())
+        tmp_path = self.aggregates_path.with_name(
+            f".{self.aggregates_path.name}.{os.getpid()}.tmp"
+        )
+        aggregates.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.aggregates_path)
+
+
+def ingest_runs(
+    paths: list[str | Path],
+    root: str | Path | None = None,
+    gpu_hour_cost: float | None = None,
+) -> int:
+    """Parse all runs under the given paths into the run history store at
+    root, by default the one of run_history_dir, returns the number of new
+    runs"""
+    records = []
+    for run_dir in find_run_dirs(paths):
+        try:
+            records.append(parse_run_dir(run_dir, gpu_hour_cost))
+        except Exception as e:
+            logger.warning(f"Skipping run {run_dir}: {e}")
+    return RunHistoryStore(root).append(records)
@@ -0,0 +1,303 @@
+import hashlib
+import math
+import os
+from dataclasses import dataclass
+from enum import StrEnum, auto
+
+import numpy as np
+from loguru import logger
+
+from tuning_config_recommender.constants import (
+    DEFAULT_TOKEN_STATS_NUM_SAMPLES,
+    PADDING_STRATEGY_TIE_TOLERANCE,
+    TOKEN_STATS_CACHE_SIZE,
+    TOKENIZER_BATCH_SIZE,
+)
+from tuning_config_recommender.utils.data_processing import (
+    SamplingStrategy,
+    sample_training_data,
+)
+from tuning_config_recommender.utils.dataset_profile import (
+    DatasetFormat,
+    DatasetProfile,
+    dataset_profile_key,
+    get_dataset_profile,
+)
+from tuning_config_recommender.utils.helper import LRUCache
+
+# files that together define how a model tokenizes text
+TOKENIZER_FILES = [
+    "tokenizer.json",
+    "tokenizer_config.json",
+    "special_tokens_map.json",
+]
+
+
+@dataclass(frozen=True)
+class TokenLengthStats:
+    """Token lengths of a sample of training records"""
+
+    lengths: np.ndarray
+
+    @property
+    def num_samples(self) -> int:
+        return len(self.lengths)
+
+    def percentile(self, q: float) -> int:
+        return int(np.ceil(np.percentile(self.lengths, q)))
+
+    def truncation_rate(self, max_seq_length: int) -> float:
+        """Fraction of sampled records longer than max_seq_length"""
+        return float(np.mean(self.lengths > max_seq_length))
+
+    @classmethod
+    def merge(cls, stats: list["TokenLengthStats"]) -> "TokenLengthStats":
+        return cls(lengths=np.concatenate([s.lengths for s in stats]))
+
+
+def tokenizer_hash(model_name_or_path: str) -> str | None:
+    """Hash of the local tokenizer files, None when there is no tokenizer.json
+    to build a fast tokenizer from"""
+    if not os.path.isfile(os.path.join(model_name_or_path, "tokenizer.json")):
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    for filename in TOKENIZER_FILES:
+        path = os.path.join(model_name_or_path, filename)
+        if os.path.isfile(path):
+            digest.update(filename.encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+_TOKENIZER_CACHE = LRUCache(maxsize=4)
+
+
+def load_local_tokenizer(model_name_or_path: str, tokenizer_key: str):
+    tokenizer = _TOKENIZER_CACHE.get(tokenizer_key)
+    if tokenizer is None:
+        # transformers is slow to import and only needed once data is tokenized
+        from transformers import AutoTokenizer
+
+        tokenizer = AutoTokenizer.from_pretrained(
+            model_name_or_path, local_files_only=True, use_fast=True
+        )
+        _TOKENIZER_CACHE.put(tokenizer_key, tokenizer)
+    return tokenizer
+
+
+def warm_tokenizer_backend():
+    """Import transformers ahead of the first tokenization"""
+    from transformers import AutoTokenizer  # noqa: F401
+
+
+def _get_column(record: dict, column: str):
+    """Profiles hold lower cased template columns, records keep the original"""
+    if column in record:
+        return record[column]
+    return next((v for k, v in record.items() if k.lower() == column), "")
+
+
+def _render_chat(tokenizer, messages: list[dict]) -> tuple[str, bool]:
+    """Render a conversation with the model chat template when possible.
+    Returns the text and whether special tokens are already part of it."""
+    if getattr(tokenizer, "chat_template", None):
+        try:
+            return tokenizer.apply_chat_template(messages, tokenize=False), True
+        except Exception as e:
+            logger.debug(f"Falling back to plain chat rendering: {e}")
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages), False
+
+
+def _records_to_texts(
+    tokenizer, profile: DatasetProfile, records: list[dict]
+) -> tuple[list[str], bool]:
+    if profile.format == DatasetFormat.CHAT:
+        rendered = [
+            _render_chat(tokenizer, record[profile.chat_column]) for record in records
+        ]
+        has_special_tokens = any(templated for _, templated in rendered)
+        return [text for text, _ in rendered], has_special_tokens
+    if profile.format == DatasetFormat.QA:
+        # same layout as the template set by ApplyQAFormat
+        return [
+            f"### Input: {_get_column(record, profile.input_column)}\n\n"
+            f"### Response: {_get_column(record, profile.response_column)}"
+            for record in records
+        ], False
+    return [
+        " ".join(str(v) for v in record.values() if isinstance(v, str))
+        for record in records
+    ], False
+
+
+def _text_columns(profile: DatasetProfile) -> list[str] | None:
+    """Columns _records_to_texts reads, None when all of them are"""
+    if profile.format == DatasetFormat.TOKENIZED:
+        return ["input_ids"]
+    if profile.format == DatasetFormat.CHAT:
+        return [profile.chat_column]
+    if profile.format == DatasetFormat.QA:
+        return [profile.input_column, profile.response_column]
+    return None
+
+
+def _token_lengths(tokenizer, texts: list[str], add_special_tokens: bool):
+    lengths = []
+    for start in range(0, len(texts), TOKENIZER_BATCH_SIZE):
+        encoded = tokenizer(
+            texts[start : start + TOKENIZER_BATCH_SIZE],
+            add_special_tokens=add_special_tokens,
+            return_attention_mask=False,
+            return_token_type_ids=False,
+            return_length=True,
+            verbose=False,
+        )
+        lengths.extend(encoded["length"])
+    return np.asarray(lengths, dtype=np.int64)
+
+
+def compute_token_length_stats(
+    data_path: str,
+    model_name_or_path: str,
+    tokenizer_key: str,
+    num_samples: int = DEFAULT_TOKEN_STATS_NUM_SAMPLES,
+) -> TokenLengthStats | None:
+    """Tokenize a random sample of the dataset with batched tokenizer calls"""
+    profile = get_dataset_profile(data_path)
+    records = sample_training_data(
+        data_path,
+        num_samples=num_samples,
+        strategy=SamplingStrategy.RANDOM,
+        columns=_text_columns(profile),
+    )
+    records = [r for r in records if isinstance(r, dict)]
+    if not records:
+        return None
+    if profile.format == DatasetFormat.TOKENIZED:
+        lengths = [len(record.get("input_ids") or []) for record in records]
+        return TokenLengthStats(lengths=np.asarray(lengths, dtype=np.int64))
+    tokenizer = load_local_tokenizer(model_name_or_path, tokenizer_key)
+    texts, has_special_tokens = _records_to_texts(tokenizer, profile, records)
+    return TokenLengthStats(
+        lengths=_token_lengths(
+            tokenizer, texts, add_special_tokens=not has_special_tokens
+        )
+    )
+
+
+_TOKEN_STATS_CACHE = LRUCache(maxsize=TOKEN_STATS_CACHE_SIZE)
+
+
+def get_token_length_stats(
+    data_paths: list[str], model_name_or_path: str
+) -> TokenLengthStats | None:
+    """Token length statistics over all data paths for the model's tokenizer.
+    Statistics are cached per (dataset fingerprint, tokenizer hash), so they
+    are only recomputed when either the data or the tokenizer changes."""
+    tokenizer_key = tokenizer_hash(model_name_or_path)
+    if tokenizer_key is None:
+        logger.debug(f"No local fast tokenizer found in {model_name_or_path}")
+        return None
+    stats = []
+    for path in dict.fromkeys(data_paths):
+        key = (dataset_profile_key(path), tokenizer_key)
+        path_stats = _TOKEN_STATS_CACHE.get(key)
+        if path_stats is None:
+            logger.debug(f"Computing token length statistics for {path}")
+            path_stats = compute_token_length_stats(
+                path, model_name_or_path, tokenizer_key
+            )
+            if path_stats is None:
+                continue
+            _TOKEN_STATS_CACHE.put(key, path_stats)
+        stats.append(path_stats)
+    if not stats:
+        return None
+    return TokenLengthStats.merge(stats)
+
+
+def clear_token_stats_cache():
+    _TOKEN_STATS_CACHE.clear()
+    _TOKENIZER_CACHE.clear()
+
+
+class PaddingStrategy(StrEnum):
+    """How samples are laid out in a training step, in order of preference
+    when their estimates tie. Packing comes last as samples packed together
+    attend to each other unless attention is restricted per sample."""
+
+    PADDING_FREE = auto()
+    PADDING = auto()
+    PACKING = auto()
+
+
+@dataclass(frozen=True)
+class PaddingEstimate:
+    strategy: PaddingStrategy
+    # fraction of computed token positions that hold real tokens
+    useful_token_fraction: float
+    # fraction of sampled tokens that are trained on rather than truncated
+    token_coverage: float
+
+
+def estimate_padding_waste(
+    lengths: np.ndarray,
+    max_seq_length: int,
+    batch_size: int,
+    strategies: list[PaddingStrategy] | None = None,
+) -> dict[PaddingStrategy, PaddingEstimate]:
+    """Estimate useful token fractions of the padding strategies for samples
+    of the given token lengths batched in their sampled order. Padding pads
+    every batch to its longest sample, padding free computes only real tokens
+    and packing concatenates all samples into max_seq_length blocks."""
+    strategies = strategies or list(PaddingStrategy)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    total_tokens = int(lengths.sum())
+    kept = np.minimum(lengths, max_seq_length)
+    kept_tokens = int(kept.sum())
+    if not total_tokens:
+        return {}
+    coverage = kept_tokens / total_tokens
+
+    estimates = {}
+    if PaddingStrategy.PADDING in strategies:
+        num_batches = math.ceil(len(kept) / batch_size)
+        batches = np.zeros(num_batches * batch_size, dtype=np.int64)
+        batches[: len(kept)] = kept
+        batch_max = batches.reshape(num_batches, batch_size).max(axis=1)
+        batch_sizes = np.minimum(
+            batch_size, len(kept) - np.arange(num_batches) * batch_size
+        )
+        computed = int((batch_max * batch_sizes).sum())
+        estimates[PaddingStrategy.PADDING] = PaddingEstimate(
+            PaddingStrategy.PADDING, kept_tokens / computed, coverage
+        )
+    if PaddingStrategy.PADDING_FREE in strategies:
+        estimates[PaddingStrategy.PADDING_FREE] = PaddingEstimate(
+            PaddingStrategy.PADDING_FREE, 1.0, coverage
+        )
+    if PaddingStrategy.PACKING in strategies:
+        computed = math.ceil(total_tokens / max_seq_length) * max_seq_length
+        estimates[PaddingStrategy.PACKING] = PaddingEstimate(
+            PaddingStrategy.PACKING, total_tokens / computed, 1.0
+        )
+    return estimates
+
+
+def choose_padding_strategy(
+    estimates: dict[PaddingStrategy, PaddingEstimate],
+) -> PaddingEstimate:
+    """Pick the estimate with the highest useful token fraction, ties are
+    broken by token coverage and then by preference order"""
+    best = max(e.useful_token_fraction for e in estimates.values())
+    candidates = [
+        e
+        for e in estimates.values()
+        if best - e.useful_token_fraction <= PADDING_STRATEGY_TIE_TOLERANCE
+    ]
+    preference = list(PaddingStrategy)
+    return max(
+        candidates,
+        key=lambda e: (e.token_coverage, -preference.index(e.strategy)),
+    )
@@ -1,21 +1,42 @@
 import json
 import os
+from copy import deepcopy
 from pathlib import Path
 
-import pandas as pd
 import yaml
 
-from tuning_config_recommender.utils.kb_table import query_kb
+from tuning_config_recommender.constants import MODEL_FILE_CACHE_SIZE
+from tuning_config_recommender.utils.helper import LRUCache
+from tuning_config_recommender.utils.kb_table import (
+    TuningRunIndex,
+    get_kb_snapshot,
+    query_kb,
+)
 
 script_dir = Path(__file__).resolve().parent
 
+_MODEL_FILE_CACHE = LRUCache(maxsize=MODEL_FILE_CACHE_SIZE)
+
+
+def load_model_json(model_name_or_path: str, filename: str) -> dict:
+    """Parsed JSON file of a local model folder, parsed again only after the
+    file changed. Every call returns its own copy."""
+    path = os.path.join(model_name_or_path, filename)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    content = _MODEL_FILE_CACHE.get(key)
+    if content is None:
+        with open(path, encoding="utf-8") as f:
+            content = json.load(f)
+        _MODEL_FILE_CACHE.put(key, content)
+    return deepcopy(content)
+
 
 def is_model_type_moe(model_name_or_path: str) -> bool:
     """Checks if the granite model given is MoE"""
 
     if os.path.isdir(model_name_or_path):
-        with open(f"{model_name_or_path}/config.json", encoding="utf-8") as f:
-            config = json.load(f)
+        config = load_model_json(model_name_or_path, "config.json")
 
     moe_tags = ["granitemoe", ""]
 
@@ -33,30 +54,14 @@ def is_model_type_moe(model_name_or_path: str) -> bool:
     return False
 
 
-def find_best_row(df, target_length, default_value=None):
-    # Step 1: Exact match
-    exact_match = df[df["model_max_length"] == target_length]
-    if not exact_match.empty:
-        return exact_match.iloc[0]
-
-    # Step 2: Nearest smaller value
-    smaller_matches = df[df["model_max_length"] < target_length]
-    if not smaller_matches.empty:
-        nearest = smaller_matches.sort_values(
-            by="model_max_length", ascending=False
-        ).iloc[0]
-        return nearest
-
-    # Step 3: Default
-    return default_value
+def load_tuning_run_index() -> TuningRunIndex:
+    """Indexed tuning run data of the current KB snapshot"""
+    return get_kb_snapshot().run_index
 
 
 def use_kb_for_batch_size(user_input: dict):
     """Use the knowledge base to determine the optimal batch size"""
-    training_run_data_path = (
-        script_dir.parent / "knowledge_base" / "tuning_run_data.csv"
-    )
-    df = pd.read_csv(training_run_data_path)
+    index = load_tuning_run_index()
     per_device_train_batch_size = user_input.get("per_device_train_batch_size", 8)
     model_name_or_path = str(user_input.get("model_name_or_path", ""))
     tuning_strategy = user_input.get("tuning_strategy", "")
@@ -67,22 +72,17 @@ def use_kb_for_batch_size(user_input: dict):
     except Exception:
         pass
 
-    filtered = df[
-        (df["model_name"] == model_name_or_path) & (df["method"] == tuning_strategy)
-    ]
+    key = (model_name_or_path, tuning_strategy)
 
     # if match is None:
-    if filtered.empty:
+    if key not in index:
         if "instruct" in model_name_or_path:
             model_name_or_path = model_name_or_path.replace("instruct", "base")
         elif "base" in model_name_or_path:
             model_name_or_path = model_name_or_path.replace("base", "instruct")
-            filtered = df[
-                (df["model_name"] == model_name_or_path)
-                & (df["method"] == tuning_strategy)
-            ]
+            key = (model_name_or_path, tuning_strategy)
 
-    match = find_best_row(filtered, max_seq_length)
+    match = index.find_best_row(*key, max_seq_length)
 
     batch_size_configs = {}
     if match is not None:
@@ -110,6 +110,4 @@ def fetch_from_knowledge_base(model_name_or_path: str, kb_section):
 
 
 def get_model_config(model_name_or_path: str):
-    with open(f"{model_name_or_path}/config.json", encoding="utf-8") as f:
-        config = json.load(f)
-    return config
+    return load_model_json(model_name_or_path, "config.json")
@@ -0,0 +1,11 @@
+import pytest
+
+from tuning_config_recommender.utils import jsonl_index
+
+
+@pytest.fixture(autouse=True)
+def jsonl_index_dir(tmp_path, monkeypatch):
+    """Keep persisted JSONL indexes of the tests out of the user cache dir"""
+    index_dir = tmp_path / "jsonl_index"
+    monkeypatch.setattr(jsonl_index, "INDEX_DIR", index_dir)
+    return index_dir
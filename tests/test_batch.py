@@ -0,0 +1,96 @@
+import json
+import threading
+
+from tuning_config_recommender import adapters
+from tuning_config_recommender.actions import IR, Action, PatchLevel, PatchType
+from tuning_config_recommender.adapters import VanillaAdapter
+from tuning_config_recommender.rule_engine import RuleEngine
+
+
+class BatchSizeAction(Action):
+    reads = ("tuning_config.max_seq_length",)
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.skip:
+            return
+        self.skip = True
+        return IR(
+            tuning_config={
+                "per_device_train_batch_size": 65536
+                // ir.tuning_config["max_seq_length"]
+            },
+            type=PatchType.SYSTEM_PERFORMANCE,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+def test_apply_many_isolates_failures(tmp_path):
+    engine = RuleEngine()
+    engine.register_action(BatchSizeAction())
+    irs = [
+        IR(
+            tuning_config={
+                "model_name_or_path": str(tmp_path),
+                "tuning_strategy": "full",
+                "max_seq_length": max_seq_length,
+            }
+        )
+        for max_seq_length in (1024, 0, 4096)
+    ]
+
+    results = {r.index: r for r in engine.apply_many(irs, max_workers=2)}
+
+    assert sorted(results) == [0, 1, 2]
+    assert not results[1].ok
+    assert isinstance(results[1].error, Exception)
+    for index, batch_size in ((0, 64), (2, 16)):
+        final_ir, _ = results[index].result
+        assert final_ir.tuning_config["per_device_train_batch_size"] == batch_size
+
+
+def test_execute_many_prefetches_once_per_group(tmp_path, monkeypatch):
+    model_dirs = []
+    for name in ("a", "b"):
+        model_dir = tmp_path / name
+        model_dir.mkdir()
+        (model_dir / "config.json").write_text(json.dumps({"model_type": name}))
+        model_dirs.append(str(model_dir))
+    downloads = []
+    lock = threading.Lock()
+
+    def get_model_path(model_name_or_path, unique_tag):
+        with lock:
+            downloads.append(model_name_or_path)
+        return model_name_or_path
+
+    def apply(self, ir, actions_meta=None, context=None):
+        if ir.compute_config.get("fail"):
+            raise ValueError("bad item")
+        return ir, []
+
+    monkeypatch.setattr(adapters, "get_model_path", get_model_path)
+    monkeypatch.setattr(adapters.RuleEngine, "apply", apply)
+    inputs = [
+        {
+            "tuning_config": {"model_name_or_path": model_dirs[i % 2]},
+            "compute_config": {"fail": i == 3},
+            "accelerate_config": {},
+            "data_config": {},
+            # every item writes its outputs under its own tag
+            "unique_tag": str(i),
+        }
+        for i in range(6)
+    ]
+    # malformed item without a tuning_config
+    inputs.append({"compute_config": {}, "unique_tag": "6"})
+
+    results = {r.index: r for r in VanillaAdapter().execute_many(inputs)}
+
+    assert sorted(results) == list(range(7))
+    assert sorted(downloads) == sorted(model_dirs)
+    assert sorted(i for i, r in results.items() if not r.ok) == [3, 6]
+    assert isinstance(results[6].error, KeyError)
+    ir, _ = results[4].result
+    assert ir.tuning_config["model_name_or_path"] == model_dirs[0]
+    # inputs are left as they were given
+    assert inputs[4]["tuning_config"] == {"model_name_or_path": model_dirs[0]}
@@ -0,0 +1,66 @@
+import copy
+import json
+
+from tuning_config_recommender.actions import IR
+from tuning_config_recommender.utils.cow import CowDict, thaw
+
+
+def _base():
+    return {
+        "chat_template": "x" * 1000,
+        "datasets": [
+            {"name": "a", "data_paths": ["a.jsonl"], "data_handlers": {}},
+            {"name": "b", "data_paths": ["b.jsonl"], "data_handlers": {}},
+        ],
+    }
+
+
+def test_writes_stay_in_the_view():
+    base = _base()
+    expected = copy.deepcopy(base)
+    view = CowDict(base)
+    for dataset in view["datasets"]:
+        dataset["data_handlers"] = [{"name": "handler"}]
+        dataset["data_paths"].append("extra.jsonl")
+    view.setdefault("dataprocessor", {})["streaming"] = False
+    view["datasets"][1]["data_paths"].pop(0)
+
+    assert base == expected
+    assert view["datasets"][0]["data_handlers"] == [{"name": "handler"}]
+    assert view["datasets"][1]["data_paths"] == ["extra.jsonl"]
+    assert view["dataprocessor"] == {"streaming": False}
+
+
+def test_thaw_shares_untouched_values():
+    base = _base()
+    view = CowDict(base)
+    view["datasets"][0]["name"] = "renamed"
+    plain = thaw(view)
+
+    assert type(plain) is dict and type(plain["datasets"]) is list
+    assert type(plain["datasets"][0]) is dict
+    assert plain["datasets"][0]["name"] == "renamed"
+    assert plain["chat_template"] is base["chat_template"]
+    assert plain["datasets"][0]["data_paths"] is base["datasets"][0]["data_paths"]
+    assert json.loads(json.dumps(view)) == plain
+    assert type(copy.deepcopy(view)) is dict
+
+
+def test_owned_values_keep_their_identity():
+    view = CowDict(_base())
+    handlers = []
+    view["datasets"][0]["data_handlers"] = handlers
+    handlers.append("added after assignment")
+    assert view["datasets"][0]["data_handlers"] is handlers
+
+
+def test_ir_view_and_snapshots():
+    ir = IR(tuning_config={"max_seq_length": 4096}, tuning_data_config=_base())
+    view = ir.view()
+    view.tuning_data_config["datasets"][0]["data_handlers"]["x"] = 1
+    assert ir.tuning_data_config == _base()
+
+    snapshot = ir.snapshot()
+    ir.update(IR(tuning_config={"max_seq_length": 1024}))
+    assert snapshot.tuning_config == {"max_seq_length": 4096}
+    assert snapshot.tuning_data_config is ir.tuning_data_config
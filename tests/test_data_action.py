@@ -0,0 +1,134 @@
+import json
+
+import pytest
+
+from tuning_config_recommender.actions import IR, PatchLevel
+from tuning_config_recommender.actions.actions import (
+    RunContext,
+    reset_run_context,
+    set_run_context,
+)
+from tuning_config_recommender.actions.data import ApplyQAFormat
+from tuning_config_recommender.utils import dataset_profile
+from tuning_config_recommender.utils.dataset_profile import (
+    clear_dataset_profile_cache,
+)
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    clear_dataset_profile_cache()
+    yield
+    clear_dataset_profile_cache()
+
+
+def _write_jsonl(path, records):
+    path.write_text("\n".join(json.dumps(r) for r in records) + "\n")
+    return str(path)
+
+
+class TestApplyQAFormat:
+    """Unit tests for ApplyQAFormat action"""
+
+    def test_apply_flags_inconsistent_shards(self, tmp_path):
+        """A dataset with a shard in a different format is left untouched
+        and gets a patch of its own asking for user intervention"""
+        qa = [{"question": "q", "answer": "a"}]
+        good = {
+            "name": "good",
+            "data_paths": [_write_jsonl(tmp_path / "good.jsonl", qa)],
+        }
+        mixed_paths = [
+            _write_jsonl(tmp_path / "mixed-0.jsonl", qa),
+            _write_jsonl(tmp_path / "mixed-1.jsonl", [{"text": "no qa here"}]),
+        ]
+        mixed = {"name": "mixed", "data_paths": mixed_paths}
+        ir = IR(
+            tuning_config={"model_name_or_path": str(tmp_path)},
+            tuning_data_config={"datasets": [good, mixed]},
+        )
+
+        action = ApplyQAFormat()
+        return_ir = action.apply(ir, actions_meta=[])
+
+        assert return_ir.level == PatchLevel.MANDATORY
+        assert mixed_paths[1] in str(return_ir.comment)
+        (intervention,) = action.json_merge_patches[:-1]
+        assert intervention.level == PatchLevel.USER_INTERVENTION
+        assert "dataset mixed" in str(intervention.comment)
+        datasets = return_ir.tuning_data_config["datasets"]
+        assert datasets[0]["data_handlers"][0]["name"] == "apply_custom_jinja_template"
+        assert "data_handlers" not in datasets[1]
+
+    def test_apply_consistent_shards_is_mandatory(self, tmp_path):
+        qa = [{"question": "q", "answer": "a"}]
+        paths = [_write_jsonl(tmp_path / f"s-{i}.jsonl", qa) for i in range(3)]
+        ir = IR(
+            tuning_config={"model_name_or_path": str(tmp_path)},
+            tuning_data_config={"datasets": [{"name": "d", "data_paths": paths}]},
+        )
+
+        return_ir = ApplyQAFormat().apply(ir, actions_meta=[])
+
+        assert return_ir.level == PatchLevel.MANDATORY
+        assert return_ir.tuning_config["dataset_text_field"] == "formatted_qa_data"
+
+    def test_unreadable_shard_is_not_in_format(self, tmp_path):
+        """A shard which can not be probed does not fail the action, datasets
+        with one are reported whichever shard it is"""
+        qa = [{"question": "q", "answer": "a"}]
+        missing = str(tmp_path / "missing.jsonl")
+        ir = IR(
+            tuning_config={"model_name_or_path": str(tmp_path)},
+            tuning_data_config={
+                "datasets": [
+                    {"name": "broken", "data_paths": [missing]},
+                    {
+                        "name": "good",
+                        "data_paths": [
+                            _write_jsonl(tmp_path / "good.jsonl", qa),
+                            missing,
+                        ],
+                    },
+                ]
+            },
+        )
+        action = ApplyQAFormat()
+
+        assert not action.heuristic_skip(ir)
+        return_ir = action.apply(ir, actions_meta=[])
+
+        assert return_ir.level == PatchLevel.MANDATORY
+        datasets = return_ir.tuning_data_config["datasets"]
+        assert "data_handlers" not in datasets[0]
+        assert "data_handlers" not in datasets[1]
+        broken, good = action.json_merge_patches[:-1]
+        assert broken.level == good.level == PatchLevel.USER_INTERVENTION
+        assert "dataset broken could not be read" in str(broken.comment)
+        assert "dataset good do not match" in str(good.comment)
+
+    def test_probes_use_the_workers_of_the_run(self, tmp_path, monkeypatch):
+        qa = [{"question": "q", "answer": "a"}]
+        paths = [_write_jsonl(tmp_path / f"s-{i}.jsonl", qa) for i in range(3)]
+        ir = IR(
+            tuning_config={"model_name_or_path": str(tmp_path)},
+            tuning_data_config={"datasets": [{"name": "d", "data_paths": paths}]},
+        )
+        workers = []
+        probe_dataset_paths = dataset_profile.probe_dataset_paths
+
+        def probe(paths, max_workers):
+            workers.append(max_workers)
+            return probe_dataset_paths(paths, max_workers)
+
+        monkeypatch.setattr(dataset_profile, "probe_dataset_paths", probe)
+        monkeypatch.setattr(
+            "tuning_config_recommender.actions.data.probe_dataset_paths", probe
+        )
+        token = set_run_context(RunContext(probe_workers=2))
+        try:
+            ApplyQAFormat().apply(ir, actions_meta=[])
+        finally:
+            reset_run_context(token)
+
+        assert workers and set(workers) == {2}
@@ -0,0 +1,201 @@
+import bz2
+import gzip
+import json
+import lzma
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tuning_config_recommender.utils import data_processing
+from tuning_config_recommender.utils.data_processing import (
+    ProbeBudget,
+    SamplingStrategy,
+    count_records_in_general_file,
+    extract_data_from_general_file,
+    resolve_data_path_glob,
+    sample_training_data,
+)
+
+RECORDS = [{"question": f"q{i}", "answer": f"a{i}"} for i in range(1000)]
+
+
+@pytest.fixture
+def data_files(tmp_path):
+    """Write RECORDS in every supported file format"""
+    paths = {}
+
+    paths["json"] = tmp_path / "data.json"
+    paths["json"].write_text(json.dumps(RECORDS, indent=2))
+
+    paths["jsonl"] = tmp_path / "data.jsonl"
+    paths["jsonl"].write_text("\n".join(json.dumps(r) for r in RECORDS) + "\n")
+
+    paths["csv"] = tmp_path / "data.csv"
+    paths["csv"].write_text(
+        "question,answer\n"
+        + "".join(f"{r['question']},{r['answer']}\n" for r in RECORDS)
+    )
+
+    table = pa.Table.from_pylist(RECORDS)
+    paths["parquet"] = tmp_path / "data.parquet"
+    pq.write_table(table, paths["parquet"], row_group_size=100)
+
+    paths["arrow"] = tmp_path / "data.arrow"
+    with pa.ipc.new_stream(str(paths["arrow"]), table.schema) as writer:
+        writer.write_table(table, max_chunksize=100)
+
+    return {k: str(v) for k, v in paths.items()}
+
+
+@pytest.mark.parametrize("fmt", ["json", "jsonl", "csv", "parquet", "arrow"])
+def test_head_sample_reads_first_records(data_files, fmt):
+    """Head sampling returns the first N records for every format"""
+    data = sample_training_data(data_files[fmt], num_samples=5)
+    assert data == RECORDS[:5]
+
+
+@pytest.mark.parametrize("fmt", ["json", "jsonl", "csv", "parquet", "arrow"])
+def test_random_sample_is_bounded_and_reproducible(data_files, fmt):
+    """Random sampling returns N distinct records and is seeded"""
+    data = sample_training_data(
+        data_files[fmt], num_samples=10, strategy=SamplingStrategy.RANDOM, seed=3
+    )
+    assert len(data) == 10
+    assert all(record in RECORDS for record in data)
+    assert len({record["question"] for record in data}) == 10
+    assert data == sample_training_data(
+        data_files[fmt], num_samples=10, strategy=SamplingStrategy.RANDOM, seed=3
+    )
+
+
+@pytest.mark.parametrize("fmt", ["json", "jsonl", "csv", "parquet", "arrow"])
+def test_full_extraction_is_unchanged(data_files, fmt):
+    """Without num_samples every record is returned as a list of dicts"""
+    assert extract_data_from_general_file(data_files[fmt]) == RECORDS
+
+
+def test_random_parquet_sample_reads_few_row_groups(data_files, monkeypatch):
+    """A random parquet sample decodes only the requested columns of at most
+    max_row_groups row groups"""
+    reads = []
+    original = pq.ParquetFile.read_row_group
+
+    def recording_read_row_group(self, i, columns=None, **kwargs):
+        reads.append((i, columns))
+        return original(self, i, columns=columns, **kwargs)
+
+    monkeypatch.setattr(pq.ParquetFile, "read_row_group", recording_read_row_group)
+    data = sample_training_data(
+        data_files["parquet"],
+        num_samples=500,
+        strategy=SamplingStrategy.RANDOM,
+        budget=ProbeBudget(max_row_groups=2),
+        columns=["Question"],
+    )
+    assert len(data) == 200
+    assert all(record.keys() == {"question"} for record in data)
+    assert len(reads) == 2
+    assert all(columns == ["question"] for _, columns in reads)
+
+    # the byte budget stops reading after the first row group
+    reads.clear()
+    data = sample_training_data(
+        data_files["parquet"],
+        num_samples=500,
+        strategy=SamplingStrategy.RANDOM,
+        budget=ProbeBudget(max_bytes=1, max_row_groups=4),
+    )
+    assert len(reads) == 1
+    assert len(data) == 100
+
+
+def test_columns_limit_records_of_every_format(data_files):
+    for path in data_files.values():
+        data = sample_training_data(path, num_samples=3, columns=["answer"])
+        assert data == [{"answer": r["answer"]} for r in RECORDS[:3]]
+
+
+def test_json_records_larger_than_read_chunk(tmp_path):
+    """Streaming JSON decoding handles records spanning multiple reads"""
+    records = [{"text": "x" * 200_000, "id": i} for i in range(3)]
+    path = tmp_path / "large.json"
+    path.write_text(json.dumps(records))
+    assert sample_training_data(str(path), num_samples=2) == records[:2]
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    """Local stand-in for a dataset repository with train and test splits"""
+    root = tmp_path / "dataset"
+    root.mkdir()
+    (root / "train.jsonl").write_text("\n".join(json.dumps(r) for r in RECORDS) + "\n")
+    (root / "test.jsonl").write_text(json.dumps({"question": "t", "answer": "t"}))
+    return str(root)
+
+
+def test_dataset_dir_is_streamed(dataset_dir, tmp_path, monkeypatch):
+    """Dataset folders are probed in streaming mode from the train split"""
+    calls = []
+    original = data_processing.load_dataset
+
+    def recording_load_dataset(*args, **kwargs):
+        calls.append(kwargs)
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(data_processing, "load_dataset", recording_load_dataset)
+    data = sample_training_data(
+        dataset_dir, num_samples=3, cache_dir=str(tmp_path / "hf_cache")
+    )
+    assert data == RECORDS[:3]
+    assert calls[0]["streaming"] is True
+
+
+def test_probe_budget_bounds_records_read(dataset_dir):
+    """A byte budget stops the probe early even for random sampling"""
+    budget = ProbeBudget(max_bytes=200)
+    data = sample_training_data(
+        dataset_dir,
+        num_samples=10,
+        strategy=SamplingStrategy.RANDOM,
+        budget=budget,
+    )
+    assert 0 < len(data) < 10
+    assert all(record in RECORDS[:10] for record in data)
+
+
+@pytest.mark.parametrize("compression", ["gz", "bz2", "xz", "zst"])
+@pytest.mark.parametrize("fmt", ["json", "jsonl", "csv"])
+def test_compressed_files_are_streamed(data_files, fmt, compression):
+    """Compressed files are detected from the inner extension"""
+    if compression == "zst":
+        zstandard = pytest.importorskip("zstandard")
+        opener = zstandard.open
+    else:
+        opener = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open}[compression]
+    path = f"{data_files[fmt]}.{compression}"
+    with open(data_files[fmt], "rb") as src, opener(path, "wb") as dst:
+        dst.write(src.read())
+
+    assert sample_training_data(path, num_samples=3) == RECORDS[:3]
+    data = sample_training_data(
+        path, num_samples=5, strategy=SamplingStrategy.RANDOM, seed=1
+    )
+    assert len(data) == 5
+    assert count_records_in_general_file(path) == len(RECORDS)
+
+
+def test_glob_falls_back_to_compressed_shards(tmp_path):
+    for i in range(2):
+        with gzip.open(tmp_path / f"shard-{i}.jsonl.gz", "wt") as f:
+            f.write(json.dumps(RECORDS[i]) + "\n")
+    (tmp_path / "other.csv").write_text("a\n1\n")
+
+    resolved = resolve_data_path_glob(str(tmp_path / "*.jsonl"))
+    assert sorted(resolved) == [
+        str(tmp_path / "shard-0.jsonl.gz"),
+        str(tmp_path / "shard-1.jsonl.gz"),
+    ]
+    assert resolve_data_path_glob(str(tmp_path / "*.csv")) == [
+        str(tmp_path / "other.csv")
+    ]
@@ -0,0 +1,168 @@
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from tuning_config_recommender.utils import dataset_profile
+from tuning_config_recommender.utils.dataset_profile import (
+    DatasetFormat,
+    clear_dataset_profile_cache,
+    find_inconsistent_shards,
+    get_dataset_profile,
+    probe_dataset_paths,
+)
+from tuning_config_recommender.utils.helper import LRUCache
+
+
+def _write_jsonl(path, records):
+    path.write_text("\n".join(json.dumps(r) for r in records) + "\n")
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    clear_dataset_profile_cache()
+    yield
+    clear_dataset_profile_cache()
+
+
+@pytest.fixture
+def count_probes(monkeypatch):
+    calls = []
+    original = dataset_profile.sample_training_data
+
+    def counting_sample(path, *args, **kwargs):
+        calls.append(path)
+        return original(path, *args, **kwargs)
+
+    monkeypatch.setattr(dataset_profile, "sample_training_data", counting_sample)
+    return calls
+
+
+def test_profile_classifies_formats(tmp_path):
+    """Chat, QA and tokenized datasets are detected from the sample"""
+    chat = _write_jsonl(
+        tmp_path / "chat.jsonl",
+        [{"messages": [{"role": "user", "content": "hi"}]}],
+    )
+    qa = _write_jsonl(tmp_path / "qa.jsonl", [{"Question": "q", "Answer": "a"}])
+    tokenized = _write_jsonl(
+        tmp_path / "tok.jsonl", [{"input_ids": [1, 2], "labels": [1, 2]}]
+    )
+
+    assert get_dataset_profile(chat).format == DatasetFormat.CHAT
+    assert get_dataset_profile(chat).chat_column == "messages"
+    assert get_dataset_profile(qa).format == DatasetFormat.QA
+    assert get_dataset_profile(qa).input_column == "question"
+    assert get_dataset_profile(qa).response_column == "answer"
+    assert get_dataset_profile(tokenized).format == DatasetFormat.TOKENIZED
+
+
+def test_profile_is_computed_once_per_file_version(tmp_path, count_probes):
+    """Repeated lookups hit the cache until the file changes"""
+    path = _write_jsonl(tmp_path / "qa.jsonl", [{"question": "q", "answer": "a"}])
+    for _ in range(5):
+        get_dataset_profile(path)
+    assert len(count_probes) == 1
+
+    _write_jsonl(tmp_path / "qa.jsonl", [{"input": "q", "output": "a", "x": 1}])
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    assert get_dataset_profile(path).columns == ["input", "output", "x"]
+    assert len(count_probes) == 2
+
+
+def test_columnar_profile_uses_schema_only(tmp_path, count_probes, monkeypatch):
+    """Parquet/arrow detection needs no decoded rows for struct messages"""
+    table = pa.Table.from_pylist(
+        [{"messages": [{"role": "user", "content": "hi"}], "id": i} for i in range(10)]
+    )
+    parquet_path = str(tmp_path / "chat.parquet")
+    pq.write_table(table, parquet_path, row_group_size=2)
+    arrow_path = str(tmp_path / "chat.arrow")
+    with pa.ipc.new_stream(arrow_path, table.schema) as writer:
+        writer.write_table(table)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("rows should not be decoded")
+
+    monkeypatch.setattr(dataset_profile, "read_first_row_group", fail)
+    for path in (parquet_path, arrow_path):
+        profile = get_dataset_profile(path)
+        assert profile.format == DatasetFormat.CHAT
+        assert profile.chat_column == "messages"
+        assert profile.columns == ["messages", "id"]
+    assert get_dataset_profile(parquet_path).num_rows == 10
+    assert count_probes == []
+
+
+def test_columnar_profile_checks_values_when_type_is_inconclusive(tmp_path):
+    """A messages column of strings is not chat formatted"""
+    path = str(tmp_path / "strings.parquet")
+    pq.write_table(pa.Table.from_pylist([{"messages": "hi", "answer": "a"}]), path)
+    profile = get_dataset_profile(path)
+    assert not profile.is_chat
+    assert profile.chat_column == "messages"
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_probe_dataset_paths_profiles_every_shard(tmp_path, count_probes):
+    """All shards are probed once and errors are kept"""
+    paths = [
+        _write_jsonl(tmp_path / f"shard-{i}.jsonl", [{"question": "q", "answer": "a"}])
+        for i in range(4)
+    ]
+    for i in range(2):
+        json_path = tmp_path / f"shard-{i}.json"
+        json_path.write_text(
+            json.dumps([{"messages": [{"role": "user", "content": "x"}]}])
+        )
+        paths.append(str(json_path))
+    missing = str(tmp_path / "missing.jsonl")
+
+    results = probe_dataset_paths(paths + [missing], max_workers=4)
+
+    assert list(results) == paths + [missing]
+    assert all(results[p].profile.is_qa for p in paths[:4])
+    assert all(results[p].profile.is_chat for p in paths[4:])
+    with pytest.raises(FileNotFoundError):
+        results[missing].unwrap()
+
+    # profiles computed by the probe are served from the cache afterwards
+    probed = len(count_probes)
+    for path in paths:
+        get_dataset_profile(path)
+    assert len(count_probes) == probed
+
+
+def test_find_inconsistent_shards_caches_verdicts(tmp_path, count_probes):
+    """Mismatched shards are reported and unchanged shards are not re-probed"""
+    qa = [{"question": "q", "answer": "a"}]
+    paths = [_write_jsonl(tmp_path / f"shard-{i}.jsonl", qa) for i in range(3)]
+    paths.append(
+        _write_jsonl(
+            tmp_path / "chat.jsonl",
+            [{"messages": [{"role": "user", "content": "x"}]}],
+        )
+    )
+
+    assert find_inconsistent_shards(paths) == [paths[-1]]
+    probed = len(count_probes)
+
+    clear_dataset_profile_cache()
+    assert find_inconsistent_shards(paths) == [paths[-1]]
+    # only the reference shard is profiled again
+    assert count_probes[probed:] == [paths[0]]
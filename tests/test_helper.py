@@ -0,0 +1,48 @@
+from tuning_config_recommender.constants import CACHE_DIR_ENV_VAR
+from tuning_config_recommender.utils import (
+    PatchIndex,
+    patch_op_key,
+    set_difference,
+    set_issubset,
+    user_cache_dir,
+)
+
+OPS = [
+    {"op": "add", "path": "/tuning_config/packing", "value": True},
+    {"op": "replace", "path": "/tuning_config/max_seq_length", "value": 1024},
+    {"op": "add", "path": "/accelerate_config", "value": {"b": [1], "a": None}},
+    {"op": "remove", "path": "/tuning_config/padding_free"},
+]
+
+
+def test_patch_op_key_is_canonical():
+    assert patch_op_key(OPS[2]) == patch_op_key(
+        {"path": "/accelerate_config", "value": {"a": None, "b": [1]}, "op": "add"}
+    )
+    assert patch_op_key(OPS[3]) != patch_op_key({**OPS[3], "value": None})
+    assert patch_op_key(OPS[0]) != patch_op_key({**OPS[0], "value": 1})
+
+
+def test_patch_index_membership():
+    index = PatchIndex(OPS[:2])
+    assert {"op": "add", "path": "/tuning_config/packing", "value": True} in index
+    assert {"op": "add", "path": "/tuning_config/packing", "value": False} not in index
+    assert index.covers(OPS[:1])
+    assert not index.covers(OPS)
+    assert index.paths() == ["/tuning_config/packing", "/tuning_config/max_seq_length"]
+
+
+def test_set_helpers_keep_order():
+    assert set_difference(OPS, OPS[1:3]) == [OPS[0], OPS[3]]
+    assert set_issubset(OPS, [dict(op) for op in OPS[2:]])
+    assert not set_issubset(OPS[:2], OPS[2:])
+
+
+def test_user_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv(CACHE_DIR_ENV_VAR, raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "xdg"))
+    assert user_cache_dir("index") == (
+        tmp_path / "xdg" / "tuning_config_recommender" / "index"
+    )
+    monkeypatch.setenv(CACHE_DIR_ENV_VAR, str(tmp_path / "custom"))
+    assert user_cache_dir("index") == tmp_path / "custom" / "index"
@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+from tuning_config_recommender.utils import jsonl_index
+from tuning_config_recommender.utils.data_processing import (
+    count_records_in_general_file,
+)
+from tuning_config_recommender.utils.jsonl_index import (
+    count_jsonl_records,
+    get_jsonl_index,
+    sample_jsonl_records,
+)
+
+
+@pytest.fixture
+def jsonl_file(tmp_path):
+    path = tmp_path / "data.jsonl"
+    lines = [json.dumps({"id": i}) for i in range(500)]
+    # blank lines are not records
+    path.write_text("\n".join(lines[:250]) + "\n\n" + "\n".join(lines[250:]) + "\n")
+    return str(path)
+
+
+def test_count_without_parsing(jsonl_file):
+    assert count_jsonl_records(jsonl_file) == 500
+    assert count_records_in_general_file(jsonl_file) == 500
+
+
+def test_whitespace_only_lines_are_not_records(tmp_path):
+    path = tmp_path / "crlf.jsonl"
+    path.write_bytes(b'{"id": 0}\r\n  \t\r\n{"id": 1}\r\n\r\n')
+    assert count_jsonl_records(str(path)) == 2
+    assert count_records_in_general_file(str(path)) == 2
+    assert sorted(r["id"] for r in sample_jsonl_records(str(path), num_samples=10)) == [
+        0,
+        1,
+    ]
+
+
+def test_random_sample_is_uniform_and_distinct(jsonl_file):
+    records = sample_jsonl_records(jsonl_file, num_samples=50, seed=1)
+    ids = [r["id"] for r in records]
+    assert len(set(ids)) == 50
+    # records are drawn from the whole file, not only its head
+    assert max(ids) > 250
+    assert records == sample_jsonl_records(jsonl_file, num_samples=50, seed=1)
+
+
+def test_index_is_persisted_and_rebuilt_on_change(
+    jsonl_file, jsonl_index_dir, monkeypatch
+):
+    first = get_jsonl_index(jsonl_file)
+    assert len(list(jsonl_index_dir.iterdir())) == 1
+
+    def fail(path):
+        raise AssertionError("index should be loaded from disk")
+
+    monkeypatch.setattr(jsonl_index, "build_jsonl_index", fail)
+    loaded = get_jsonl_index(jsonl_file)
+    assert (loaded.starts == first.starts).all()
+    assert (loaded.ends == first.ends).all()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(jsonl_index, "INDEX_DIR", jsonl_index_dir)
+    with open(jsonl_file, "a") as f:
+        f.write(json.dumps({"id": 500}) + "\n")
+    stat = os.stat(jsonl_file)
+    os.utime(jsonl_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    rebuilt = get_jsonl_index(jsonl_file)
+    assert rebuilt.num_records == 501
+
+
+def test_index_is_rebuilt_on_rewrite_keeping_size_and_mtime(jsonl_file):
+    first = get_jsonl_index(jsonl_file)
+    stat = os.stat(jsonl_file)
+    with open(jsonl_file, "r+b") as f:
+        # the first record, {"id": 0}, is rewritten as three of the same size
+        f.write(b"{}\n{}\n{}\n")
+    os.utime(jsonl_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    rebuilt = get_jsonl_index(jsonl_file)
+    assert rebuilt.num_records == first.num_records + 2
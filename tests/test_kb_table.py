@@ -0,0 +1,201 @@
+import fnmatch
+import os
+import random
+import shutil
+import time
+from contextvars import copy_context
+
+import pytest
+
+from tuning_config_recommender.constants import (
+    COMPILED_KB_ENV_VAR,
+    RUN_HISTORY_DIR_ENV_VAR,
+)
+from tuning_config_recommender.utils import kb_table
+from tuning_config_recommender.utils.kb_table import (
+    KBIndex,
+    KBWatcher,
+    _build_kb_table,
+    build_kb_snapshot,
+    clear_kb_snapshot,
+    compile_kb,
+    get_kb_snapshot,
+    pin_kb_snapshot,
+    query_kb,
+    reload_kb,
+)
+
+
+def _scan(table, model_name, section):
+    """Reference lookup scanning the whole table in priority order"""
+    for row in table:
+        if row["section"] != section:
+            continue
+        if fnmatch.fnmatch(model_name, row["model_pattern"]):
+            return row["payload"], row["model_pattern"] != "*"
+    return {}, False
+
+
+def _row(pattern, section, priority):
+    return {
+        "model_pattern": pattern,
+        "section": section,
+        "payload": {"from": pattern},
+        "priority": priority,
+    }
+
+
+def test_priority_between_globs_and_exact_names():
+    table = sorted(
+        [
+            _row("ibm-granite/*", "defaults", 0),
+            _row("ibm-granite/granite-3b", "defaults", 1),
+            _row("ibm-granite/granite-3b", "chat_template", 2),
+            _row("*-instruct", "chat_template", 3),
+            _row("*", "defaults", 1000),
+            _row("*", "chat_template", 1000),
+        ],
+        key=lambda r: r["priority"],
+    )
+    index = KBIndex(table)
+    assert index.query("ibm-granite/granite-3b", "defaults") == (
+        {"from": "ibm-granite/*"},
+        True,
+    )
+    assert index.query("ibm-granite/granite-3b", "chat_template") == (
+        {"from": "ibm-granite/granite-3b"},
+        True,
+    )
+    assert index.query("other-instruct", "chat_template") == (
+        {"from": "*-instruct"},
+        True,
+    )
+    assert index.query("other", "defaults") == ({"from": "*"}, False)
+    assert index.query("other", "missing") == ({}, False)
+
+
+def test_index_matches_table_scan():
+    rng = random.Random(0)
+    names = [f"org{i % 5}/model-{i}" for i in range(50)]
+    patterns = names + ["org1/*", "*model-1?", "org[23]/model-*", "*-4*"]
+    table = [
+        _row(pattern, section, rng.randrange(10))
+        for pattern in patterns
+        for section in ("a", "b")
+        if rng.random() < 0.6
+    ]
+    table += [_row("*", "a", 1000)]
+    table.sort(key=lambda r: r["priority"])
+    index = KBIndex(table)
+    for name in [*names, "org2/model-x", "unknown"]:
+        for section in ("a", "b", "c"):
+            expected = _scan(table, name, section)
+            assert index.query(name, section) == expected
+            # memoized results are the same
+            assert index.query(name, section) == expected
+
+
+@pytest.mark.parametrize("section", ["chat_template", "additional_special_tokens"])
+def test_shipped_kb_queries_are_unchanged(section):
+    table = _build_kb_table()
+    for row in table:
+        name = row["model_pattern"].replace("*", "x")
+        assert query_kb(name, section) == _scan(table, name, section)
+
+
+@pytest.fixture
+def kb_path(tmp_path, monkeypatch):
+    path = tmp_path / "knowledge_base.yaml"
+    path.write_text(
+        "version: 1\ngeneral_defaults:\n  chat_template: default\n"
+        "models:\n  granite:\n    chat_template: old\n"
+    )
+    run_data = tmp_path / "tuning_run_data.csv"
+    shutil.copy(kb_table.TUNING_RUN_DATA_PATH, run_data)
+    monkeypatch.setattr(kb_table, "KB_PATH", path)
+    monkeypatch.setattr(kb_table, "TUNING_RUN_DATA_PATH", run_data)
+    monkeypatch.setattr(kb_table, "COMPILED_KB_PATH", tmp_path / "kb.arrow")
+    monkeypatch.setenv(RUN_HISTORY_DIR_ENV_VAR, str(tmp_path / "run_history"))
+    monkeypatch.delenv(COMPILED_KB_ENV_VAR, raising=False)
+    clear_kb_snapshot()
+    yield path
+    clear_kb_snapshot()
+
+
+def test_pinned_snapshot_survives_reload(kb_path):
+    with pin_kb_snapshot() as snapshot:
+        kb_path.write_text("models:\n  granite:\n    chat_template: new\n")
+        reloaded = reload_kb()
+        assert reloaded.version != snapshot.version
+        # the run keeps its snapshot, also on threads given its context
+        assert query_kb("granite", "chat_template") == ("old", True)
+        assert copy_context().run(query_kb, "granite", "chat_template")[0] == "old"
+    assert query_kb("granite", "chat_template") == ("new", True)
+    assert get_kb_snapshot() is reloaded
+    # unchanged content keeps the active snapshot
+    assert reload_kb(force=True) is reloaded
+
+
+def test_watcher_reloads_changed_kb(kb_path):
+    version = get_kb_snapshot().version
+    watcher = KBWatcher(interval=0.01).start()
+    try:
+        kb_path.write_text("models:\n  granite:\n    chat_template: new\n")
+        deadline = time.monotonic() + 5
+        while get_kb_snapshot().version == version and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        watcher.stop()
+    assert query_kb("granite", "chat_template") == ("new", True)
+
+
+def test_compiled_kb_is_used_while_fresh(kb_path, monkeypatch):
+    kb_table.TUNING_RUN_DATA_PATH.write_text(
+        "model_name,method,model_max_length,per_device_train_batch_size\n"
+        "granite,full,4096,8\ngranite,full,2048,16\n"
+    )
+    expected = build_kb_snapshot()
+    compile_kb()
+
+    def no_parsing(contents):
+        raise AssertionError("KB sources parsed")
+
+    with monkeypatch.context() as m:
+        m.setattr(kb_table, "_parse_sources", no_parsing)
+        # unchanged stats, the sources are not even read
+        m.setattr(kb_table, "_read_sources", no_parsing)
+        compiled = build_kb_snapshot()
+    assert compiled.version == expected.version
+    assert compiled.kb == expected.kb
+    assert compiled.table == expected.table
+    assert compiled.run_index.find_best_row("granite", "full", 3000) == (
+        expected.run_index.find_best_row("granite", "full", 3000)
+    )
+
+    # touched but unchanged sources are hashed and still match
+    os.utime(kb_path, ns=(0, 0))
+    with monkeypatch.context() as m:
+        m.setattr(kb_table, "_parse_sources", no_parsing)
+        assert build_kb_snapshot().version == expected.version
+
+    # a changed source makes the artifact stale
+    kb_path.write_text("models:\n  granite:\n    chat_template: new\n")
+    snapshot = build_kb_snapshot()
+    assert snapshot.version != expected.version
+    assert snapshot.index.query("granite", "chat_template") == ("new", True)
+
+
+def test_compiled_kb_path_is_configurable(kb_path, tmp_path, monkeypatch):
+    path = tmp_path / "elsewhere" / "kb.arrow"
+    monkeypatch.setenv(COMPILED_KB_ENV_VAR, str(path))
+    assert compile_kb() == path
+    assert path.is_file()
+
+
+def test_missing_run_data_is_tolerated(kb_path):
+    kb_table.TUNING_RUN_DATA_PATH.unlink()
+    snapshot = build_kb_snapshot()
+    assert snapshot.run_index.find_best_row("granite", "full", 4096) is None
+    assert snapshot.index.query("granite", "chat_template") == ("old", True)
+    compile_kb()
+    assert build_kb_snapshot().version == snapshot.version
@@ -0,0 +1,99 @@
+import json
+import threading
+import tracemalloc
+
+from tuning_config_recommender.actions import IR, Action, PatchLevel, PatchType
+from tuning_config_recommender.rule_engine import RuleEngine
+from tuning_config_recommender.utils.profiling import (
+    Profiler,
+    get_profiler,
+    profile_span,
+)
+
+
+def test_spans_are_off_without_profiler():
+    assert get_profiler() is None
+    with profile_span("x", "test") as span:
+        assert span is None
+
+
+def test_nested_span_peaks(tmp_path):
+    with Profiler() as profiler:
+        with profile_span("outer", "test"):
+            with profile_span("inner", "test"):
+                block = bytearray(4 * 2**20)
+                del block
+            small = bytearray(1024)
+            del small
+        path = tmp_path / "data.txt"
+        with profile_span("write", "io"):
+            path.write_bytes(b"x" * 100_000)
+    spans = {span.name: span for span in profiler.spans}
+    assert spans["inner"].peak_bytes >= 4 * 2**20
+    # the outer peak covers the inner allocation despite the peak reset
+    assert spans["outer"].peak_bytes >= 4 * 2**20
+    assert spans["outer"].wall_ns >= spans["inner"].wall_ns
+    if spans["write"].io_write_bytes is not None:
+        assert spans["write"].io_write_bytes >= 100_000
+
+    trace_file = tmp_path / "trace.json"
+    profiler.write_chrome_trace(trace_file)
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert [e["name"] for e in events] == ["outer", "inner", "write"]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+    assert profiler.summary().splitlines()[2].split()[:2] == ["test", "outer"]
+
+
+def test_concurrent_profilers_share_tracemalloc():
+    entered, exited = threading.Event(), threading.Event()
+    other = Profiler()
+
+    def other_request():
+        with other:
+            with profile_span("other", "test"):
+                entered.set()
+                exited.wait(5)
+
+    thread = threading.Thread(target=other_request)
+    with Profiler() as profiler:
+        thread.start()
+        entered.wait(5)
+        # the peak is neither reset nor reported while another profiler traces
+        with profile_span("busy", "test"):
+            pass
+        exited.set()
+        thread.join()
+        assert tracemalloc.is_tracing()
+        with profile_span("alone", "test"):
+            pass
+    assert not tracemalloc.is_tracing()
+    spans = {span.name: span for span in profiler.spans}
+    assert spans["busy"].peak_bytes is None
+    assert other.spans[0].peak_bytes is None
+    assert spans["alone"].peak_bytes is not None
+
+
+class PatchAction(Action):
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.skip:
+            return
+        self.skip = True
+        return IR(
+            tuning_config={"packing": True},
+            type=PatchType.SYSTEM_PERFORMANCE,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+def test_engine_records_actions_and_iterations(tmp_path):
+    engine = RuleEngine()
+    engine.register_action(PatchAction())
+    ir = IR(
+        tuning_config={"model_name_or_path": str(tmp_path), "tuning_strategy": "full"}
+    )
+    with Profiler() as profiler:
+        engine.apply(ir)
+    rows = {(row["category"], row["name"]): row for row in profiler.summary_rows()}
+    assert rows[("action", "PatchAction")]["calls"] == 1
+    assert ("iteration", "iteration 1") in rows
+    assert ("engine", "validate_and_maybe_fix_ir") in rows
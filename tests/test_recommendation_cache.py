@@ -0,0 +1,171 @@
+import json
+
+import pytest
+
+from tuning_config_recommender import adapters
+from tuning_config_recommender.actions import (
+    IR,
+    REMOVE,
+    ApplyDefaults,
+    Comment,
+    PatchLevel,
+    PatchType,
+)
+from tuning_config_recommender.adapters import VanillaAdapter
+from tuning_config_recommender.constants import RUN_HISTORY_DIR_ENV_VAR
+from tuning_config_recommender.utils import recommendation_cache
+from tuning_config_recommender.utils.recommendation_cache import (
+    RecommendationCache,
+    recommendation_key,
+)
+
+
+@pytest.fixture
+def kb_files(tmp_path, monkeypatch):
+    files = [tmp_path / "knowledge_base.yaml", tmp_path / "tuning_run_data.csv"]
+    files[0].write_text("models: {}\n")
+    files[1].write_text("model_name,method\n")
+    monkeypatch.setattr(recommendation_cache, "KB_FILES", files)
+    monkeypatch.setenv(RUN_HISTORY_DIR_ENV_VAR, str(tmp_path / "run_history"))
+    return files
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    path = tmp_path / "data.jsonl"
+    path.write_text(json.dumps({"question": "q", "answer": "a"}) + "\n")
+    return str(path)
+
+
+def _key(data_path, **tuning_config):
+    return recommendation_key(
+        {"tuning_config": {"model_name_or_path": "m", **tuning_config}},
+        [ApplyDefaults],
+        [data_path],
+        "m",
+    )
+
+
+def test_key_tracks_inputs_datasets_and_kb(kb_files, data_path):
+    key = _key(data_path)
+    assert key == _key(data_path)
+    assert key != _key(data_path, max_seq_length=1024)
+
+    with open(data_path, "a") as f:
+        f.write(json.dumps({"question": "q2", "answer": "a2"}) + "\n")
+    changed_data = _key(data_path)
+    assert changed_data != key
+
+    kb_files[0].write_text("models: {granite: {}}\n")
+    assert _key(data_path) != changed_data
+
+
+def test_disk_tier_is_shared(tmp_path, kb_files):
+    cache = RecommendationCache(tmp_path / "cache")
+    cache.put("a", {"value": [1]})
+    result = cache.get("a")
+    assert result == {"value": [1]}
+    result["value"].append(2)
+    assert cache.get("a") == {"value": [1]}
+    assert RecommendationCache(tmp_path / "cache").get("a") == {"value": [1]}
+    assert cache.get("b") is None
+
+
+def test_entries_are_stored_as_json(tmp_path, kb_files):
+    patch = IR(
+        tuning_config={"packing": "True", "padding_free": REMOVE},
+        type=PatchType.SYSTEM_PERFORMANCE,
+        level=PatchLevel.SUGGESTION,
+        comment=Comment("packing"),
+    )
+    value = (IR(tuning_config={"a": 1}), [{"json_merge_patch": patch, "c": None}])
+    RecommendationCache(tmp_path / "cache").put("a", value)
+    (entry,) = (tmp_path / "cache").glob("*/a.*")
+    json.loads(entry.read_text())
+
+    ir, [patches] = RecommendationCache(tmp_path / "cache").get("a")
+    assert ir == value[0]
+    cached = patches["json_merge_patch"]
+    assert cached.tuning_config == patch.tuning_config
+    assert cached.level is PatchLevel.SUGGESTION
+    assert cached.effect is PatchType.SYSTEM_PERFORMANCE
+    assert str(cached.comment) == "packing"
+    assert patches["c"] is None
+
+
+def test_disk_tier_evicts_oldest_entries(tmp_path, kb_files):
+    cache = RecommendationCache(tmp_path / "cache", max_disk_bytes=2500)
+    for key in "abc":
+        cache.put(key, "x" * 1000)
+    other = RecommendationCache(tmp_path / "cache")
+    assert other.get("a") is None
+    assert other.get("c") == "x" * 1000
+
+
+def test_disk_tier_is_only_scanned_past_its_limit(tmp_path, kb_files, monkeypatch):
+    cache = RecommendationCache(tmp_path / "cache", max_disk_bytes=2500)
+    scans = []
+    stat_entries = cache._stat_entries
+
+    def count_scans():
+        scans.append(1)
+        return stat_entries()
+
+    monkeypatch.setattr(cache, "_stat_entries", count_scans)
+    cache.put("a", "x" * 1000)
+    cache.put("b", "x" * 1000)
+    # replacing an entry does not grow the disk tier
+    cache.put("b", "y" * 1000)
+    assert len(scans) == 1
+    cache.put("c", "x" * 1000)
+    assert len(scans) == 2
+    assert RecommendationCache(tmp_path / "cache").get("a") is None
+
+
+def test_kb_change_invalidates_both_tiers(tmp_path, kb_files):
+    cache = RecommendationCache(tmp_path / "cache")
+    cache.put("a", 1)
+    kb_files[1].write_text("model_name,method\ngranite,lora\n")
+    assert cache.get("a") is None
+    assert RecommendationCache(tmp_path / "cache").get("a") is None
+
+
+def test_kb_versions_keep_their_entries(tmp_path, kb_files):
+    """Processes on different KB versions do not drop each other's entries"""
+    RecommendationCache(tmp_path / "cache").put("a", 1)
+    old_run_data = kb_files[1].read_text()
+    kb_files[1].write_text("model_name,method\ngranite,lora\n")
+    RecommendationCache(tmp_path / "cache").put("b", 2)
+
+    kb_files[1].write_text(old_run_data)
+    cache = RecommendationCache(tmp_path / "cache")
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_adapter_reuses_cached_recommendation(tmp_path, kb_files, monkeypatch):
+    runs = []
+
+    def apply(self, ir, actions_meta=None, context=None):
+        runs.append(ir)
+        return ir, []
+
+    monkeypatch.setattr(adapters.RuleEngine, "apply", apply)
+    adapter = VanillaAdapter()
+    adapter.cache = RecommendationCache(tmp_path / "cache")
+
+    def execute():
+        return adapter.execute(
+            {"model_name_or_path": str(tmp_path), "tuning_strategy": "full"},
+            compute_config={},
+            accelerate_config={},
+            data_config={},
+            unique_tag="",
+        )
+
+    first_ir, _ = execute()
+    second_ir, _ = execute()
+    assert len(runs) == 1
+    assert isinstance(second_ir, IR)
+    assert second_ir.tuning_config == first_ir.tuning_config
@@ -0,0 +1,402 @@
+import gc
+import json
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+
+import pytest
+
+from tuning_config_recommender.actions import (
+    IR,
+    REMOVE,
+    Action,
+    PatchLevel,
+    PatchType,
+    RunContext,
+)
+from tuning_config_recommender.rule_engine import (
+    PatchMode,
+    RuleEngine,
+    clear_engine_plan_cache,
+    get_engine_plan,
+    paths_overlap,
+)
+
+
+class CountingAction(Action):
+    """Test action recording its runs, patch is computed from the input IR"""
+
+    def __init__(self, patch_fn):
+        self.patch_fn = patch_fn
+        self.runs = 0
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        self.runs += 1
+        tuning_config = self.patch_fn(ir)
+        if not tuning_config:
+            return
+        return IR(
+            tuning_config=tuning_config,
+            type=PatchType.COMPATIBILITY,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+@pytest.fixture
+def engine():
+    return RuleEngine()
+
+
+@pytest.fixture
+def ir(tmp_path):
+    return IR(
+        tuning_config={
+            "model_name_or_path": str(tmp_path),
+            "tuning_strategy": "full",
+            "max_seq_length": 4096,
+        },
+        compute_config={"num_gpus_per_node": 8},
+    )
+
+
+def test_paths_overlap():
+    assert paths_overlap("tuning_config", "tuning_config.max_seq_length")
+    assert paths_overlap("tuning_config.max_seq_length", "tuning_config")
+    assert not paths_overlap("tuning_config.max_seq_length", "tuning_config.max")
+    assert not paths_overlap("compute_config", "tuning_config.max_seq_length")
+
+
+def test_only_actions_reading_changed_paths_rerun(engine, ir):
+    """Actions are rerun when a later patch changes what they read"""
+    batch_size = CountingAction(
+        lambda ir: {
+            "per_device_train_batch_size": 16384 // ir.tuning_config["max_seq_length"]
+        }
+    )
+    batch_size.reads = ("tuning_config.max_seq_length",)
+    compute = CountingAction(lambda ir: None)
+    compute.reads = ("compute_config",)
+    seq_length = CountingAction(lambda ir: {"max_seq_length": 1024})
+    seq_length.reads = ("tuning_config.max_seq_length",)
+    for action in (batch_size, compute, seq_length):
+        engine.register_action(action)
+
+    final_ir, _ = engine.apply(ir)
+
+    assert final_ir.tuning_config["per_device_train_batch_size"] == 16
+    assert batch_size.runs == 2
+    assert compute.runs == 1
+    assert seq_length.runs == 1
+
+
+def test_converges_without_skip_flags(engine, ir):
+    """Actions never calling skip stop once the IR reaches a fixed point"""
+    action = CountingAction(lambda ir: {"use_flash_attn": True})
+    other = CountingAction(lambda ir: {"padding_free": "huggingface"})
+    engine.register_action(action)
+    engine.register_action(other)
+
+    context = RunContext()
+    final_ir, _ = engine.apply(ir, context=context)
+
+    assert final_ir.tuning_config["use_flash_attn"] is True
+    assert action.runs == 2
+    assert other.runs == 1
+    assert len(context.ir_pipeline) == 3
+
+
+def test_depends_on_flags_are_read_paths():
+    action = Action()
+    assert set(action.read_paths()) == {
+        "tuning_config",
+        "compute_config",
+        "accelerate_config",
+        "tuning_data_config",
+    }
+    action.depends_on_compute_config = True
+    action.depends_on_dataset = True
+    assert action.read_paths() == (
+        "compute_config",
+        "tuning_data_config",
+        "tuning_config.training_data_path",
+    )
+
+
+def test_actions_modify_a_view_and_stages_share_sections(engine, ir):
+    """Actions may mutate their input without touching the engine state, and
+    stored stages share every section the action did not patch"""
+    ir.tuning_data_config = {"datasets": [{"name": "a", "data_handlers": {}}]}
+
+    def mutate(ir):
+        ir.tuning_data_config["datasets"][0]["data_handlers"]["x"] = 1
+        ir.compute_config["num_gpus_per_node"] = 1
+        return {"max_seq_length": 1024}
+
+    action = CountingAction(mutate)
+    engine.register_action(action)
+    context = RunContext()
+    final_ir, _ = engine.apply(ir, context=context)
+
+    assert final_ir.tuning_data_config == {
+        "datasets": [{"name": "a", "data_handlers": {}}]
+    }
+    assert final_ir.compute_config == {"num_gpus_per_node": 8}
+    stage = context.json_patches_and_comment_wrt_source[action][-1]["stage_source_ir"]
+    assert stage.tuning_data_config is context.ir_pipeline[0].tuning_data_config
+
+
+class BatchSizeAction(Action):
+    """Stateless action deriving its patch from the input only"""
+
+    reads = ("tuning_config.max_seq_length",)
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.skip:
+            return
+        self.skip = True
+        return IR(
+            tuning_config={
+                "per_device_train_batch_size": 65536
+                // ir.tuning_config["max_seq_length"],
+                "meta": list(actions_meta),
+            },
+            type=PatchType.SYSTEM_PERFORMANCE,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+def test_concurrent_applies_are_isolated(engine, tmp_path):
+    """One engine serves many parallel runs without sharing their state or
+    growing memory from run to run"""
+    engine.register_action(BatchSizeAction())
+
+    def run(i):
+        ir = IR(
+            tuning_config={
+                "model_name_or_path": str(tmp_path),
+                "tuning_strategy": "full",
+                "max_seq_length": 2 ** (i % 8 + 4),
+            }
+        )
+        final_ir, patches = engine.apply(ir, actions_meta=[f"run-{i}"])
+        return i, final_ir, patches
+
+    def run_many():
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            return list(pool.map(run, range(300)))
+
+    tracemalloc.start()
+    try:
+        run_many()
+        gc.collect()
+        baseline = tracemalloc.get_traced_memory()[0]
+        run_many()
+        gc.collect()
+        grown = tracemalloc.get_traced_memory()[0] - baseline
+    finally:
+        tracemalloc.stop()
+
+    assert grown < 512 * 1024
+    for i, final_ir, patches in run_many():
+        max_seq_length = 2 ** (i % 8 + 4)
+        assert final_ir.tuning_config["max_seq_length"] == max_seq_length
+        assert final_ir.tuning_config["per_device_train_batch_size"] == (
+            65536 // max_seq_length
+        )
+        assert final_ir.tuning_config["meta"] == [f"run-{i}"]
+        assert len(patches) == 2
+    assert engine.actions[0].skip is False
+
+
+class BarrierAction(Action):
+    """Action writing a single key derived from the paths it reads. With a
+    barrier it only gets past it once all parties run at the same time."""
+
+    def __init__(self, key, reads, fn, barrier=None):
+        self.key = key
+        self.reads = reads
+        self.writes = (f"tuning_config.{key}",)
+        self.fn = fn
+        self.barrier = barrier
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.barrier is not None:
+            # raises BrokenBarrierError unless the other parties overlap
+            self.barrier.wait(timeout=10)
+        return IR(
+            tuning_config={self.key: self.fn(ir)},
+            type=PatchType.COMPATIBILITY,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+def _barrier_actions(barrier=None):
+    return [
+        BarrierAction("a", (), lambda ir: 1, barrier),
+        BarrierAction("b", (), lambda ir: 2, barrier),
+        BarrierAction("c", (), lambda ir: 3, barrier),
+        BarrierAction(
+            "d",
+            ("tuning_config.a", "tuning_config.c"),
+            lambda ir: ir.tuning_config.get("a", 0) + ir.tuning_config.get("c", 0),
+        ),
+    ]
+
+
+def test_parallel_runs_independent_actions_concurrently(ir):
+    """Parallel mode overlaps independent actions and gives the same result
+    and patches as sequential mode"""
+    results = {}
+    for parallel in (False, True):
+        engine = RuleEngine(parallel=parallel)
+        # only independent actions evaluated concurrently meet at the barrier
+        barrier = threading.Barrier(3) if parallel else None
+        for action in _barrier_actions(barrier):
+            engine.register_action(action)
+        results[parallel] = engine.apply(deepcopy(ir))
+
+    sequential_ir, sequential_patches = results[False]
+    parallel_ir, parallel_patches = results[True]
+    assert parallel_ir.tuning_config["d"] == 4
+    assert parallel_ir == sequential_ir
+    assert json.dumps(parallel_patches, default=str) == json.dumps(
+        sequential_patches, default=str
+    )
+
+
+def test_parallel_reruns_actions_reading_undeclared_writes(ir):
+    """A result computed on an IR an earlier member changed is dropped and
+    the action is run again, even when the writes were not declared"""
+    engine = RuleEngine(parallel=True)
+    writer = CountingAction(lambda ir: {"max_seq_length": 1024})
+    writer.reads = ()
+    writer.writes = ()
+    reader = CountingAction(
+        lambda ir: {
+            "per_device_train_batch_size": 16384 // ir.tuning_config["max_seq_length"]
+        }
+    )
+    reader.reads = ("tuning_config.max_seq_length",)
+    reader.writes = ("tuning_config.per_device_train_batch_size",)
+    engine.register_action(writer)
+    engine.register_action(reader)
+
+    final_ir, _ = engine.apply(ir)
+
+    assert final_ir.tuning_config["per_device_train_batch_size"] == 16
+    assert reader.runs == 2
+
+
+class SectionAction(Action):
+    """Merges a fixed patch into the IR once"""
+
+    def __init__(self, **sections):
+        self.sections = sections
+
+    def apply(self, ir: IR, actions_meta: list[str]) -> IR:
+        if self.skip:
+            return
+        self.skip = True
+        return IR(
+            **self.sections,
+            type=PatchType.COMPATIBILITY,
+            level=PatchLevel.SUGGESTION,
+        )
+
+
+def _patching_actions():
+    return [
+        SectionAction(tuning_config={"max_seq_length": 1024, "packing": True}),
+        SectionAction(
+            tuning_data_config={
+                "datasets": [{"name": "a", "data_handlers": {"x": [1, 2]}}]
+            },
+            accelerate_config={"num_processes": 8},
+        ),
+        SectionAction(tuning_config={"packing": None, "padding_free": "huggingface"}),
+    ]
+
+
+@pytest.mark.parametrize("mode", list(PatchMode))
+def test_patch_modes_agree(ir, tmp_path, mode):
+    """Patches derived from merge patches equal those of full diffs, including
+    changes made by validation and sections missing in the source"""
+    ir.tuning_config["training_data_path"] = str(tmp_path / "data.jsonl")
+    ir.tuning_data_config = {"datasets": [{"name": "a", "data_handlers": {}}]}
+    ir.accelerate_config = None
+    results = {}
+    for patch_mode in (PatchMode.DIFF, mode):
+        engine = RuleEngine(patch_mode=patch_mode)
+        for action in _patching_actions():
+            engine.register_action(action)
+        results[patch_mode] = engine.apply(deepcopy(ir))
+
+    final_ir, patches = results[mode]
+    assert final_ir == results[PatchMode.DIFF][0]
+    assert patches == results[PatchMode.DIFF][1]
+    assert {
+        "op": "remove",
+        "path": "/tuning_config/training_data_path",
+    } in patches[-2]["json_patch"]
+
+
+@pytest.mark.parametrize("mode", list(PatchMode))
+def test_none_is_set_and_remove_drops_the_key(ir, mode):
+    engine = RuleEngine(patch_mode=mode)
+    engine.register_action(
+        SectionAction(
+            tuning_config={
+                "max_seq_length": REMOVE,
+                "gradient_checkpointing_kwargs": None,
+            }
+        )
+    )
+    final_ir, patches = engine.apply(ir)
+    assert "max_seq_length" not in final_ir.tuning_config
+    assert final_ir.tuning_config["gradient_checkpointing_kwargs"] is None
+    assert {"op": "remove", "path": "/tuning_config/max_seq_length"} in patches[0][
+        "json_patch"
+    ]
+
+
+def test_incremental_patches_do_not_diff_the_ir(ir, monkeypatch):
+    def full_diff(*args):
+        raise AssertionError("full IR diff")
+
+    monkeypatch.setattr(IR, "get_json_patch", full_diff)
+    engine = RuleEngine()
+    for action in _patching_actions():
+        engine.register_action(action)
+    _, patches = engine.apply(ir)
+    assert {
+        "op": "add",
+        "path": "/tuning_config/padding_free",
+        "value": "huggingface",
+    } in patches[-2]["json_patch"]
+
+
+class WarmedAction(BatchSizeAction):
+    instances = 0
+    warmed = 0
+
+    def __init__(self):
+        WarmedAction.instances += 1
+
+    def warm(self):
+        WarmedAction.warmed += 1
+
+
+def test_engine_plan_is_built_once_per_action_set(ir):
+    clear_engine_plan_cache()
+    plan = get_engine_plan([WarmedAction])
+    assert get_engine_plan([WarmedAction]) is plan
+    assert (WarmedAction.instances, WarmedAction.warmed) == (1, 1)
+
+    results = [RuleEngine.from_plan(plan).apply(deepcopy(ir)) for _ in range(3)]
+    engine = RuleEngine()
+    engine.register_action(WarmedAction())
+    expected = engine.apply(deepcopy(ir))
+    assert all(result == expected for result in results)
+    assert WarmedAction.warmed == 1
+    clear_engine_plan_cache()
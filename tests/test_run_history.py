@@ -0,0 +1,147 @@
+import json
+
+import pytest
+import yaml
+
+from tuning_config_recommender.constants import RUN_HISTORY_DIR_ENV_VAR
+from tuning_config_recommender.utils.kb_table import clear_kb_snapshot, reload_kb
+from tuning_config_recommender.utils.run_history import (
+    RUN_METADATA_FILE,
+    RunHistoryStore,
+    find_run_dirs,
+    ingest_runs,
+    parse_run_dir,
+    run_aggregates_path,
+)
+from tuning_config_recommender.utils.tuning_config import use_kb_for_batch_size
+
+
+def _write_run(root, name, batch_size, tokens_per_second, max_seq_length=4096):
+    """Output folder of a finished run as left by fms-hf-tuning"""
+    run_dir = root / name
+    (run_dir / "checkpoint-10").mkdir(parents=True)
+    (run_dir / "tuning_config.yaml").write_text(
+        yaml.safe_dump(
+            {
+                "model_name_or_path": "/models/granite-3b/main",
+                "original_model_name_or_path": "ibm-granite/granite-3b",
+                "max_seq_length": max_seq_length,
+                "per_device_train_batch_size": batch_size,
+                "gradient_accumulation_steps": 2,
+            }
+        )
+    )
+    (run_dir / "compute_config.yaml").write_text(
+        yaml.safe_dump({"num_nodes": 1, "num_gpus_per_node": 4})
+    )
+    state = {
+        "train_batch_size": batch_size,
+        "log_history": [
+            {"loss": 1.5, "step": 5},
+            {
+                "train_runtime": 100.0,
+                "train_samples_per_second": 8.0,
+                "train_tokens_per_second": tokens_per_second,
+                "step": 10,
+            },
+        ],
+    }
+    for folder in (run_dir, run_dir / "checkpoint-10"):
+        (folder / "trainer_state.json").write_text(json.dumps(state))
+    (run_dir / "training_logs.jsonl").write_text(
+        json.dumps({"name": "training_loss", "data": {"step": 10, "value": 1.2}}) + "\n"
+    )
+    return run_dir
+
+
+def test_parse_run_dir(tmp_path):
+    run_dir = _write_run(tmp_path, "exp-1", 8, 7200.0)
+    record = parse_run_dir(run_dir, gpu_hour_cost=2.0)
+    assert record["model_name"] == "granite-3b"
+    assert record["method"] == "full"
+    assert record["model_max_length"] == 4096
+    assert record["batch_size"] == 8 * 4 * 2
+    assert record["number_gpus"] == 4
+    assert record["dataset_tokens_per_second"] == 7200.0
+    assert record["gpu_hours_per_million_tokens"] == pytest.approx(
+        4 * 1e6 / 7200 / 3600
+    )
+    assert record["dollars_per_million_tokens"] == pytest.approx(
+        2 * record["gpu_hours_per_million_tokens"]
+    )
+    assert record["train_loss"] == 1.2
+    assert record["experiment_id"].startswith("exp-1-")
+    assert parse_run_dir(run_dir)["experiment_id"] == record["experiment_id"]
+    assert find_run_dirs([tmp_path]) == [run_dir.resolve()]
+
+    # a moved run keeps its id, a run of the same folder name and another
+    # config is another experiment
+    moved = tmp_path / "moved"
+    moved.mkdir()
+    run_dir = run_dir.rename(moved / "exp-1")
+    assert parse_run_dir(run_dir)["experiment_id"] == record["experiment_id"]
+    other = _write_run(tmp_path / "other", "exp-1", 16, 7200.0)
+    assert parse_run_dir(other)["experiment_id"] != record["experiment_id"]
+    (other / RUN_METADATA_FILE).write_text(json.dumps({"experiment_id": 42}))
+    assert parse_run_dir(other)["experiment_id"] == "42"
+
+
+def test_run_is_stored_once_as_it_progresses(tmp_path):
+    run_dir = _write_run(tmp_path / "runs", "exp-1", 8, 7200.0)
+    # the run while training, with a checkpoint only
+    (run_dir / "trainer_state.json").unlink()
+    store_root = tmp_path / "store"
+    assert ingest_runs([tmp_path / "runs"], store_root) == 1
+
+    state = json.loads((run_dir / "checkpoint-10" / "trainer_state.json").read_text())
+    state["log_history"].append({"loss": 1.1, "step": 20})
+    (run_dir / "trainer_state.json").write_text(json.dumps(state))
+    assert ingest_runs([tmp_path / "runs"], store_root) == 0
+    assert len(RunHistoryStore(store_root).read_runs()) == 1
+
+
+def test_ingestion_dedupes_and_aggregates(tmp_path):
+    runs = tmp_path / "runs"
+    _write_run(runs, "exp-1", 8, 7200.0)
+    _write_run(runs, "exp-2", 16, 9000.0)
+    _write_run(runs, "exp-3", 4, 3000.0, max_seq_length=1024)
+    store_root = tmp_path / "store"
+
+    assert ingest_runs([runs], store_root) == 3
+    assert ingest_runs([runs], store_root) == 0
+    _write_run(runs, "exp-4", 32, 1000.0)
+    assert ingest_runs([runs], store_root) == 1
+    # same folder name as a stored run
+    _write_run(tmp_path / "more_runs", "exp-1", 2, 500.0)
+    assert ingest_runs([tmp_path / "more_runs"], store_root) == 1
+
+    store = RunHistoryStore(store_root)
+    experiment_ids = store.read_runs()["experiment_id"]
+    assert len(set(experiment_ids)) == 5
+    aggregates = store.read_aggregates()
+    columns = ["model_max_length", "per_device_train_batch_size"]
+    assert aggregates[columns].values.tolist() == [[1024, 4], [4096, 16]]
+    assert aggregates["num_runs"].tolist() == [1, 4]
+
+
+def test_batch_size_lookup_reads_aggregates(tmp_path, monkeypatch):
+    _write_run(tmp_path / "runs", "exp-1", 16, 9000.0)
+    monkeypatch.setenv(RUN_HISTORY_DIR_ENV_VAR, str(tmp_path / "store"))
+    assert ingest_runs([tmp_path / "runs"]) == 1
+    assert run_aggregates_path() == RunHistoryStore().aggregates_path
+    assert run_aggregates_path().is_file()
+    reload_kb()
+    try:
+        assert use_kb_for_batch_size(
+            {
+                "model_name_or_path": "/cache/granite-3b/tag",
+                "tuning_strategy": "full",
+                "max_seq_length": 8192,
+            }
+        ) == {
+            "per_device_train_batch_size": 16,
+            "model_max_length": 4096,
+            "number_gpus": 4,
+        }
+    finally:
+        clear_kb_snapshot()
@@ -0,0 +1,232 @@
+import json
+
+import numpy as np
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from tuning_config_recommender.actions import IR, REMOVE, PatchLevel
+from tuning_config_recommender.actions.data import ApplyMaxSeqLength
+from tuning_config_recommender.actions.train import (
+    ApplyPackingOptimization,
+    ApplyTrainingOptimization,
+)
+from tuning_config_recommender.utils import token_stats
+from tuning_config_recommender.utils.dataset_profile import (
+    clear_dataset_profile_cache,
+)
+from tuning_config_recommender.utils.token_stats import (
+    PaddingStrategy,
+    choose_padding_strategy,
+    clear_token_stats_cache,
+    estimate_padding_waste,
+    get_token_length_stats,
+)
+
+WORDS = ["q", "a", "user", "assistant", "###", "Input:", "Response:"]
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache():
+    clear_dataset_profile_cache()
+    clear_token_stats_cache()
+    yield
+    clear_dataset_profile_cache()
+    clear_token_stats_cache()
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    """Offline model folder with a whitespace word level fast tokenizer"""
+    vocab = {"[UNK]": 0, **{w: i + 1 for i, w in enumerate(WORDS)}}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    path = tmp_path / "model"
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="[UNK]"
+    ).save_pretrained(path)
+    (path / "config.json").write_text(json.dumps({"max_position_embeddings": 2048}))
+    return str(path)
+
+
+def _write_qa(path, answer_lengths):
+    records = [{"Question": "q", "answer": " ".join(["a"] * n)} for n in answer_lengths]
+    path.write_text("\n".join(json.dumps(r) for r in records) + "\n")
+    return str(path)
+
+
+def test_qa_lengths_follow_the_template(tmp_path, model_dir):
+    """QA records are measured as rendered by the QA template"""
+    path = _write_qa(tmp_path / "qa.jsonl", [1, 10, 100])
+    stats = get_token_length_stats([path], model_dir)
+    # "### Input: q ### Response:" adds five tokens to every answer
+    assert sorted(stats.lengths.tolist()) == [6, 15, 105]
+    assert stats.truncation_rate(15) == pytest.approx(1 / 3)
+
+
+def test_chat_and_tokenized_lengths(tmp_path, model_dir):
+    chat = tmp_path / "chat.jsonl"
+    chat.write_text(
+        json.dumps(
+            {
+                "messages": [
+                    {"role": "user", "content": "q q"},
+                    {"role": "assistant", "content": "a"},
+                ]
+            }
+        )
+    )
+    tokenized = tmp_path / "tokenized.jsonl"
+    tokenized.write_text(json.dumps({"input_ids": [1, 2, 3, 4], "labels": [1]}))
+
+    assert get_token_length_stats([str(chat)], model_dir).lengths.tolist() == [5]
+    assert get_token_length_stats([str(tokenized)], model_dir).lengths.tolist() == [4]
+
+
+def test_stats_are_cached_per_dataset_and_tokenizer(tmp_path, model_dir, monkeypatch):
+    calls = []
+    original = token_stats.compute_token_length_stats
+
+    def counting_compute(*args, **kwargs):
+        calls.append(args[0])
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(token_stats, "compute_token_length_stats", counting_compute)
+    path = _write_qa(tmp_path / "qa.jsonl", [1, 2])
+    get_token_length_stats([path], model_dir)
+    get_token_length_stats([path], model_dir)
+    assert len(calls) == 1
+
+    tokenizer_config = tmp_path / "model" / "tokenizer_config.json"
+    config = json.loads(tokenizer_config.read_text())
+    config["model_max_length"] = 1024
+    tokenizer_config.write_text(json.dumps(config))
+    get_token_length_stats([path], model_dir)
+    assert len(calls) == 2
+
+
+def test_no_tokenizer_files(tmp_path):
+    path = _write_qa(tmp_path / "qa.jsonl", [1])
+    assert get_token_length_stats([path], str(tmp_path)) is None
+
+
+class TestApplyMaxSeqLength:
+    def _ir(self, model_dir, data_path, **tuning_config):
+        return IR(
+            tuning_config={
+                "model_name_or_path": model_dir,
+                "training_data_path": data_path,
+                **tuning_config,
+            }
+        )
+
+    def test_recommends_rounded_percentile(self, tmp_path, model_dir):
+        path = _write_qa(tmp_path / "qa.jsonl", [10] * 90 + [300] * 10)
+        patch = ApplyMaxSeqLength().apply(self._ir(model_dir, path), [])
+        assert patch.tuning_config == {"max_seq_length": 512}
+        assert patch.level == PatchLevel.SUGGESTION
+
+    def test_keeps_user_value_without_truncation(self, tmp_path, model_dir):
+        path = _write_qa(tmp_path / "qa.jsonl", [10] * 10)
+        ir = self._ir(model_dir, path, max_seq_length=384)
+        assert ApplyMaxSeqLength().apply(ir, []) is None
+
+    def test_suggests_shorter_length_for_oversized_user_value(
+        self, tmp_path, model_dir
+    ):
+        path = _write_qa(tmp_path / "qa.jsonl", [10] * 10)
+        ir = self._ir(model_dir, path, max_seq_length=2048)
+        patch = ApplyMaxSeqLength().apply(ir, [])
+        assert patch.tuning_config == {"max_seq_length": 256}
+        assert patch.level == PatchLevel.SUGGESTION
+        assert "8.0x the recommended 256" in str(patch.comment)
+
+    def test_flags_truncation_beyond_model_length(self, tmp_path, model_dir):
+        path = _write_qa(tmp_path / "qa.jsonl", [10] * 9 + [3000])
+        ir = self._ir(model_dir, path, max_seq_length=256)
+        patch = ApplyMaxSeqLength().apply(ir, [])
+        assert patch.tuning_config == {"max_seq_length": 2048}
+        assert patch.level == PatchLevel.USER_INTERVENTION
+        assert "truncates 10.0%" in str(patch.comment)
+
+
+def test_padding_waste_estimates():
+    lengths = np.array([10, 30, 20, 20, 50])
+    estimates = estimate_padding_waste(lengths, max_seq_length=40, batch_size=2)
+    # batches [10, 30] [20, 20] [40] pad to 60 + 40 + 40 positions
+    padding = estimates[PaddingStrategy.PADDING]
+    assert padding.useful_token_fraction == pytest.approx(120 / 140)
+    assert padding.token_coverage == pytest.approx(120 / 130)
+    # 130 tokens packed into four blocks of 40
+    packing = estimates[PaddingStrategy.PACKING]
+    assert packing.useful_token_fraction == pytest.approx(130 / 160)
+    assert packing.token_coverage == 1.0
+    assert estimates[PaddingStrategy.PADDING_FREE].useful_token_fraction == 1.0
+
+
+def test_padding_strategy_choice():
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 4096, size=100_000)
+    best = choose_padding_strategy(estimate_padding_waste(lengths, 4096, 8))
+    assert best.strategy == PaddingStrategy.PADDING_FREE
+
+    # packing wins a tie when padding free would truncate samples
+    lengths = np.full(1000, 600)
+    best = choose_padding_strategy(estimate_padding_waste(lengths, 512, 8))
+    assert best.strategy == PaddingStrategy.PACKING
+
+
+class TestApplyPackingOptimization:
+    def _ir(self, model_dir, data_path, **tuning_config):
+        return IR(
+            tuning_config={
+                "model_name_or_path": model_dir,
+                "training_data_path": str(data_path),
+                **tuning_config,
+            }
+        )
+
+    def _write_tokenized(self, path, lengths):
+        path.write_text("\n".join(json.dumps({"input_ids": [1] * n}) for n in lengths))
+        return path
+
+    def test_qa_data_is_never_packed(self, tmp_path, model_dir):
+        path = _write_qa(tmp_path / "qa.jsonl", [2000] * 10)
+        ir = self._ir(model_dir, path, max_seq_length=1024, use_flash_attn=True)
+        patch = ApplyPackingOptimization().apply(ir, [])
+        assert patch.tuning_config == {
+            "padding_free": "huggingface",
+            "packing": "False",
+        }
+        assert "throughput gain" in str(patch.comment)
+
+    def test_flash_attention_turned_off_is_kept(self, model_dir):
+        ir = IR(
+            tuning_config={"model_name_or_path": model_dir, "use_flash_attn": "False"}
+        )
+        assert ApplyTrainingOptimization().apply(ir, []) is None
+        ir.tuning_config["use_flash_attn"] = True
+        patch = ApplyTrainingOptimization().apply(ir, [])
+        assert patch.tuning_config["padding_free"] == "huggingface"
+
+    def test_padding_free_needs_flash_attention(self, tmp_path, model_dir):
+        path = _write_qa(tmp_path / "qa.jsonl", [2000] * 10)
+        ir = self._ir(model_dir, path, max_seq_length=1024, use_flash_attn="False")
+        assert ApplyPackingOptimization().apply(ir, []) is None
+
+    def test_recommends_packing(self, tmp_path, model_dir):
+        path = self._write_tokenized(tmp_path / "tokenized.jsonl", [600] * 100)
+        ir = self._ir(model_dir, path, max_seq_length=512, use_flash_attn=True)
+        patch = ApplyPackingOptimization().apply(ir, [])
+        assert patch.tuning_config == {"packing": "True", "padding_free": REMOVE}
+
+    def test_recommends_padding_without_flash_attention(self, tmp_path, model_dir):
+        path = self._write_tokenized(tmp_path / "tokenized.jsonl", [500] * 100)
+        ir = self._ir(model_dir, path, max_seq_length=512, padding_free="huggingface")
+        patch = ApplyPackingOptimization().apply(ir, [])
+        assert patch.tuning_config == {"packing": "False", "padding_free": REMOVE}
+        assert "use_flash_attn is off" in str(patch.comment)
+
+        ir.update(patch)
+        assert ir.tuning_config["packing"] == "False"
+        assert "padding_free" not in ir.tuning_config
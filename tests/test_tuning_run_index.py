@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from tuning_config_recommender.utils import kb_table
+from tuning_config_recommender.utils.kb_table import clear_kb_snapshot, reload_kb
+from tuning_config_recommender.utils.tuning_config import (
+    TuningRunIndex,
+    use_kb_for_batch_size,
+)
+
+
+def _pandas_best_row(df, model_name, method, target_length):
+    """Reference lookup filtering the whole frame"""
+    df = df[(df["model_name"] == model_name) & (df["method"] == method)]
+    exact_match = df[df["model_max_length"] == target_length]
+    if not exact_match.empty:
+        return exact_match.iloc[0]
+    smaller_matches = df[df["model_max_length"] < target_length]
+    if not smaller_matches.empty:
+        return smaller_matches.sort_values(
+            by="model_max_length", ascending=False, kind="stable"
+        ).iloc[0]
+    return None
+
+
+def _run_data(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "model_name": rng.choice(["granite-3b-base", "llama-8b"], num_rows),
+            "method": rng.choice(["full", "lora"], num_rows),
+            "model_max_length": rng.choice([512, 1024, 2048, 4096], num_rows),
+            "per_device_train_batch_size": rng.integers(1, 64, num_rows),
+            "number_gpus": rng.choice([1, 2, 4, 8], num_rows),
+        }
+    )
+
+
+def _arrow_index(df):
+    return TuningRunIndex.from_arrow(pa.RecordBatch.from_pandas(df))
+
+
+@pytest.mark.parametrize("build_index", [TuningRunIndex, _arrow_index])
+def test_index_matches_pandas_lookup(build_index):
+    df = _run_data(200)
+    index = build_index(df)
+    for model_name in ("granite-3b-base", "llama-8b", "unknown"):
+        for method in ("full", "lora"):
+            for target in (256, 512, 1000, 2048, 8192):
+                expected = _pandas_best_row(df, model_name, method, target)
+                row = index.find_best_row(model_name, method, target)
+                if expected is None:
+                    assert row is None
+                else:
+                    assert row == {c: expected[c] for c in TuningRunIndex.COLUMNS}
+
+
+@pytest.fixture
+def run_data_path(tmp_path, monkeypatch):
+    path = tmp_path / "tuning_run_data.csv"
+    monkeypatch.setattr(kb_table, "TUNING_RUN_DATA_PATH", path)
+    yield path
+    clear_kb_snapshot()
+
+
+def test_run_data_is_reloaded_after_change(run_data_path):
+    df = _run_data(1).assign(
+        model_name="granite-3b-instruct", method="full", model_max_length=2048
+    )
+    df.to_csv(run_data_path, index=False)
+    reload_kb()
+    user_input = {
+        "model_name_or_path": "/models/granite-3b-base/main",
+        "tuning_strategy": "full",
+        "max_seq_length": 4096,
+    }
+    # base models fall back to the instruct runs
+    assert use_kb_for_batch_size(user_input) == {
+        "per_device_train_batch_size": int(df["per_device_train_batch_size"][0]),
+        "model_max_length": 2048,
+        "number_gpus": int(df["number_gpus"][0]),
+    }
+
+    df.assign(model_max_length=16384).to_csv(run_data_path, index=False)
+    reload_kb()
+    assert use_kb_for_batch_size(user_input) == {}
+
+
+@pytest.mark.parametrize("columns", [[], ["model_name", "method"]])
+def test_empty_run_data(columns):
+    index = TuningRunIndex(pd.DataFrame(columns=columns))
+    assert index.find_best_row("granite-3b-base", "full", 4096) is None